@@ -28,6 +28,7 @@ import gnome15.g15globals as g15globals
 import gnome15.util.g15scheduler as g15scheduler
 import gnome15.util.g15uigconf as g15uigconf
 import gnome15.util.g15gconf as g15gconf
+import gnome15.util.g15pixels as g15pixels
 import gnome15.g15uinput as g15uinput
 import gnome15.g15exceptions as g15exceptions
 import sys
@@ -35,8 +36,6 @@ import os
 import gconf
 import gtk
 import logging
-from PIL import ImageMath
-from PIL import Image
 import array
 logger = logging.getLogger(__name__)
 load_error = None
@@ -121,14 +120,15 @@ backlight_control = g15driver.Control("keyboard_backlight", _("Keyboard Backligh
 lcd_backlight_control = g15driver.Control("lcd_backlight", _("LCD Backlight Level"), 2, 0, 2, hint = g15driver.HINT_SHADEABLE)
 lcd_contrast_control = g15driver.Control("lcd_contrast", _("LCD Contrast"), 22, 0, 2)
 invert_control = g15driver.Control("invert_lcd", _("Invert LCD"), 0, 0, 1, hint = g15driver.HINT_SWITCH )
+dither_control = g15driver.Control("dither_lcd", _("Dither LCD"), 1, 0, 1, hint = g15driver.HINT_SWITCH )
 
 controls = {
   g15driver.MODEL_G11 :         [ mkeys_control, backlight_control ],
-  g15driver.MODEL_G15_V1 :      [ mkeys_control, backlight_control, lcd_contrast_control, lcd_backlight_control, invert_control ], 
-  g15driver.MODEL_G15_V2 :      [ mkeys_control, backlight_control, lcd_backlight_control, invert_control ],
-  g15driver.MODEL_G13 :         [ mkeys_control, color_backlight_control, invert_control ],
-  g15driver.MODEL_G510 :        [ mkeys_control, color_backlight_control, invert_control ],
-  g15driver.MODEL_Z10 :         [ backlight_control, lcd_backlight_control, invert_control ],
+  g15driver.MODEL_G15_V1 :      [ mkeys_control, backlight_control, lcd_contrast_control, lcd_backlight_control, invert_control, dither_control ], 
+  g15driver.MODEL_G15_V2 :      [ mkeys_control, backlight_control, lcd_backlight_control, invert_control, dither_control ],
+  g15driver.MODEL_G13 :         [ mkeys_control, color_backlight_control, invert_control, dither_control ],
+  g15driver.MODEL_G510 :        [ mkeys_control, color_backlight_control, invert_control, dither_control ],
+  g15driver.MODEL_Z10 :         [ backlight_control, lcd_backlight_control, invert_control, dither_control ],
   g15driver.MODEL_G110 :        [ mkeys_control, red_blue_backlight_control ],
             }   
 
@@ -306,50 +306,18 @@ class Driver(g15driver.AbstractDriver):
              
         self.lock.acquire()        
         try :           
+            # Threshold (or dither), invert and pack straight into the libg15 layout
             size = self.get_size()
-            
-            # Paint to 565 image provided into an ARGB image surface for PIL's benefit. PIL doesn't support 565?
-            argb_surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, size[0], size[1])
-            argb_context = cairo.Context(argb_surface)
-            argb_context.set_source_surface(img)
-            argb_context.paint()
-            
-            # Now convert the ARGB to a PIL image so it can be converted to a 1 bit monochrome image, with all
-            # colours dithered. It would be nice if Cairo could do this :( Any suggestions? 
-            pil_img = Image.frombuffer("RGBA", size, argb_surface.get_data(), "raw", "RGBA", 0, 1)
-            pil_img = ImageMath.eval("convert(pil_img,'1')",pil_img=pil_img)
-            pil_img = ImageMath.eval("convert(pil_img,'P')",pil_img=pil_img)
-            pil_img = pil_img.point(lambda i: i >= 250,'1')
-            
             invert_control = self.get_control("invert_lcd")
-            if invert_control.value == 0:            
-                pil_img = pil_img.point(lambda i: 1^i)
-    
-            # Convert image buffer to string
-            buf = ""
-            for x in list(pil_img.getdata()): 
-                buf += chr(x)
-                
-            if len(buf) != self.device.lcd_size[0] * self.device.lcd_size[1]:
+            dither_control = self.get_control("dither_lcd")
+            buf = g15pixels.surface_to_lcd(img, size[0], size[1],
+                                           invert = invert_control.value != 0,
+                                           dither = g15pixels.DITHER_ORDERED if dither_control.value else g15pixels.DITHER_NONE,
+                                           buffer_size = len(self.empty_buf))
+            
+            if len(buf) != len(self.empty_buf):
                 logger.warning("Invalid buffer size")
-            else:
-                # TODO Replace with C routine
-                arrbuf = array.array('B', self.empty_buf)
-                width, height = self.get_size() 
-                max_byte_offset = 0
-                for x in range(0, width):
-                    for y in range(0, height):
-                        pixel_offset = y * width + x;
-                        byte_offset = pixel_offset / 8;
-                        max_byte_offset =  max(max_byte_offset, byte_offset)
-                        bit_offset = 7-(pixel_offset % 8);
-                        val = ord(buf[x+(y*160)])
-                        pv = arrbuf[byte_offset]
-                        if val > 0:
-                            arrbuf[byte_offset] = pv | 1 << bit_offset
-                        else:
-                            arrbuf[byte_offset] = pv &  ~(1 << bit_offset)
-                buf = arrbuf.tostring()
+            elif self.frame_diff.is_changed(buf):
                 try :
                     logger.debug("Writing buffer of %d bytes", len(buf))
                     pylibg15.write_pixmap(buf)
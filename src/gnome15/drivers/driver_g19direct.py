@@ -21,7 +21,6 @@ with the keyboard
 import gnome15.g15locale as g15locale
 _ = g15locale.get_translation("gnome15-drivers").ugettext
 
-from cStringIO import StringIO
 from threading import RLock
 import cairo
 import gnome15.g15driver as g15driver
@@ -29,6 +28,7 @@ import gnome15.g15globals as g15globals
 import gnome15.util.g15convert as g15convert
 import gnome15.util.g15uigconf as g15uigconf
 import gnome15.util.g15cairo as g15cairo
+import gnome15.util.g15pixels as g15pixels
 import gnome15.g15exceptions as g15exceptions
 import sys
 import os
@@ -224,22 +224,12 @@ class Driver(g15driver.AbstractDriver):
         back_context.set_operator (cairo.OPERATOR_SOURCE);
         back_context.paint()
         
-        if back_surface.get_format() == cairo.FORMAT_ARGB32:
-            file_str = StringIO()
-            data = back_surface.get_data()
-            for i in range(0, len(data), 4):
-                r = ord(data[i + 2])
-                g = ord(data[i + 1])
-                b = ord(data[i + 0])
-                file_str.write(self._rgb_to_uint16(r, g, b))                
-            buf = array.array('B', file_str.getvalue())   
-        else:   
-            buf = array.array('B', str(back_surface.get_data()))   
+        buf = array.array('B', g15pixels.surface_to_rgb565(back_surface))
                   
         expected_size = MAX_X * MAX_Y * ( self.get_bpp() / 8 )
         if len(buf) != expected_size:
             logger.warning("Invalid buffer size, expected %d, got %d", expected_size, len(buf))
-        else:
+        elif self.frame_diff.is_changed(buf):
             try:
                 self.lg19.send_frame(buf)
             except usb.USBError as e:
@@ -351,17 +341,3 @@ class Driver(g15driver.AbstractDriver):
         except usb.USBError as e:
             logger.debug('Error updating control.', exc_info = e)
             self._on_receive_error(e)
-            
-    def _rgb_to_uint16(self, r, g, b):
-        rBits = r * 32 / 255
-        gBits = g * 64 / 255
-        bBits = b * 32 / 255
-
-        rBits = rBits if rBits <= 31 else 31
-        gBits = gBits if gBits <= 63 else 63
-        bBits = bBits if bBits <= 31 else 31        
-
-        valueH = (rBits << 3) | (gBits >> 3)
-        valueL = (gBits << 5) | bBits
-
-        return chr(valueL & 0xff) + chr(valueH & 0xff)
@@ -28,6 +28,7 @@ import pyinputevent.scancodes as S
 import gnome15.g15driver as g15driver
 import gnome15.util.g15scheduler as g15scheduler
 import gnome15.util.g15uigconf as g15uigconf
+import gnome15.util.g15pixels as g15pixels
 import gnome15.g15globals as g15globals
 import gnome15.g15uinput as g15uinput
 import gconf
@@ -38,8 +39,6 @@ import cairo
 import re
 import usb
 import fb
-from PIL import Image
-from PIL import ImageMath
 import array
 import dbus
 import gobject
@@ -247,9 +246,10 @@ g15_backlight_control = g15driver.Control("keyboard_backlight", _("Keyboard Back
 g15_lcd_backlight_control = g15driver.Control("lcd_backlight", _("LCD Backlight"), 2, 0, 2, g15driver.HINT_SHADEABLE)
 g15_lcd_contrast_control = g15driver.Control("lcd_contrast", _("LCD Contrast"), 22, 0, 48, 0)
 g15_invert_control = g15driver.Control("invert_lcd", _("Invert LCD"), 0, 0, 1, hint=g15driver.HINT_SWITCH | g15driver.HINT_VIRTUAL)
-g15_controls = [ g15_mkeys_control, g15_backlight_control, g15_invert_control, g15_lcd_backlight_control, g15_lcd_contrast_control ]  
+g15_dither_control = g15driver.Control("dither_lcd", _("Dither LCD"), 1, 0, 1, hint=g15driver.HINT_SWITCH | g15driver.HINT_VIRTUAL)
+g15_controls = [ g15_mkeys_control, g15_backlight_control, g15_invert_control, g15_dither_control, g15_lcd_backlight_control, g15_lcd_contrast_control ]  
 g11_controls = [ g15_mkeys_control, g15_backlight_control ]
-g13_controls = [ g19_keyboard_backlight_control, g15_mkeys_control, g15_invert_control, g15_mkeys_control ]
+g13_controls = [ g19_keyboard_backlight_control, g15_mkeys_control, g15_invert_control, g15_dither_control, g15_mkeys_control ]
 
 """
 Keymaps that are sent to the kernel driver. These are the codes the driver
@@ -1037,68 +1037,23 @@ class Driver(g15driver.AbstractDriver):
             back_context.set_operator (cairo.OPERATOR_SOURCE);
             back_context.paint()
                 
-            if back_surface.get_format() == cairo.FORMAT_ARGB32:
-                """
-                If the creation of the type 4 image failed (i.e. earlier version of Cairo)
-                then we have to convert it ourselves. This is slow. 
-                
-                TODO Replace with C routine 
-                """
-                file_str = StringIO()
-                data = back_surface.get_data()
-                for i in range(0, len(data), 4):
-                    r = ord(data[i + 2])
-                    g = ord(data[i + 1])
-                    b = ord(data[i + 0])
-                    file_str.write(self.rgb_to_uint16(r, g, b))             
-                buf = file_str.getvalue()
-            else:   
-                buf = str(back_surface.get_data())
+            # If the creation of the type 4 image failed (i.e. earlier version of Cairo)
+            # then the surface is converted in batch by g15pixels
+            buf = g15pixels.surface_to_rgb565(back_surface)
         else:
+            # Threshold (or dither), invert and pack straight into the framebuffer layout
             width, height = self.get_size()
-            arrbuf = array.array('B', self.empty_buf)
-            
-            argb_surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
-            argb_context = cairo.Context(argb_surface)
-            argb_context.set_source_surface(img)
-            argb_context.paint()
-            
-            '''
-            Now convert the ARGB to a PIL image so it can be converted to a 1 bit monochrome image, with all
-            colours dithered. It would be nice if Cairo could do this :( Any suggestions?
-            ''' 
-            pil_img = Image.frombuffer("RGBA", (width, height), argb_surface.get_data(), "raw", "RGBA", 0, 1)
-            pil_img = ImageMath.eval("convert(pil_img,'1')",pil_img=pil_img)
-            pil_img = ImageMath.eval("convert(pil_img,'P')",pil_img=pil_img)
-            pil_img = pil_img.point(lambda i: i >= 250,'1')
-            
-            # Invert the screen if required
-            if g15_invert_control.value == 0:            
-                pil_img = pil_img.point(lambda i: 1^i)
-            
-            # Data is 160x43, 1 byte per pixel. Will have value of 0 or 1.
-            width, height = self.get_size()
-            data = list(pil_img.getdata())
-            fixed = self.fb.get_fixed_info()
-            v = 0
-            b = 1
-            
-            # TODO Replace with C routine
-            for row in range(0, height):
-                for col in range(0, width):
-                    if data[( row * width ) + col]:
-                        v += b
-                    b = b << 1
-                    if b == 256:
-                        # Full byte
-                        b = 1          
-                        i = row * fixed.line_length + col / 8
-                        arrbuf[i] = v   
-                        v = 0 
-            buf = arrbuf.tostring()
+            buf = g15pixels.surface_to_lcd(img, width, height,
+                                           invert = g15_invert_control.value != 0,
+                                           dither = g15pixels.DITHER_ORDERED if g15_dither_control.value else g15pixels.DITHER_NONE,
+                                           line_length = fixed.line_length,
+                                           lsb_first = True,
+                                           buffer_size = len(self.empty_buf))
                 
         if self.fb and self.fb.buffer:
-            self.fb.buffer[0:len(buf)] = buf
+            # The framebuffer is memory mapped, so only the rows that changed need be written
+            for offset, length in self.frame_diff.get_changed_rows(buf, fixed.line_length):
+                self.fb.buffer[offset:offset + length] = buf[offset:offset + length]
             
     def process_svg(self, document):  
         if self.get_bpp() == 1:
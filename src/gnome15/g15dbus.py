@@ -15,9 +15,14 @@
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
  
 import dbus.service
+import cairo
+import mmap
+import fcntl
+import os
 import g15globals
 import g15theme
 import util.g15scheduler as g15scheduler
+import util.jobqueue as jobqueue
 import util.g15gconf as g15gconf
 import util.g15cairo as g15cairo
 import util.g15icontools as g15icontools
@@ -40,6 +45,22 @@ CONTROL_ACQUISITION_IF_NAME="org.gnome15.Control"
 SCREEN_IF_NAME="org.gnome15.Screen"
 DEVICE_IF_NAME="org.gnome15.Device"
 
+# Page drawing methods that may be sent together in a single DrawBatch call
+BATCH_COMMANDS = [ "NewSurface", "Save", "Restore", "DrawSurface", "SetLineWidth", "Line",
+                   "Rectangle", "Circle", "Arc", "Foreground", "SetFont", "Text", "Image",
+                   "ImageData", "Redraw" ]
+
+# memfd seals (from linux/fcntl.h), not all versions of the fcntl module define them
+F_GET_SEALS = 1034
+F_SEAL_SHRINK = 0x0002
+
+# Pixel formats that may be used for frames shared with SetFrameBuffer
+FRAME_FORMATS = { "ARGB32" : cairo.FORMAT_ARGB32,
+                  "RGB24" : cairo.FORMAT_RGB24,
+                  "RGB16_565" : g15driver.CAIRO_IMAGE_FORMAT,
+                  "A8" : cairo.FORMAT_A8,
+                  "A1" : cairo.FORMAT_A1 }
+
 # Logging
 import logging
 logger = logging.getLogger(__name__)
@@ -271,6 +292,9 @@ class G15DBUSScreenService(AbstractG15DBUSService):
             self.PageDeleted(dbus_page._bus_name)
             dbus_page.remove_from_connection()
             del self._dbus_pages[page.id]
+            if dbus_page._frame_map is not None:
+                # Not on this thread, the draw lock may be held while pages are deleted
+                g15scheduler.execute("dbusFrameBuffer", "releaseFrameBuffer", dbus_page._set_frame_buffer, None, None)
         else:
             logger.warning("DBUS Page %s was deleted, but it never existed. Huh? %s",
                            page.id,
@@ -357,6 +381,15 @@ class G15DBUSScreenService(AbstractG15DBUSService):
         driver = self._screen.driver
         return ( driver.get_name(), driver.get_model_name(), driver.get_size()[0], driver.get_size()[1], driver.get_bpp() ) if driver != None else None 
     
+    @dbus.service.method(SCREEN_IF_NAME, in_signature='', out_signature='a{st}')
+    def GetFrameStatistics(self):
+        driver = self._screen.driver
+        return driver.get_frame_statistics() if driver != None else {}
+    
+    @dbus.service.method(SCREEN_IF_NAME, in_signature='', out_signature='a{sd}')
+    def GetRedrawStatistics(self):
+        return self._screen.get_redraw_statistics()
+    
     @dbus.service.method(SCREEN_IF_NAME, in_signature='', out_signature='s')
     def GetDeviceUID(self):
         return self._screen.device.uid
@@ -604,6 +637,8 @@ class G15DBUSPageService(AbstractG15DBUSService):
         self._sequence_number = sequence_number
         self._page = page
         self._timer = None        
+        self._frame_map = None
+        self._frame_surface = None
         self._page.key_handlers.append(self)
             
     @dbus.service.method(PAGE_IF_NAME, in_signature='b')
@@ -718,6 +753,53 @@ class G15DBUSPageService(AbstractG15DBUSService):
         file_str.close()
         self._page.image(img_surface, x, y)
     
+    @dbus.service.method(PAGE_IF_NAME, in_signature='a(sav)')
+    def DrawBatch(self, commands):
+        # Each command is the name of one of the drawing methods in BATCH_COMMANDS
+        # and its arguments. Nothing is drawn if any command is not allowed 
+        for name, args in commands:
+            if not name in BATCH_COMMANDS:
+                raise Exception("%s may not be used in a batch" % name)
+        for name, args in commands:
+            getattr(self, name)(*args)
+    
+    @dbus.service.method(PAGE_IF_NAME, in_signature='hiiis')
+    def SetFrameBuffer(self, fd, width, height, stride, pixel_format):
+        # The file descriptor refers to a memfd holding a frame in one of FRAME_FORMATS,
+        # sealed with at least F_SEAL_SHRINK. It is mapped and painted by the page as is,
+        # so the client may draw further frames into the same memory and call Redraw 
+        fd = fd.take()
+        try:
+            # The memory could otherwise be truncated after it is mapped, and painting
+            # beyond the end of it would crash the service
+            try:
+                seals = fcntl.fcntl(fd, F_GET_SEALS)
+            except EnvironmentError:
+                seals = 0
+            if not seals & F_SEAL_SHRINK:
+                raise Exception("Frame buffer must be a memfd sealed against shrinking")
+            if not pixel_format in FRAME_FORMATS:
+                raise Exception("Unsupported pixel format %s" % pixel_format)
+            if width <= 0 or height <= 0:
+                raise Exception("Invalid frame size %dx%d" % ( width, height ))
+            min_stride = cairo.ImageSurface.format_stride_for_width(FRAME_FORMATS[pixel_format], width)
+            if stride < min_stride:
+                raise Exception("Stride of %d is less than the %d needed for %d %s pixels" % ( stride, min_stride, width, pixel_format ))
+            
+            size = os.fstat(fd).st_size
+            if size < stride * height:
+                raise Exception("Frame buffer is %d bytes, %d are needed" % ( size, stride * height ))
+            try:
+                frame_map = mmap.mmap(fd, stride * height, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+            except EnvironmentError:
+                # Read-only memory, later changes may not be seen 
+                frame_map = mmap.mmap(fd, stride * height, mmap.MAP_PRIVATE, mmap.PROT_READ | mmap.PROT_WRITE)
+        finally:
+            os.close(fd)
+        surface = cairo.ImageSurface.create_for_data(frame_map, FRAME_FORMATS[pixel_format], width, height, stride)
+        self._set_frame_buffer(frame_map, surface)
+        self._screen_service._screen.redraw(self._page)
+    
     @dbus.service.method(PAGE_IF_NAME, in_signature='')
     def CancelTimer(self):
         self._timer.cancel()
@@ -770,6 +852,26 @@ class G15DBUSPageService(AbstractG15DBUSService):
             raise Exception("Not reserved")
         self._reserved_keys.remove(key_name)
         
+    """
+    Private
+    """
+    def _set_frame_buffer(self, frame_map, surface):
+        # Swap under the draw lock, so the old memory is not unmapped while it is being painted
+        screen = self._screen_service._screen
+        screen.draw_lock.acquire()
+        try:
+            old_map = self._frame_map
+            old_surface = self._frame_surface
+            self._frame_map = frame_map
+            self._frame_surface = surface
+            self._page.buffer = surface
+            if old_surface is not None:
+                old_surface.finish()
+            if old_map is not None:
+                old_map.close()
+        finally:
+            screen.draw_lock.release()
+        
     """
     Callbacks
     """
@@ -937,6 +1039,34 @@ class G15DBUSService(AbstractG15DBUSService):
     def GetServerInformation(self):
         return ( g15globals.name, "Gnome15 Project", g15globals.version, "2.1" )
     
+    # Returns the upper bounds (in seconds) of the histogram buckets, and for every queue and 
+    # job name the number of jobs run, failed and waiting, the total wait and run times and
+    # the wait and run time histograms
+    @dbus.service.method(IF_NAME, in_signature='', out_signature='ada(sstttddatat)')
+    def GetJobMetrics(self):
+        metrics = []
+        for entry in g15scheduler.scheduler.get_metrics():
+            metrics.append(( entry.queue_name, str(entry.job_name), entry.count, entry.failures, entry.backlog,
+                             entry.total_wait, entry.total_run, entry.wait_histogram, entry.run_histogram ))
+        return ( jobqueue.HISTOGRAM_BOUNDS, metrics )
+    
+    # Returns when each plugin was created and activated, for the global plugins and every
+    # screen. Each entry is the device UID (empty for global plugins), plugin ID, phase 
+    # (create or activate), start time in seconds since the service started, duration in 
+    # seconds, outcome (ok, failed or running) and whether startup stopped waiting for it
+    @dbus.service.method(IF_NAME, in_signature='', out_signature='a(sssddsb)')
+    def GetStartupTimeline(self):
+        managers = [ ( "", self._service.global_plugins ) ]
+        for screen in self._service.screens:
+            managers.append(( screen.device.uid, screen.plugins ))
+        timeline = []
+        for uid, manager in managers:
+            if manager is not None:
+                for entry in list(manager.timeline):
+                    timeline.append(( uid, entry.plugin_id, entry.phase, entry.started - self._service.start_time,
+                                      entry.get_duration(), entry.outcome, entry.background ))
+        return sorted(timeline, key = lambda e: e[3])
+    
     @dbus.service.method(IF_NAME, in_signature='', out_signature='')
     def Stop(self):
         g15scheduler.queue("serviceQueue", "dbusShutdown", 0, self._service.shutdown)
@@ -21,11 +21,16 @@ the GI bindings, which may no longer be mixed with static bindings (that
 Gnome15 uses).
 
 This class is stop gap until a better solution can be found
+
+All keys of a schema are read at once, and then served from memory until
+dconf reports a change to the schema.
 """
 
 import dbus
 import os
 import gobject
+import pipes
+from threading import Lock
 
 # Logging
 import logging
@@ -34,6 +39,34 @@ logger = logging.getLogger(__name__)
 PASSIVE_MATCH_STRING="type='method_call',interface='ca.desrt.dconf.Writer',member='Change'"
 EAVESDROP_MATCH_STRING="eavesdrop='true',%s" % PASSIVE_MATCH_STRING
 
+# Command used to read settings. This may be replaced by a stand-in that 
+# accepts the same 'list-recursively' and 'get' arguments 
+GSETTINGS_COMMAND="gsettings"
+
+# Read counts for all GSettings instances
+_statistics_lock = Lock()
+_statistics = { "reads" : 0, "hits" : 0, "loads" : 0 }
+
+def get_statistics():
+    """
+    Get the number of reads, how many were served from memory, and how many
+    times settings had to be loaded, along with the hit rate (0.0 - 1.0).
+    """
+    _statistics_lock.acquire()
+    try:
+        stats = dict(_statistics)
+    finally:
+        _statistics_lock.release()
+    stats["hit_rate"] = float(stats["hits"]) / stats["reads"] if stats["reads"] > 0 else 0.0
+    return stats
+
+def _count(name):
+    _statistics_lock.acquire()
+    try:
+        _statistics[name] += 1
+    finally:
+        _statistics_lock.release()
+
 class GSettingsCallback():
     
     def __init__(self, handle, key, callback):
@@ -50,6 +83,8 @@ class GSettings():
         self._session_bus = dbus.SessionBus(private=True)
         self._writer = dbus.Interface(self._session_bus.get_object("ca.desrt.dconf", "/ca/desrt/dconf/Writer/user"), "ca.desrt.dconf.Writer")
         self._monitors = {}
+        self._values = None
+        self._values_lock = Lock()
         
         self._match_string = EAVESDROP_MATCH_STRING
         try:
@@ -75,12 +110,66 @@ class GSettings():
             del self._monitors[handle]
         
     def get_string(self, key):
-        _, result = self._get_status_output("gsettings get %s %s" % (self.schema_id, key))         
-        if len(result) > 0:
-            result = result.replace("\n", "")
+        result = self.get_value(key)
+        if result is not None and len(result) > 0:
             if result.startswith("'"):
                 return result[1:-1]
             return result
+        
+    def get_boolean(self, key):
+        return self.get_value(key) == "true"
+        
+    def get_int(self, key):
+        result = self.get_value(key)
+        return int(result.split(" ")[-1]) if result else 0
+        
+    def get_double(self, key):
+        result = self.get_value(key)
+        return float(result.split(" ")[-1]) if result else 0.0
+        
+    def get_value(self, key):
+        """
+        Get the value of a key as printed by gsettings (i.e. in GVariant text
+        format), or None if there is no such key
+        
+        Keyword arguments:
+        key        -- key name
+        """
+        _count("reads")
+        self._values_lock.acquire()
+        try:
+            loaded = self._values is None
+            if loaded:
+                self._values = self._load()
+            key = key.replace("_", "-")
+            if key in self._values:
+                if not loaded:
+                    _count("hits")
+            else:
+                # Not listed (e.g. a relocatable schema), so ask for the key itself 
+                _count("loads")
+                _, result = self._get_status_output("%s get %s %s" % (GSETTINGS_COMMAND, pipes.quote(self.schema_id), pipes.quote(key)))
+                self._values[key] = result.replace("\n", "") if len(result) > 0 else None
+            return self._values[key]
+        finally:
+            self._values_lock.release()
+            
+    def _load(self):
+        _count("loads")
+        values = {}
+        _, result = self._get_status_output("%s list-recursively %s" % (GSETTINGS_COMMAND, pipes.quote(self.schema_id)))
+        for line in result.split("\n"):
+            split = line.split(" ", 2)
+            if len(split) == 3 and split[0] == self.schema_id:
+                values[split[1]] = split[2]
+        return values
+    
+    def _invalidate(self):
+        self._values_lock.acquire()
+        try:
+            self._values = None
+        finally:
+            self._values_lock.release()
             
     def _get_status_output(self, cmd):
         pipe = os.popen('{ ' + cmd + '; } 2>/dev/null', 'r')
@@ -106,11 +195,18 @@ class GSettings():
             s_id = s[:li][1:].replace("/", ".")
             k = s[li + 1:].replace("-", "_")
             if s_id == self.schema_id:
+                self._invalidate()
                 for m in self._monitors:
                     mon = self._monitors[m]
                     if mon.key == k:
                         # Bit rubbish, but we need to give dconf time to update
-                        gobject.timeout_add(1000, mon.callback)
+                        gobject.timeout_add(1000, self._notify, mon)
+                        
+    def _notify(self, mon):
+        # Anything read since the change was seen may be stale
+        self._invalidate()
+        mon.callback()
+        return False
             
     def _msg_cb(self, bus, msg):
         # Only interested in method calls
@@ -172,9 +172,16 @@ HINT_RED_BLUE_LED = 1 << 8
 # 16bit 565
 CAIRO_IMAGE_FORMAT=4
 
+"""
+Default maximum frame rates for monochrome and colour displays
+"""
+MONO_MAX_FPS = 20
+COLOR_MAX_FPS = 30
+
 FX_QUEUE = "ControlEffects"
 
 import util.g15scheduler as g15scheduler
+import array
 import time
 import colorsys
 from threading import Lock
@@ -488,6 +495,94 @@ class ControlAcquisition(AbstractControlAcquisition):
                 else:
                     g15scheduler.queue(FX_QUEUE, "Fade", interval, self._reduce, interval, target_val, release, step)
         
+class FrameDiff(object):
+    """
+    Remembers the last frame buffer (in the device's native format) that was 
+    sent to a device, so that identical frames may be skipped, and for devices
+    that allow it, only the rows that have changed need be sent. Also keeps
+    counts of frames and bytes sent and skipped.
+    """
+    
+    def __init__(self):
+        self.lock = Lock()
+        self.last_frame = None
+        self.frames_sent = 0
+        self.frames_skipped = 0
+        self.bytes_sent = 0
+        self.bytes_skipped = 0
+        
+    def reset(self):
+        """
+        Forget the last frame, so the next frame is always sent in full. This 
+        should be called whenever the contents of the device's LCD are unknown,
+        for example on connection.
+        """
+        self.lock.acquire()
+        try:
+            self.last_frame = None
+        finally:
+            self.lock.release()
+        
+    def is_changed(self, buf):
+        """
+        Get if a frame is different to the last one sent, recording it as the
+        last frame if it is. Use for devices that can only be sent whole frames.
+        
+        Keyword arguments:
+        buf        -- frame in device format
+        """
+        return len(self.get_changed_rows(buf, len(buf))) > 0
+    
+    def get_changed_rows(self, buf, line_length):
+        """
+        Compare a frame to the last one sent row by row, recording it as the 
+        last frame. A list of (offset, length) tuples is returned, one for each
+        block of consecutive rows that has changed. The list will be empty if
+        the frame is identical.
+        
+        Keyword arguments:
+        buf        -- frame in device format
+        line_length -- number of bytes in each row
+        """
+        buf = buf.tostring() if isinstance(buf, array.array) else str(buf)
+        self.lock.acquire()
+        try:
+            last_frame = self.last_frame
+            self.last_frame = buf
+            if last_frame == buf:
+                self.frames_skipped += 1
+                self.bytes_skipped += len(buf)
+                return []
+            
+            if last_frame is None or len(last_frame) != len(buf) or line_length < 1:
+                changed = [ ( 0, len(buf) ) ]
+            else:
+                changed = []
+                for offset in range(0, len(buf), line_length):
+                    if buf[offset:offset + line_length] != last_frame[offset:offset + line_length]:
+                        length = min(line_length, len(buf) - offset)
+                        if len(changed) > 0 and changed[-1][0] + changed[-1][1] == offset:
+                            changed[-1] = ( changed[-1][0], changed[-1][1] + length )
+                        else:
+                            changed.append(( offset, length ))
+                        
+            sent = sum([ length for offset, length in changed ])
+            self.frames_sent += 1
+            self.bytes_sent += sent
+            self.bytes_skipped += len(buf) - sent
+            return changed
+        finally:
+            self.lock.release()
+        
+    def get_statistics(self):
+        """
+        Get a dictionary of the frame and byte counts
+        """
+        return { "frames_sent" : self.frames_sent,
+                 "frames_skipped" : self.frames_skipped,
+                 "bytes_sent" : self.bytes_sent,
+                 "bytes_skipped" : self.bytes_skipped }
+        
 class AbstractDriver(object):
     
     def __init__(self, id):
@@ -500,6 +595,7 @@ class AbstractDriver(object):
         self.connecting = False
         self.all_off_on_disconnect = True
         self.allow_multiple = True
+        self.frame_diff = FrameDiff()
         self._reset_state()
         
     def has_memory_bank(self):
@@ -603,6 +699,7 @@ class AbstractDriver(object):
             raise Exception("Already connected")
         logger.info("Connecting driver %s", self.get_name())
         self.connecting = True
+        self.frame_diff.reset()
         try:
             self._on_connect()
         finally:
@@ -667,6 +764,14 @@ class AbstractDriver(object):
         raise NotImplementedError( "Not implemented")
     
     
+    def get_max_fps(self):
+        """
+        Get the maximum number of frames per second that should be painted. Drivers
+        may override this if the device is able to accept frames faster or slower than
+        the default for its type of display.
+        """
+        return MONO_MAX_FPS if self.get_bpp() == 1 else COLOR_MAX_FPS
+    
     def get_controls(self):
         """
         Get the all of the controls available. This would include things such as LCD contrast, LCD brightness,
@@ -735,6 +840,13 @@ class AbstractDriver(object):
     
     def get_mkey_lights(self):
         return self.lights 
+    
+    def get_frame_statistics(self):
+        """
+        Get a dictionary of the number of frames (and bytes) sent to and skipped
+        for the device because they had not changed. 
+        """
+        return self.frame_diff.get_statistics()
         
     def get_control(self, control_id):
         controls = self.get_controls()
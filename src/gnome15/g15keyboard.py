@@ -32,6 +32,8 @@ import g15driver
 import g15actions
 import g15uinput
 import g15screen
+import time
+import random
 
 import logging
 logger = logging.getLogger(__name__)
@@ -62,6 +64,76 @@ class KeyState():
     def __repr__(self):
         return "%s = %s [consumed = %s]" % (self.key, g15profile.to_key_state_name(self.state_id), str(self.consumed) )      
     
+class KeyIndex():
+    """
+    Index of the macros or action bindings that may be activated by a key
+    combination. Every key is given a bit, so the keys of each entry become
+    a mask. Finding the entries that could be activated by the keys that
+    currently have a state only looks at entries using those keys, so the
+    cost depends on the keys pressed rather than the number of entries.
+    """
+    
+    def __init__(self, bits = None):
+        """
+        Constructor
+        
+        Keyword arguments:
+        bits        -- dictionary of key to bit, may be shared between indexes
+        """
+        self.bits = bits if bits is not None else {}
+        self.by_key = {}
+        self.size = 0
+        
+    def add(self, item, keys):
+        """
+        Add an item to the index. Items are returned by find() in the order
+        they were added.
+        
+        Keyword arguments:
+        item        -- macro or binding
+        keys        -- list of keys that activate the item
+        """
+        entry = ( self.size, self.get_mask(keys, True), item )
+        self.size += 1
+        for k in set(keys):
+            self.by_key.setdefault(k, []).append(entry)
+            
+    def get_mask(self, keys, allocate = False):
+        """
+        Get the mask for a list of keys. Keys that have no bit are ignored,
+        unless allocate is True, in which case they are given one.
+        
+        Keyword arguments:
+        keys        -- list of keys
+        allocate    -- give new keys a bit
+        """
+        mask = 0
+        for k in keys:
+            bit = self.bits.get(k)
+            if bit is None:
+                if not allocate:
+                    continue
+                bit = 1 << len(self.bits)
+                self.bits[k] = bit
+            mask |= bit
+        return mask
+    
+    def find(self, keys):
+        """
+        Get the items, in the order they were added, all of whose keys are in
+        the provided list (or dictionary) of keys.
+        
+        Keyword arguments:
+        keys        -- keys that currently have a state
+        """
+        present = self.get_mask(keys)
+        found = {}
+        for k in keys:
+            for entry in self.by_key.get(k, ()):
+                if entry[1] & present == entry[1]:
+                    found[entry[0]] = entry[2]
+        return [ found[i] for i in sorted(found) ]
+    
 class G15KeyHandler():
     """
     Main class for handling key events. There should be one instance of this
@@ -91,6 +163,12 @@ class G15KeyHandler():
         self.__uinput_macros = []
         self.__normal_macros = []
         self.__normal_held_macros = []
+        self.__key_bits = {}
+        self.__uinput_index = KeyIndex(self.__key_bits)
+        self.__normal_index = KeyIndex(self.__key_bits)
+        self.__normal_held_index = KeyIndex(self.__key_bits)
+        self.__action_index = KeyIndex(self.__key_bits)
+        self.__action_keys = None
         self.__notify_handles = []
         self.__key_states = {}
         
@@ -160,6 +238,15 @@ class G15KeyHandler():
         self.__normal_macros = []
         self.__uinput_macros = []
         self._build_macros()
+        self.__uinput_index = self._build_index(self.__uinput_macros)
+        self.__normal_index = self._build_index(self.__normal_macros)
+        self.__normal_held_index = self._build_index(self.__normal_held_macros)
+        
+    def _build_index(self, macros):
+        index = KeyIndex(self.__key_bits)
+        for m in macros:
+            index.add(m, m.keys)
+        return index
         
     def _do_key_received(self, keys, state_id):
         """
@@ -226,9 +313,10 @@ class G15KeyHandler():
                 self.__key_states = {}
         finally:
             """
-            Always redraw the current page on key presses
+            Always redraw the current page on key presses, without waiting for the
+            next frame so the feedback is immediate
             """
-            self.__screen.redraw()
+            self.__screen.redraw(priority = g15screen.REDRAW_HIGH)
             
     def _handle_actions(self):
         """
@@ -238,8 +326,13 @@ class G15KeyHandler():
         """
         action_keys = self.__screen.driver.get_action_keys()
         if action_keys:
-            for action in action_keys:
-                binding = action_keys[action]
+            if action_keys is not self.__action_keys or self.__action_index.size != len(action_keys):
+                index = KeyIndex(self.__key_bits)
+                for action in action_keys:
+                    index.add(action_keys[action], action_keys[action].keys)
+                self.__action_index = index
+                self.__action_keys = action_keys
+            for binding in self.__action_index.find(self.__key_states):
                 f = 0
                 for k in binding.keys:
                     if k in self.__key_states and \
@@ -256,7 +349,7 @@ class G15KeyHandler():
         First check for any KEY_STATE_HELD macros. We do these first so KEY_STATE_UP
         macros don't consume the key states
         """        
-        for m in self.__normal_held_macros:
+        for m in self.__normal_held_index.find(self.__key_states):
             held = []
             for k in m.keys:
                 if k in self.__key_states:
@@ -272,7 +365,7 @@ class G15KeyHandler():
         Search for all the non-uinput macros that would be activated by the
         current key state. In this case, KEY_STATE_UP macros are looked for
         """
-        for m in self.__normal_macros:
+        for m in self.__normal_index.find(self.__key_states):
             up = []
             held = []
             down = []
@@ -300,7 +393,7 @@ class G15KeyHandler():
         current key state, and emit events of the same type.
         """
         uinput_repeat = False
-        for m in self.__uinput_macros:
+        for m in self.__uinput_index.find(self.__key_states):
             down = []
             up = []
             held = []
@@ -658,4 +751,62 @@ class G15KeyHandler():
         
         for l in self.action_listeners:  
             if l.action_performed(binding):
-                return True
\ No newline at end of file
+                return True
+
+def benchmark(macros = 1000, events = 10000, keys = 18, max_combination = 3):
+    """
+    Measure the time taken to find the macros that may be activated by each
+    event of a synthetic key stream, both by scanning every macro and by using
+    a KeyIndex. Returns a tuple of the mean time per event (in seconds) for
+    the scan and for the index.
+    
+    Keyword arguments:
+    macros            -- number of macros in the synthetic profile
+    events            -- number of key events to replay
+    keys              -- number of different keys
+    max_combination   -- maximum number of keys in a macro's combination
+    """
+    class Macro():
+        def __init__(self, keys):
+            self.keys = keys
+            
+    r = random.Random(0)
+    key_names = [ "g%d" % (i + 1) for i in range(0, keys) ]
+    macro_list = [ Macro(r.sample(key_names, r.randint(1, max_combination))) for i in range(0, macros) ]
+    index = KeyIndex()
+    for m in macro_list:
+        index.add(m, m.keys)
+        
+    # Replay presses and releases, keeping up to max_combination keys down
+    stream = []
+    down = []
+    for i in range(0, events):
+        if len(down) < max_combination and ( len(down) == 0 or r.random() < 0.5 ):
+            down.append(r.choice([ k for k in key_names if not k in down ]))
+        else:
+            down.remove(r.choice(down))
+        stream.append(dict([ ( k, True ) for k in down ]))
+        
+    started = time.time()
+    for key_states in stream:
+        for m in macro_list:
+            f = 0
+            for k in m.keys:
+                if k in key_states:
+                    f += 1
+            if f == len(m.keys):
+                pass
+    scanned = ( time.time() - started ) / events
+    
+    started = time.time()
+    for key_states in stream:
+        for m in index.find(key_states):
+            f = 0
+            for k in m.keys:
+                if k in key_states:
+                    f += 1
+            if f == len(m.keys):
+                pass
+    indexed = ( time.time() - started ) / events
+    
+    return scanned, indexed
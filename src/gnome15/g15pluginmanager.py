@@ -41,9 +41,11 @@ Plugins are looked for in a number of locations.
                         
 The lifecycle of all plugins consists of 5 stages. 
 
-1. Loading - When the python module is loaded. This happens to all plugins,
-regardless of whether they are enabled or not. Any plugins that fail this
-stage will not be visible.
+1. Loading - When the python module is loaded. The metadata of all plugins
+(ID, name, supported models, actions and so on) is read from the plugin index
+without importing them, see PluginModule. The python module itself is only
+imported when it is first needed, usually when the plugin is enabled for a
+device. Any plugins whose metadata cannot be read will not be visible.
 
 2. Initialise - This is when the plugin instance is created. All enabled
 plugins will go through this stage *once*. If a plugin is de-activated, and
@@ -64,9 +66,15 @@ or if Gnome15 itself is closing down.
  
 import os.path
 import sys
+import ast
+import time
+import cPickle
 import g15globals
 import g15driver
 import g15actions
+import g15locale
+import util.g15os as g15os
+import util.g15scheduler as g15scheduler
 import gconf
 import threading
 
@@ -90,6 +98,11 @@ ACTIVATED = 4
 DEACTIVATING = 5
 DEACTIVATED = 6
 DESTROYING = 7
+
+"""
+Maximum number of entries kept in each plugin manager's startup timeline
+"""
+MAX_TIMELINE = 500
             
 def list_plugin_dirs(path):
     """
@@ -162,6 +175,26 @@ def is_needs_network(plugin_module):
     """
     return getattr(plugin_module, 'needs_network', False)
 
+def get_unresolvable(requires):
+    """
+    Get the set of plugins that can never be activated because what they 
+    require forms a cycle, either because they are part of the cycle or
+    because they require a plugin that is.
+    
+    Keyword arguments:
+    requires -- dictionary of the plugin each plugin requires
+    """
+    unresolvable = set()
+    for plugin in requires:
+        chain = []
+        current = plugin
+        while current in requires and not current in chain and not current in unresolvable:
+            chain.append(current)
+            current = requires[current]
+        if current in chain or current in unresolvable:
+            unresolvable.update(chain)
+    return unresolvable
+
 def is_default_enabled(plugin_module):
     """
     Get if the provided plugin_module instance should be enabled by default.
@@ -216,13 +249,370 @@ def get_actions(plugin_module, device):
 
 
 """
-Loads the python modules for all plugins for all known locations. This is done
-in two phases.
+Reading plugin metadata without importing the plugin.
+
+Every plugin module declares a handful of module level attributes (id, name,
+supported_models, actions and so on) that are needed long before the plugin
+itself is used, for example to build the list of plugins in the configuration
+tool, or to decide which plugins to start for a device. Importing the module
+to get at these also pulls in whatever the plugin depends on (webkit,
+gstreamer, evolution and the like), so instead the attributes are read from
+the module's source and the results kept in an index, which is cached in the
+user's cache directory and only re-read for a plugin when its file changes.
+"""
+
+"""
+Increase this whenever the format of the index, or the rules for reading
+metadata, change. Any existing cached index is then ignored.
+"""
+INDEX_VERSION = 2
+
+"""
+Location of the cached plugin index
+"""
+index_file = os.path.join(g15globals.user_cache_dir, "plugins.index")
+
+"""
+Module level attributes that are read from the plugin source. actions_<model>
+attributes are also read.
+"""
+METADATA_ATTRIBUTES = [ "id", "name", "description", "author", "copyright", "site",
+                       "has_preferences", "supported_models", "unsupported_models",
+                       "global_plugin", "passive", "needs_network", "default_enabled",
+                       "single_instance", "requires", "actions" ]
+
+"""
+Seconds taken to import each plugin module, keyed by plugin ID
+"""
+import_times = {}
+
+class NotStaticError(Exception):
+    """
+    Raised when a plugin's metadata cannot be read without running the module.
+    """
+    pass
+
+class Message(object):
+    """
+    A string passed to the plugin's translation function. It is translated
+    using the plugin's own translation domain when the index is loaded.
+    """
+    def __init__(self, msgid):
+        self.msgid = msgid
+
+class Reference(object):
+    """
+    A metadata attribute that is copied from another plugin module, for
+    example unsupported_models=weather.unsupported_models 
+    """
+    def __init__(self, module_name, attribute):
+        self.module_name = module_name
+        self.attribute = attribute
+
+def is_metadata_attribute(name):
+    return name in METADATA_ATTRIBUTES or name.startswith("actions_")
+
+def read_metadata(path):
+    """
+    Read the metadata of a plugin module from its source, without importing
+    it. A dictionary is returned, containing the module name, translation
+    domain and the metadata attributes. NotStaticError is raised if any of
+    the metadata cannot be worked out without running the module.
+    
+    Keyword arguments:
+    path -- path of the plugin's main module
+    """
+    f = open(path, "r")
+    try:
+        tree = ast.parse(f.read(), path)
+    finally:
+        f.close()
+        
+    names = {}
+    modules = {}
+    attributes = {}
+    domain = None
+    for node in tree.body:
+        if isinstance(node, ast.Import) or isinstance(node, ast.ImportFrom):
+            for alias in node.names:
+                full_name = alias.name if isinstance(node, ast.Import) else "%s.%s" % ( node.module, alias.name )
+                if alias.asname:
+                    modules[alias.asname] = full_name
+                elif isinstance(node, ast.ImportFrom):
+                    modules[alias.name] = full_name
+                else:
+                    modules[alias.name.split(".")[0]] = alias.name.split(".")[0]
+        elif isinstance(node, ast.Assign):
+            for target in node.targets:
+                if not isinstance(target, ast.Name):
+                    continue
+                if target.id == "_":
+                    domain = _get_translation_domain(node.value)
+                try:
+                    names[target.id] = _evaluate(node.value, names, modules, True)
+                except NotStaticError as nse:
+                    if is_metadata_attribute(target.id):
+                        raise NotStaticError("%s in %s. %s" % ( target.id, path, nse ))
+                    names.pop(target.id, None)
+                    continue
+                if is_metadata_attribute(target.id):
+                    attributes[target.id] = names[target.id]
+        elif isinstance(node, ast.Expr) and isinstance(node.value, ast.Str):
+            # Docstring
+            continue
+        elif not isinstance(node, ast.FunctionDef) and not isinstance(node, ast.ClassDef):
+            # Anything else (such as registering profiles or conditional metadata) 
+            # only happens when the module is run, so the plugin must be imported
+            raise NotStaticError("Line %d of %s has effects when imported" % ( node.lineno, path ))
+                
+    if not "id" in attributes:
+        raise NotStaticError("No plugin ID in %s" % path)
+    return { "module" : os.path.basename(path)[:-3],
+             "domain" : domain,
+             "attributes" : attributes }
+
+def _get_translation_domain(node):
+    # _ = g15locale.get_translation("domain", modfile = __file__).ugettext
+    if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Call):
+        call = node.value
+        if isinstance(call.func, ast.Attribute) and call.func.attr == "get_translation" and \
+                len(call.args) > 0 and isinstance(call.args[0], ast.Str):
+            return call.args[0].s
+
+def _evaluate(node, names, modules, top = False):
+    if isinstance(node, ast.Str):
+        return node.s
+    elif isinstance(node, ast.Num):
+        return node.n
+    elif isinstance(node, ast.Name):
+        if node.id in [ "True", "False", "None" ]:
+            return { "True" : True, "False" : False, "None" : None }[node.id]
+        elif node.id in names and not isinstance(names[node.id], Reference):
+            return names[node.id]
+    elif isinstance(node, ast.List) or isinstance(node, ast.Tuple):
+        l = [ _evaluate(n, names, modules) for n in node.elts ]
+        return l if isinstance(node, ast.List) else tuple(l)
+    elif isinstance(node, ast.Dict):
+        return dict(zip([ _evaluate(n, names, modules) for n in node.keys ],
+                        [ _evaluate(n, names, modules) for n in node.values ]))
+    elif isinstance(node, ast.BinOp) and isinstance(node.op, ast.Add):
+        left = _evaluate(node.left, names, modules)
+        right = _evaluate(node.right, names, modules)
+        if ( isinstance(left, basestring) and isinstance(right, basestring) ) or \
+                ( isinstance(left, list) and isinstance(right, list) ):
+            return left + right
+    elif isinstance(node, ast.Call):
+        if isinstance(node.func, ast.Name) and node.func.id == "_" and len(node.args) == 1 and \
+                len(node.keywords) == 0 and node.starargs is None and node.kwargs is None:
+            msgid = _evaluate(node.args[0], names, modules)
+            if isinstance(msgid, basestring):
+                return Message(msgid)
+    elif isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) and \
+            node.value.id in modules:
+        module_name = modules[node.value.id]
+        if module_name in sys.modules and hasattr(sys.modules[module_name], node.attr):
+            # Constants from already loaded modules, i.e. g15driver
+            val = getattr(sys.modules[module_name], node.attr)
+            if isinstance(val, basestring) or isinstance(val, bool) or \
+                    isinstance(val, int) or isinstance(val, float):
+                return val
+            elif isinstance(val, list) or isinstance(val, tuple):
+                return list(val) if isinstance(val, list) else val
+        elif top and not "." in module_name:
+            return Reference(module_name, node.attr)
+    raise NotStaticError("Cannot read %s on line %d without running the module" % ( type(node).__name__, node.lineno ))
+
+def _translate(val, translate):
+    if isinstance(val, Message):
+        return translate(val.msgid)
+    elif isinstance(val, list):
+        return [ _translate(v, translate) for v in val ]
+    elif isinstance(val, tuple):
+        return tuple([ _translate(v, translate) for v in val ])
+    elif isinstance(val, dict):
+        return dict([ ( _translate(k, translate), _translate(v, translate) ) for k, v in val.items() ])
+    return val
+
+class PluginModule(object):
+    """
+    Stands in for a plugin's python module. The metadata attributes are
+    available straight away from the plugin index. Getting any other attribute
+    (e.g. the create() function) imports the real module first.
+    """
+    def __init__(self, path, module_name, attributes):
+        self.__dict__.update(attributes)
+        self.__name__ = module_name
+        self.__file__ = path
+        self._module = None
+        
+    def is_imported(self):
+        """
+        Get if the real plugin module has been imported yet
+        """
+        return self._module is not None
+        
+    def get_module(self):
+        """
+        Get the real plugin module, importing it if it has not been
+        imported yet.
+        """
+        if self._module is None:
+            import_lock.acquire()
+            try:
+                if self._module is None:
+                    self._module = _import_plugin(self.__name__, self.id)
+            finally:
+                import_lock.release()
+        return self._module
+        
+    def __getattr__(self, name):
+        if is_metadata_attribute(name) or name.startswith("__"):
+            raise AttributeError(name)
+        return getattr(self.get_module(), name)
+    
+    def __repr__(self):
+        return "<plugin module '%s' from '%s'%s>" % ( self.__name__, self.__file__,
+                                                      "" if self.is_imported() else " (not imported)")
+
+import_lock = threading.RLock()
+
+def _import_plugin(module_name, plugin_id = None):
+    started = time.time()
+    mod = __import__(module_name)
+    taken = time.time() - started
+    import_times[plugin_id if plugin_id is not None else mod.id] = taken
+    logger.info("Imported plugin module %s in %.3f seconds", module_name, taken)
+    return mod
+
+def load_index():
+    """
+    Load the cached plugin index. An empty index is returned if there is
+    none, or it was written by a different version.
+    """
+    if os.path.exists(index_file):
+        try:
+            f = open(index_file, "rb")
+            try:
+                index = cPickle.load(f)
+            finally:
+                f.close()
+            if index.get("version") == ( INDEX_VERSION, g15globals.version ):
+                return index["plugins"]
+        except Exception as e:
+            logger.warning("Failed to load plugin index %s, it will be rebuilt.", index_file, exc_info = e)
+    return {}
+
+def save_index(plugins):
+    """
+    Write the plugin index to the cache directory.
+    
+    Keyword arguments:
+    plugins -- dictionary of index entries, keyed by plugin module path
+    """
+    try:
+        g15os.mkdir_p(g15globals.user_cache_dir)
+        tmp_file = "%s.%d" % ( index_file, os.getpid() )
+        f = open(tmp_file, "wb")
+        try:
+            cPickle.dump({ "version" : ( INDEX_VERSION, g15globals.version ), "plugins" : plugins }, f, 2)
+        finally:
+            f.close()
+        os.rename(tmp_file, index_file)
+    except Exception as e:
+        logger.warning("Failed to save plugin index %s.", index_file, exc_info = e)
+
+def get_index_entry(index, path):
+    """
+    Get the index entry for a plugin module, reading the module source
+    again if it has changed since the entry was created. None is returned
+    if the entry was already up to date. If the metadata cannot be read
+    statically, the entry will have no attributes and the module will be
+    imported during discovery instead.
+    
+    Keyword arguments:
+    index -- current index
+    path -- path of plugin module
+    """
+    stat = os.stat(path)
+    entry = index.get(path)
+    if entry is not None and entry["mtime"] == stat.st_mtime and entry["size"] == stat.st_size:
+        return None
+    try:
+        entry = read_metadata(path)
+    except Exception as e:
+        logger.info("Plugin metadata for %s will be read by importing it. %s", path, e)
+        entry = { "module" : os.path.basename(path)[:-3], "domain" : None, "attributes" : None }
+    entry["mtime"] = stat.st_mtime
+    entry["size"] = stat.st_size
+    return entry
+
+def _create_plugin_module(path, entry, entries):
+    attributes = dict(entry["attributes"])
+    for name, val in attributes.items():
+        if isinstance(val, Reference):
+            other = [ e for e in entries.values() if e["module"] == val.module_name and \
+                     e["attributes"] is not None and val.attribute in e["attributes"] ]
+            if len(other) == 0:
+                return None
+            attributes[name] = other[0]["attributes"][val.attribute]
+    if entry["domain"] is not None:
+        translate = g15locale.get_translation(entry["domain"], modfile = path).ugettext
+    else:
+        translate = lambda s: s
+    return PluginModule(path, entry["module"], _translate(attributes, translate))
+
+def discover_plugins(plugin_dirs):
+    """
+    Find all plugin modules in the provided plugin directories, returning
+    a list of PluginModule instances (or actual modules, for plugins whose
+    metadata could not be read without importing them). The plugin index 
+    is used and updated as required.
+    
+    Keyword arguments:
+    plugin_dirs -- list of plugin directories
+    """
+    index = load_index()
+    entries = {}
+    changed = False
+    for plugindir in plugin_dirs:
+        path = os.path.join(plugindir, "%s.py" % os.path.basename(plugindir))
+        if os.path.isfile(path):
+            try:
+                entry = get_index_entry(index, path)
+                if entry is None:
+                    entry = index[path]
+                else:
+                    changed = True
+                entries[path] = entry
+            except Exception as e:
+                logger.error("Failed to index plugin module %s.", plugindir, exc_info = e)
+    if changed or len(entries) != len(index):
+        save_index(entries)
+    
+    plugins = []
+    for plugindir in plugin_dirs:
+        path = os.path.join(plugindir, "%s.py" % os.path.basename(plugindir))
+        if path in entries:
+            entry = entries[path]
+            try :
+                mod = None
+                if entry["attributes"] is not None:
+                    mod = _create_plugin_module(path, entry, entries)
+                if mod is None:
+                    mod = _import_plugin(entry["module"])
+                plugins.append(mod)
+            except Exception as e:
+                logger.error("Failed to load plugin module %s.", plugindir, exc_info = e)
+    return plugins
+
+"""
+Finds plugins in all known locations. This is done in two phases.
 
 Firstly, the paths of all plugins are added to the python search path.
 
 Secondly, all of these directories are scanned for python files with the same
-name as the directory they are in. Each one of these is the main plugin module.
+name as the directory they are in. Each one of these is the main plugin module,
+and its metadata is read using the plugin index. 
 
 TODO - These should really be using __init__.py
 """
@@ -238,22 +628,44 @@ for plugindir in all_plugin_directories:
         sys.path.insert(0, plugindir)
        
 # Phase 2
-for plugindir in all_plugin_directories: 
-    plugin_name = os.path.basename(plugindir)
-    pluginfiles = [fname[:-3] for fname in os.listdir(plugindir) if fname == plugin_name + ".py"]
-    if not plugindir in sys.path:
-        sys.path.insert(0, plugindir)
-    try :
-        for mod in ([__import__(fname) for fname in pluginfiles]):
-            imported_plugins.append(mod)
-            # TODO - we need to be registering actions for a particular device
-            actions = get_actions(mod, None)
-            for a in actions:
-                if not a in g15actions.actions:
-                    g15actions.actions.append(a)
-    except Exception as e:
-        logger.error("Failed to load plugin module %s.", plugindir, exc_info = e)
+discovery_started = time.time()
+imported_plugins += discover_plugins(all_plugin_directories)
+for mod in imported_plugins:
+    # TODO - we need to be registering actions for a particular device
+    actions = get_actions(mod, None)
+    for a in actions:
+        if not a in g15actions.actions:
+            g15actions.actions.append(a)
+logger.info("Found %d plugins in %.3f seconds", len(imported_plugins), time.time() - discovery_started)
 
+class TimelineEntry():
+    """
+    Records when a plugin instance was created or activated, how long it took
+    and how it went. The entries for every plugin make up the startup timeline.
+    """
+    def __init__(self, plugin_id, phase):
+        self.plugin_id = plugin_id
+        self.phase = phase
+        self.started = time.time()
+        self.finished = None
+        self.outcome = "running"
+        self.background = False
+        
+    def complete(self, outcome):
+        """
+        Mark the phase as complete
+        
+        Keyword arguments:
+        outcome -- "ok" or "failed"
+        """
+        self.finished = time.time()
+        self.outcome = outcome
+        
+    def get_duration(self):
+        """
+        Get how long the phase took (or has taken so far if it is still running)
+        """
+        return ( self.finished if self.finished is not None else time.time() ) - self.started
 
 class G15Plugins():
     """
@@ -283,6 +695,12 @@ class G15Plugins():
         self.module_map = {}
         self.plugin_map = {}
         self.state = UNINITIALISED
+        self.timeline = []
+        self.activating = {}
+        self.waiting = {}
+        self.stragglers = set()
+        self.cancelled = set()
+        self.activation_condition = threading.Condition(threading.RLock())
         
     def is_activated(self):
         """
@@ -359,12 +777,14 @@ class G15Plugins():
                         # Only actually activate if the plugin is not passive and the network
                         # is in the right state
                         
+                        # Plugins that do not support the model are not created at all, so
+                        # their modules need not be imported
                         if self.conf_client.get_bool(key) and \
-                          not is_passive_plugin(mod):
+                          not is_passive_plugin(mod) and \
+                          ( self.screen is None or self.screen.driver.get_model_name() in get_supported_models(mod) ):
                             try :
                                 instance = self._create_instance(mod, plugin_dir_key)
-                                if self.screen is None or self.screen.driver.get_model_name() in get_supported_models(mod):
-                                    self.started.append(instance)
+                                self.started.append(instance)
                             except Exception as e:
                                 self.conf_client.set_bool(key, False)
                                 logger.error("Failed to load plugin %s.", mod.id, exc_info = e)
@@ -375,7 +795,8 @@ class G15Plugins():
             raise a 
         finally:
             self.lock.release()
-        logger.info("Started plugin manager")
+        logger.info("Started plugin manager. %d of %d plugin modules imported in %.3f seconds",
+                    len(import_times), len(imported_plugins), sum(import_times.values()))
     
     def handle_key(self, key, state, post=False):
         """
@@ -402,6 +823,12 @@ class G15Plugins():
         """
         Activate all plugins that currently started.
         
+        When activating a list of plugins (or all of them), the plugins are
+        activated concurrently, see _activate_concurrently(). This returns 
+        once they are all activated, or those that are left have taken 
+        longer than the activation timeout, in which case they will finish
+        in the background.
+        
         Keyword arguments:
         callback      --     callback function to invoke when each invididual plugin
                             is activated. This is used for the progress bar during initial startup. 
@@ -416,31 +843,50 @@ class G15Plugins():
             logger.info("Activating plugins")
             self.lock.acquire()
             try :
-                self.state = ACTIVATING
-                self.activated = []
-                idx = 0
+                self.activation_condition.acquire()
+                try:
+                    self.state = ACTIVATING
+                    self.activated = []
+                finally:
+                    self.activation_condition.release()
+                to_activate = []
                 for plugin in plugin if isinstance(plugin, list) else self.started:
                     mod = self.plugin_map[plugin]
                     
                     # Only actually activate if the plugin is not passive and the network
-                    # is in the right state
+                    # is in the right state. Plugins still being activated from a previous
+                    # attempt are left to finish
                         
                     needs_net = is_needs_network(mod)
-                    if not needs_net or ( needs_net and \
-                            self.network_manager.is_network_available() ):
-                        self._activate_instance(plugin, callback, idx)
-                        
-                    idx += 1           
-                self.state = ACTIVATED
-            except Exception as e:           
-                self.state = STARTED
-                logger.debug("Error while activating plugin", exc_info = e)
-                raise e     
+                    if ( not needs_net or ( needs_net and \
+                            self.network_manager.is_network_available() ) ) and \
+                            not plugin in self.activating and not plugin in self.waiting:
+                        to_activate.append(plugin)
             finally:
                 self.lock.release()
+                
+            # Wait without the lock, so plugins can still be enabled and disabled 
+            try :
+                self._activate_concurrently(to_activate, callback)
+            except Exception as e:
+                self._set_state_if(ACTIVATING, STARTED)
+                logger.debug("Error while activating plugin", exc_info = e)
+                raise e
+            
+            # Unless de-activated while waiting
+            self._set_state_if(ACTIVATING, ACTIVATED)
             logger.debug("Activated plugins")
         else:
-            self._activate_instance(plugin, callback, 0)
+            self.activation_condition.acquire()
+            try:
+                # A plugin still being activated (perhaps in the background) is left to finish
+                if plugin in self.activating or plugin in self.waiting or plugin in self.activated:
+                    logger.info("%s is already activated or being activated", self.plugin_map[plugin].id)
+                    return
+                self.activating[plugin] = time.time() + self.service.plugin_activation_timeout
+            finally:
+                self.activation_condition.release()
+            self._do_activation(plugin, callback, 0, concurrent = False)
             
     
     def deactivate(self, plugin=None):
@@ -458,11 +904,18 @@ class G15Plugins():
             logger.info("De-activating plugins")
             self.lock.acquire()
             try :
-                self.state = DEACTIVATING
-                for plugin in plugin if isinstance(plugin, list) else list(self.activated):
+                # Any activations still running in the background see the state 
+                # change, and discard their plugin rather than adding it to activated
+                self.activation_condition.acquire()
+                try:
+                    self.state = DEACTIVATING
+                    to_deactivate = plugin if isinstance(plugin, list) else list(self.activated)
+                finally:
+                    self.activation_condition.release()
+                for plugin in to_deactivate:
                     self._deactivate_instance(plugin)
             finally:
-                self.state = DEACTIVATED
+                self._set_state_if(DEACTIVATING, DEACTIVATED)
                 self.lock.release()
             logger.info("De-activated plugins")
         else:
@@ -497,7 +950,19 @@ class G15Plugins():
             mod_id = self.plugin_map[plugin].id
             if mod_id in self.service.active_plugins:
                 del self.service.active_plugins[mod_id]
-        self.activated.remove(plugin)
+        self.activation_condition.acquire()
+        try:
+            self.activated.remove(plugin)
+        finally:
+            self.activation_condition.release()
+        
+    def _set_state_if(self, expected, state):
+        self.activation_condition.acquire()
+        try:
+            if self.state == expected:
+                self.state = state
+        finally:
+            self.activation_condition.release()
         
     def _get_plugin_key(self, subkey=None):
         folder = self.screen.device.uid if self.screen is not None else "global"
@@ -530,20 +995,25 @@ class G15Plugins():
                     instance = self._create_instance(plugin, self._get_plugin_key(plugin_id))
                     self.started.append(instance)
                     if self.is_in_active_state() == True:
-                        self._activate_instance(instance)
+                        self.activate(plugin = instance)
                 elif not now_enabled and instance != None:
-                    if instance in self.activated:
-                        self._deactivate_instance(instance)
                     if instance in self.started:
                         self.started.remove(instance)
                     del self.module_map[plugin_id]
-                    instance.destroy()
+                    
+                    # An activation that is still running destroys the plugin once it completes 
+                    if not self._cancel_activation(instance):
+                        if instance in self.activated:
+                            self._deactivate_instance(instance)
+                        instance.destroy()
         finally:
             self.lock.release()
             
-    def _activate_instance(self, instance, callback=None, idx=0):
+    def _activate_instance(self, instance, callback=None, idx=0, concurrent=False):
         mod = self.plugin_map[instance] 
         logger.info("Activating %s", mod.id)
+        entry = self._add_to_timeline(mod.id, "activate")
+        entry.background = instance in self.stragglers
         try :             
             if self._is_single_instance(mod):
                 logger.info("%s may only be run once, checking if there is another instance", mod.id)
@@ -552,21 +1022,176 @@ class G15Plugins():
             if callback != None:
                 callback(idx, len(self.started), mod.name)
             instance.activate()
-            self.service.active_plugins[mod.id] = True
-            self.activated.append(instance)
+            entry.complete("ok")
         except Exception as e:
+            entry.complete("failed")
             logger.error("Failed to activate plugin %s.", mod.id, exc_info = e)
-            self.conf_client.set_bool(self._get_plugin_key("%s/enabled" % mod.id), False)              
+            self.conf_client.set_bool(self._get_plugin_key("%s/enabled" % mod.id), False)
+            return
+        
+        self.activation_condition.acquire()
+        try:
+            # The plugins may have been de-activated, or this one disabled, while it was
+            # being activated in the background
+            discard = instance in self.cancelled or \
+                      ( concurrent and ( not self.state in [ ACTIVATING, ACTIVATED ] or \
+                                         not instance in self.started ) )
+            if not discard:
+                self.service.active_plugins[mod.id] = True
+                self.activated.append(instance)
+        finally:
+            self.activation_condition.release()
+        if discard:
+            logger.info("%s is no longer wanted now its activation is complete, de-activating", mod.id)
+            try :
+                instance.deactivate()
+            except Exception as e:
+                logger.warning("Failed to deactive plugin properly.", exc_info = e)
+            
+    def _activate_concurrently(self, instances, callback):
+        """
+        Activate a list of plugin instances using the plugin activation queue,
+        which runs up to service.plugin_activation_threads activations at once.
+        A plugin whose "requires" attribute names another plugin in the list
+        is not started until that plugin has finished activating.
+        
+        Waits until every plugin has been activated, or the ones that remain
+        have each been queued for longer than service.plugin_activation_timeout 
+        seconds (or are waiting on such a plugin). Those stragglers continue in
+        the background.
+        
+        Keyword arguments:
+        instances -- plugin instances to activate
+        callback -- callback function invoked as each plugin is started
+        """
+        queue_name = self._get_activation_queue()
+        
+        # Activations may block for a long time, so they have workers of their own 
+        # rather than tying up the shared ones
+        g15scheduler.set_dedicated(queue_name)
+        g15scheduler.set_max_concurrency(queue_name, max(1, self.service.plugin_activation_threads))
+        by_id = dict([ ( self.plugin_map[instance].id, instance ) for instance in instances ])
+        requires = {}
+        for instance in instances:
+            required = by_id.get(getattr(self.plugin_map[instance], "requires", None))
+            if required is not None and required != instance:
+                requires[instance] = required
+        
+        # Plugins that require each other (or require such a plugin) would wait forever
+        unresolvable = get_unresolvable(requires)
+        for instance in unresolvable:
+            mod = self.plugin_map[instance]
+            self._add_to_timeline(mod.id, "activate").complete("failed")
+            logger.error("Failed to activate plugin %s, its requirements form a cycle.", mod.id)
+        
+        self.activation_condition.acquire()
+        try:
+            for idx, instance in enumerate(instances):
+                if instance in unresolvable:
+                    continue
+                if instance in requires:
+                    self.waiting[instance] = ( requires[instance], callback, idx )
+                else:
+                    self._queue_activation(instance, callback, idx)
+                    
+            while True:
+                remaining = [ i for i in instances if i in self.activating or i in self.waiting ]
+                if len(remaining) == 0:
+                    break
+                now = time.time()
+                deadlines = [ self.activating[i] for i in remaining if i in self.activating and self.activating[i] > now ]
+                if len(deadlines) == 0:
+                    for instance in remaining:
+                        logger.warning("%s is taking too long to activate, continuing in the background",
+                                       self.plugin_map[instance].id)
+                        self.stragglers.add(instance)
+                        for entry in self.timeline:
+                            if entry.plugin_id == self.plugin_map[instance].id and entry.finished is None:
+                                entry.background = True
+                    break
+                self.activation_condition.wait(min(deadlines) - now)
+        finally:
+            self.activation_condition.release()
+            
+    def _queue_activation(self, instance, callback, idx):
+        self.activating[instance] = time.time() + self.service.plugin_activation_timeout
+        g15scheduler.execute(self._get_activation_queue(), "activate-%s" % self.plugin_map[instance].id,
+                             self._do_activation, instance, callback, idx)
+            
+    def _do_activation(self, instance, callback, idx, concurrent = True):
+        cancelled = False
+        try:
+            if not instance in self.cancelled:
+                self._activate_instance(instance, callback, idx, concurrent)
+        finally:
+            self.activation_condition.acquire()
+            try:
+                del self.activating[instance]
+                self.stragglers.discard(instance)
+                cancelled = instance in self.cancelled
+                self.cancelled.discard(instance)
+                self._release_waiting(instance)
+                self.activation_condition.notify_all()
+            finally:
+                self.activation_condition.release()
+            if cancelled:
+                # The plugin was disabled while it was being activated
+                instance.destroy()
+                
+    def _release_waiting(self, instance):
+        for waiting, ( required, waiting_callback, waiting_idx ) in list(self.waiting.items()):
+            if required == instance:
+                del self.waiting[waiting]
+                self._queue_activation(waiting, waiting_callback, waiting_idx)
+                
+    def _cancel_activation(self, instance):
+        """
+        Cancel an activation of a plugin that has not yet completed. Returns True
+        if the activation is still running, in which case the plugin is 
+        de-activated and destroyed when it completes.
+        
+        Keyword arguments:
+        instance -- plugin instance
+        """
+        self.activation_condition.acquire()
+        try:
+            if instance in self.waiting:
+                del self.waiting[instance]
+                self._release_waiting(instance)
+                self.activation_condition.notify_all()
+            if instance in self.activating and not instance in self.activated:
+                logger.info("%s was disabled while being activated", self.plugin_map[instance].id)
+                self.cancelled.add(instance)
+                return True
+            return False
+        finally:
+            self.activation_condition.release()
+            
+    def _get_activation_queue(self):
+        return "pluginActivation-%s" % ( self.screen.device.uid if self.screen is not None else "global" )
+    
+    def _add_to_timeline(self, plugin_id, phase):
+        entry = TimelineEntry(plugin_id, phase)
+        self.timeline.append(entry)
+        if len(self.timeline) > MAX_TIMELINE:
+            del self.timeline[0]
+        return entry
         
     def _is_single_instance(self, module):
         return getattr(module, 'single_instance', False)
             
     def _create_instance(self, module, key):
         logger.info("Loading %s", module.id)
-        if self.screen is not None:
-            instance = module.create(key, self.conf_client, screen=self.screen)
-        else:
-            instance = module.create(key, self.conf_client, service=self.service)
+        entry = self._add_to_timeline(module.id, "create")
+        try:
+            if self.screen is not None:
+                instance = module.create(key, self.conf_client, screen=self.screen)
+            else:
+                instance = module.create(key, self.conf_client, service=self.service)
+        except:
+            entry.complete("failed")
+            raise
+        entry.complete("ok")
         self.module_map[module.id] = instance
         self.plugin_map[instance] = module
         logger.info("Loaded %s", module.id)
@@ -126,6 +126,17 @@ NO_PLUGINS = "none"
 ALL_PLUGINS = "all"
 SELECTED_PLUGINS = "selected"
 
+'''
+Operations macro scripts are compiled to
+'''
+OP_PRESS = 0
+OP_RELEASE = 1
+OP_UPRESS = 2
+OP_URELEASE = 3
+OP_DELAY = 4
+OP_GOTO = 5
+OP_WAIT = 6
+
 """
 Defaults
 """
@@ -409,6 +420,96 @@ def clone_macro(macro):
     return m
         
 
+class MacroScript(object):
+    """
+    A macro script compiled to a list of operations, so the text only has to be
+    parsed and checked once rather than every time the macro is run. Each 
+    operation is a tuple of one of the OP_ codes followed by its arguments.
+    Goto labels are resolved to positions in the list, uinput key names to
+    their codes and delays to seconds. Lines that are not valid are logged and
+    left out.
+    """
+    def __init__(self, text, activate_on):
+        """
+        Constructor
+        
+        Keyword arguments:
+        text           --    script text
+        activate_on    --    key state the macro activates on, which determines
+                             the Wait operations that may be used 
+        """
+        self.text = text
+        self.activate_on = activate_on
+        self.ops = []
+        self.errors = 0
+        self._compile()
+        
+    """
+    Private
+    """
+    
+    def _compile(self):
+        labels = {}
+        gotos = []
+        for macro_text in self.text.split("\n"):
+            split = macro_text.split(" ")
+            op = split[0].lower()
+            if len(split) < 2:
+                if len(op.strip()) > 0:
+                    self._error("Insufficient arguments in macro script. '%s'", macro_text)
+                continue
+            val = split[1]
+            if op == "label":
+                labels[val.lower()] = len(self.ops)
+            elif op == "goto":
+                gotos.append(( len(self.ops), val.lower() ))
+                self.ops.append(( OP_GOTO, -1 ))
+            elif op == "delay":
+                try:
+                    self.ops.append(( OP_DELAY, float(val) / 1000.0 ))
+                except ValueError:
+                    self._error("Invalid delay in macro script. '%s'", macro_text)
+            elif op == "press":
+                self.ops.append(( OP_PRESS, val ))
+            elif op == "release":
+                self.ops.append(( OP_RELEASE, val ))
+            elif op == "upress" or op == "urelease":
+                if len(split) < 3:                        
+                    self._error("Invalid operation in macro script. '%s'", macro_text)
+                elif not val in g15uinput.capabilities:
+                    self._error("Unknown uinput key %s.", val)
+                else:
+                    self.ops.append(( OP_UPRESS if op == "upress" else OP_URELEASE, split[2], g15uinput.capabilities[val] ))
+            elif op == "wait":
+                val = val.lower()
+                if val == "release":
+                    if self.activate_on == g15driver.KEY_STATE_UP:
+                        self._error("WaitRelease cannot be used with macros that activate on release")
+                    else:
+                        self.ops.append(( OP_WAIT, g15driver.KEY_STATE_UP ))
+                elif val == "hold":
+                    if self.activate_on == g15driver.KEY_STATE_DOWN:
+                        self.ops.append(( OP_WAIT, g15driver.KEY_STATE_HELD ))
+                    else:                        
+                        self._error("WaitHold cannot be used with macros that activate on hold or release")
+                else:                        
+                    self._error("Wait may only have an argument of release or hold")
+            else:
+                self._error("Invalid operation in macro script. '%s'", macro_text)
+        
+        # Now the positions of all labels are known, resolve the gotos. Unknown
+        # labels just continue with the next operation   
+        for i, label in gotos:
+            if label in labels:
+                self.ops[i] = ( OP_GOTO, labels[label] )
+            else:
+                self._error("Unknown goto label %s in macro script. Ignoring", label)
+                self.ops[i] = ( OP_GOTO, i + 1 )
+                    
+    def _error(self, message, *args):
+        self.errors += 1
+        logger.error(message, *args)
+
 class G15Macro(object):
     """
     Represents a single macro in a profile. A macro defines how it's used
@@ -440,6 +541,7 @@ class G15Macro(object):
         self.repeat_mode = REPEAT_WHILE_HELD
         self.type = MACRO_SCRIPT
         self.repeat_delay = DEFAULT_REPEAT_DELAY 
+        self._script = None
         section_name = "m%d" % self.memory
         if not self.profile.parser.has_section(section_name):
             self.profile.parser.add_section(section_name)
@@ -465,6 +567,18 @@ class G15Macro(object):
         """
         return self._get_total(self.keys) - self._get_total(o.keys)
         
+    def get_script(self):
+        """
+        Get the compiled MacroScript for this macro. It is compiled again if 
+        the script text or activation state have changed since it was last
+        compiled.
+        """
+        script = self._script
+        if script is None or script.text != self.macro or script.activate_on != self.activate_on:
+            script = MacroScript(self.macro, self.activate_on)
+            self._script = script
+        return script
+    
     def get_uinput_code(self):
         """
         Get the uinput code of the key this macro is mapped to. If this 
@@ -616,6 +730,8 @@ class G15Macro(object):
                 it's stored when the profile is in 1.0 mode.
                 """
                 self.macro = self._decode_val(self._get("action", ""))
+        if self.type == MACRO_SCRIPT:
+            self.get_script()
         
     def _get(self, key, default_value):
         section_name = self._get_section_name()
@@ -34,6 +34,12 @@ PRI_NORMAL = 50
 PRI_LOW = 20
 PRI_INVISIBLE = 0
 
+"""
+Redraw priorities
+"""
+REDRAW_NORMAL = 0
+REDRAW_HIGH = 1
+
 """
 Paint stages
 """
@@ -241,6 +247,15 @@ class Painter():
         """
         self.z_order = z_order
         self.place = place
+        self.cached = False
+        self.dirty = True
+        
+    def mark_dirty(self):
+        """
+        Painters that set cached to True must call this when they need to paint 
+        something different, until then the screen re-uses what they last painted.
+        """
+        self.dirty = True
         
     def paint(self, canvas):
         """
@@ -252,6 +267,238 @@ class Painter():
         raise Exception("Not implemented")
     
     
+class Compositor():
+    """
+    Builds each frame from layers. Painters that are cached get a layer of their
+    own that is only painted again when they are marked dirty. When all of the
+    background painters are cached, they are combined into a single layer along
+    with the background colour, so a frame starts with one copy of that layer.
+    """
+    
+    def __init__(self, screen):
+        self.screen = screen
+        self.reset()
+        
+    def reset(self):
+        """
+        Discard all layers, for example because the screen size changed
+        """
+        self.painters = []
+        self.sorted_painters = []
+        self.layers = {}
+        self.background = None
+        
+    def get_painters(self):
+        """
+        Get the screen's painters in z-order. They are only sorted again when
+        painters have been added or removed.
+        """
+        if self.painters != self.screen.painters:
+            self.painters = list(self.screen.painters)
+            self.sorted_painters = sorted(self.painters, key=lambda painter: painter.z_order)
+            for painter in self.layers.keys():
+                if not painter in self.painters:
+                    del self.layers[painter]
+            self.background = None
+        return self.sorted_painters
+    
+    def paint_background(self, canvas):
+        """
+        Clear the canvas and paint all of the background painters.
+        
+        Keyword arguments:
+        canvas            -- canvas
+        """
+        painters = [ painter for painter in self.get_painters() if painter.place == BACKGROUND_PAINTER ]
+        if len(painters) == 0 or len([ painter for painter in painters if not getattr(painter, "cached", False) ]) > 0:
+            self.screen.clear_canvas(canvas)
+            for painter in painters:
+                self._paint_painter(painter, canvas)
+            return
+        
+        rgb = self.screen.driver.get_color_as_ratios(g15driver.HINT_BACKGROUND, (255, 255, 255))
+        if self.background is None or self.background[0] != rgb or \
+                len([ painter for painter in painters if painter.dirty ]) > 0:
+            surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, self.screen.width, self.screen.height)
+            layer_canvas = cairo.Context(surface)
+            self.screen.clear_canvas(layer_canvas)
+            for painter in painters:
+                painter.dirty = False
+                painter.paint(layer_canvas)
+            self.background = ( rgb, surface )
+            
+        canvas.save()
+        canvas.set_operator(cairo.OPERATOR_SOURCE)
+        canvas.set_source_surface(self.background[1])
+        canvas.paint()
+        canvas.restore()
+        rgb = self.screen.driver.get_color_as_ratios(g15driver.HINT_FOREGROUND, (0, 0, 0))
+        canvas.set_source_rgb(rgb[0], rgb[1], rgb[2])
+        self.screen.configure_canvas(canvas)
+        
+    def paint_foreground(self, canvas):
+        """
+        Paint all of the foreground painters.
+        
+        Keyword arguments:
+        canvas            -- canvas
+        """
+        for painter in self.get_painters():
+            if painter.place == FOREGROUND_PAINTER:
+                self._paint_painter(painter, canvas)
+    
+    """
+    Private
+    """
+    
+    def _paint_painter(self, painter, canvas):
+        if not getattr(painter, "cached", False):
+            painter.paint(canvas)
+            return
+        
+        surface = self.layers.get(painter)
+        if surface is None or painter.dirty:
+            surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, self.screen.width, self.screen.height)
+            layer_canvas = cairo.Context(surface)
+            self.screen.configure_canvas(layer_canvas)
+            painter.dirty = False
+            painter.paint(layer_canvas)
+            self.layers[painter] = surface
+        canvas.save()
+        canvas.set_source_surface(surface)
+        canvas.paint()
+        canvas.restore()
+    
+    
+class RedrawScheduler():
+    """
+    Merges redraw requests for a screen so that a burst of them results in a single
+    frame, and limits the rate frames are painted at to the maximum the device
+    should be sent. High priority requests (key feedback and page changes) are
+    painted as soon as the redraw queue gets to them, normal requests wait until
+    the frame interval has passed.
+    """
+    
+    def __init__(self, screen):
+        self.screen = screen
+        self.lock = RLock()
+        self.max_fps = g15driver.COLOR_MAX_FPS
+        self.pending = {}
+        self.direction = "up"
+        self.transitions = False
+        self.job = None
+        self.timer = None
+        self.last_frame = 0
+        self.window_start = time.time()
+        self.window_frames = 0
+        self.fps = 0.0
+        self.requests = 0
+        self.merged = 0
+        self.frames = 0
+        
+    def request(self, page=None, direction="up", transitions=True, redraw_content=True, priority=REDRAW_NORMAL):
+        """
+        Request a frame be painted.
+        
+        Keyword arguments:
+        page            -- page to redraw or None for the visible page
+        direction       -- direction for transitions
+        transitions     -- whether transitions may be run
+        redraw_content  -- whether the page content must be painted again
+        priority        -- REDRAW_NORMAL or REDRAW_HIGH 
+        """
+        self.lock.acquire()
+        try:
+            self.requests += 1
+            self.pending[page] = self.pending.get(page, False) or redraw_content
+            if transitions:
+                self.transitions = True
+                self.direction = direction
+            # The queued paint may have been cleared from the queue (by a page 
+            # cycle), so check it will still run rather than trusting a flag
+            if self.job is not None and self.job.is_pending():
+                self.merged += 1
+                if priority == REDRAW_HIGH and self.timer is not None:
+                    # Paint now instead of waiting for the timer 
+                    self.timer.cancel()
+                    self.timer = None
+                    self.job = g15scheduler.execute(REDRAW_QUEUE, "redraw", self._paint)
+                return
+            
+            self.timer = None
+            delay = 0
+            if priority != REDRAW_HIGH and self.max_fps > 0:
+                delay = self.last_frame + ( 1.0 / self.max_fps ) - time.time()
+            if delay > 0:
+                self.timer = g15scheduler.queue(REDRAW_QUEUE, "redraw", delay, self._paint)
+                self.job = self.timer
+            else:
+                self.job = g15scheduler.execute(REDRAW_QUEUE, "redraw", self._paint)
+        finally:
+            self.lock.release()
+            
+    def get_statistics(self):
+        """
+        Get a dictionary containing the frame rate achieved over the last few seconds,
+        the maximum frame rate, and the number of redraws requested, merged
+        into other redraws and actually painted.
+        """
+        self.lock.acquire()
+        try:
+            return { "redraw_fps" : self.fps,
+                     "redraw_max_fps" : self.max_fps,
+                     "redraw_requests" : self.requests,
+                     "redraw_merged" : self.merged,
+                     "redraw_frames" : self.frames }
+        finally:
+            self.lock.release()
+    
+    """
+    Private
+    """
+            
+    def _paint(self):
+        self.lock.acquire()
+        try:
+            pending = self.pending
+            direction = self.direction
+            transitions = self.transitions
+            self.pending = {}
+            self.transitions = False
+            self.job = None
+            self.timer = None
+            if len(pending) == 0:
+                return
+        finally:
+            self.lock.release()
+            
+        screen = self.screen
+        screen.page_model_lock.acquire()
+        try :           
+            current_page = screen._get_next_page_to_display()
+            if None in pending or current_page in pending:
+                screen._draw_page(current_page, direction, transitions, pending.get(None, False) or pending.get(current_page, False))
+            elif len([ page for page in pending if page.panel_painter != None ]) > 0:
+                screen._draw_page(current_page, direction, transitions, False)
+            else:
+                return
+        finally:    
+            screen.page_model_lock.release()
+            
+        self.lock.acquire()
+        try:
+            now = time.time()
+            self.last_frame = now
+            self.frames += 1
+            self.window_frames += 1
+            if now - self.window_start >= 5:
+                self.fps = self.window_frames / ( now - self.window_start )
+                self.window_start = now
+                self.window_frames = 0
+        finally:
+            self.lock.release()
+    
+    
 class G15Screen():
     
     def __init__(self, plugin_manager_module, service, device):
@@ -286,6 +533,11 @@ class G15Screen():
         self.memory_bank_color_control = None
         self.acquired_controls = {}
         self.painters = []
+        self.compositor = Compositor(self)
+        self.redraw_scheduler = RedrawScheduler(self)
+        
+        # Painting must not wait behind jobs that block on the shared workers
+        g15scheduler.set_dedicated(REDRAW_QUEUE)
         self.fader = None
         self.mkey = 1
         self.temp_acquired_controls = {}
@@ -361,6 +613,7 @@ class G15Screen():
         self.notify_handles.append(self.conf_client.notify_add("%s/cycle_screens" % screen_key, self.resched_cycle))
         self.notify_handles.append(self.conf_client.notify_add("%s/active_profile" % screen_key, self.active_profile_changed))
         self.notify_handles.append(self.conf_client.notify_add("%s/driver" % screen_key, self.driver_changed))
+        self.notify_handles.append(self.conf_client.notify_add("%s/max_fps" % screen_key, self._max_fps_changed))
         for control in self.driver.get_controls():
             self.notify_handles.append(self.conf_client.notify_add("%s/%s" % (screen_key, control.id), self._control_changed))
         logger.info("Starting for %s is complete.", self.device.uid)
@@ -939,6 +1192,10 @@ class G15Screen():
         self.height = self.driver.get_size()[1]
         
         self.surface = cairo.ImageSurface (cairo.FORMAT_ARGB32, self.width, self.height)
+        self.back_surface = None
+        self.old_surface = None
+        self.compositor.reset()
+        self._max_fps_changed()
         self.size = (self.width, self.height)
         self.available_size = (0, 0, self.size[0], self.size[1])
         
@@ -1142,13 +1399,17 @@ class G15Screen():
         g15scheduler.clear_jobs(REDRAW_QUEUE)
         g15scheduler.execute(REDRAW_QUEUE, "doCycle", self._do_cycle, number, transitions)
             
-    def redraw(self, page=None, direction="up", transitions=True, redraw_content=True, queue=True):
+    def redraw(self, page=None, direction="up", transitions=True, redraw_content=True, queue=True, priority=None):
         if page:
             logger.debug("Redrawing %s", page.id)
         else:
             logger.debug("Redrawing current page")
         if queue:
-            g15scheduler.execute(REDRAW_QUEUE, "redraw", self._do_redraw, page, direction, transitions, redraw_content)
+            if priority is None:
+                # Switching to a page that is not yet visible should not wait 
+                priority = REDRAW_HIGH if page is not None and page != self.visible_page and \
+                                page == self._get_next_page_to_display() else REDRAW_NORMAL
+            self.redraw_scheduler.request(page, direction, transitions, redraw_content, priority)
         else:
             self._do_redraw(page, direction, transitions, redraw_content)
             
@@ -1169,6 +1430,13 @@ class G15Screen():
             self.driver.release_control(self.memory_bank_color_control)
             self.memory_bank_color_control = None
             
+    def get_redraw_statistics(self):
+        """
+        Get a dictionary of the frame rate achieved and the number of redraw requests
+        made, merged and painted.
+        """
+        return self.redraw_scheduler.get_statistics()
+            
     def get_current_surface(self):
         return self.local_data.surface
     
@@ -1303,24 +1571,21 @@ class G15Screen():
             
             surface = self.surface
             
-            painters = sorted(self.painters, key=lambda painter: painter.z_order)
-            
-            # If the visible page is changing, creating a new surface. Both surfaces are
+            # If the visible page is changing, use the other surface. Both surfaces are
             # then passed to any transition functions registered
             if visible_page != self.visible_page: 
-                logger.debug("Page has changed, recreating surface")
+                logger.debug("Page has changed, switching surface")
                 if visible_page.priority == PRI_NORMAL and not self.stopping:   
                     self.service.conf_client.set_string("/apps/gnome15/%s/last_page" % self.device.uid, visible_page.id)  
-                surface = cairo.ImageSurface (cairo.FORMAT_ARGB32, self.width, self.height)
+                if self.back_surface is None:
+                    self.back_surface = cairo.ImageSurface (cairo.FORMAT_ARGB32, self.width, self.height)
+                surface = self.surface if self.old_surface is self.back_surface else self.back_surface
                 
             self.local_data.surface = surface
             canvas = cairo.Context (surface)
-            self.clear_canvas(canvas)
             
             # Background painters
-            for painter in painters:
-                if painter.place == BACKGROUND_PAINTER:
-                    painter.paint(canvas)
+            self.compositor.paint_background(canvas)
                     
             old_page = None
             if visible_page != self.visible_page:            
@@ -1348,10 +1613,14 @@ class G15Screen():
                              str(redraw_content))
             
                          
-                # Paint the content to a new surface so it can be cached
+                # Paint the content to a surface of its own so it can be cached
                 if self.content_surface == None or redraw_content:
-                    self.content_surface = cairo.ImageSurface (cairo.FORMAT_ARGB32, self.width, self.height)
+                    if self.content_surface == None:
+                        self.content_surface = cairo.ImageSurface (cairo.FORMAT_ARGB32, self.width, self.height)
                     content_canvas = cairo.Context(self.content_surface)
+                    content_canvas.set_operator(cairo.OPERATOR_CLEAR)
+                    content_canvas.paint()
+                    content_canvas.set_operator(cairo.OPERATOR_OVER)
                     self.configure_canvas(content_canvas)
                     self.visible_page.paint(content_canvas)
                 
@@ -1385,9 +1654,7 @@ class G15Screen():
             self.glass_pane.paint(canvas)
 
             # Foreground painters                
-            for painter in painters:
-                if painter.place == FOREGROUND_PAINTER:
-                    painter.paint(canvas)
+            self.compositor.paint_foreground(canvas)
                     
             # Run any transitions
             if transitions and self.transition_function != None and self.old_canvas != None:
@@ -1478,6 +1745,12 @@ class G15Screen():
         if len(self.pages) > 0:            
             self._cycle_pages(number, self._get_pages_of_priority(PRI_NORMAL))
                 
+    def _max_fps_changed(self, *args):
+        max_fps = self.conf_client.get_int("/apps/gnome15/%s/max_fps" % self.device.uid)
+        if max_fps <= 0 and self.driver is not None:
+            max_fps = self.driver.get_max_fps()
+        self.redraw_scheduler.max_fps = max_fps
+            
     def _do_redraw(self, page=None, direction="up", transitions=True, redraw_content=True):
         self.page_model_lock.acquire()
         try :           
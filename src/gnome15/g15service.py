@@ -74,6 +74,9 @@ VERSION = g15globals.version
 SERVICE_QUEUE = "serviceQueue"
 MACRO_HANDLER_QUEUE = "macroHandler"
 
+# How far (in seconds) a macro script may fall behind its delays before the timing is reset
+MACRO_MAX_LAG = 0.1
+
 special_X_keysyms = {
     ' ' : "space",
     '\t' : "Tab",
@@ -149,6 +152,7 @@ class MacroHandler(object):
         self.use_x_test = None
         self.x_test_available = None
         self.window = None
+        g15scheduler.set_dedicated(MACRO_HANDLER_QUEUE)
         
     def cancel(self):
         """
@@ -419,26 +423,23 @@ class MacroHandler(object):
                 self.buffered_executions.append(executor)
             
 class MacroScriptExecution(object):
+    """
+    Runs the compiled script of a macro (see g15profile.MacroScript). Delays
+    are timed against deadlines on a monotonic clock, so time spent sending 
+    keys does not add up over the length of the script.
+    """
     
     def __init__(self, macro, handler):
         self.macro = macro
         self.handler = handler
-        self.l = -1
-        self.macros = self.macro.macro.split("\n")
+        self.script = macro.get_script()
+        self.pc = 0
         self.wait_for_state = -2
         self.wait_for_keys = []
         self.down = 0
         self.all_keys_up = False
         self.cancelled = False
-        
-        # First parse to get where the labels are
-        self.labels = {}
-        for l in range(0, len(self.macros)):
-            macro_text = self.macros[l]
-            split = macro_text.split(" ")
-            op = split[0].lower()
-            if op == "label" and len(op) > 1:
-                self.labels[split[1].lower()] = l
+        self.deadline = None
                 
     def handle_key(self, keys, state_id, post):
         
@@ -461,90 +462,107 @@ class MacroScriptExecution(object):
             return True
                 
     def execute(self):
+        ops = self.script.ops
+        profile = self.macro.profile
+        press_delay = 0.0 if not profile.fixed_delays else ( float(profile.press_delay) / 1000.0 )
+        release_delay = 0.0 if not profile.fixed_delays else ( float(profile.release_delay) / 1000.0 )
+        self.deadline = None
         while True:
             if self.down == 0 and ( self.handler.cancelled or self.cancelled ):
                 logger.warning("Macro cancelled")
                 break
-            self.l += 1
-            if self.l == len(self.macros):
+            if self.pc >= len(ops):
                 break
-            macro_text = self.macros[self.l]
-            split = macro_text.split(" ")
-            op = split[0].lower()
-            if len(split) > 1:
-                val = split[1]
-                if op == "goto":
-                    val = val.lower()
-                    if val in self.labels:
-                        self.l = self.labels[val]
-                    else:
-                        logger.warning("Unknown goto label %s in macro script. Ignoring", val)
-                elif op == "delay":
-                    if not self.handler.cancelled and self.macro.profile.send_delays and not self.macro.profile.fixed_delays:
-                        time.sleep(float(val) / 1000.0 if not self.macro.profile.fixed_delays else self.macro.profile.delay_amount)
-                elif op == "press":
-                    if self.down > 0:
-                        self.handler.release_delay(self.macro)
-                    self.handler.send_string(val, True)
-                    self.down += 1
-                    self.handler.press_delay(self.macro)
-                elif op == "release":
-                    self.handler.send_string(val, False)
-                    self.down -= 1
-                elif op == "upress":
-                    if len(split) < 3:                        
-                        logger.error("Invalid operation in macro script. '%s'", macro_text)
-                    else:
-                        if self.down > 0:
-                            self.handler.release_delay(self.macro)
-                        self.down += 1
-                        self._send_uinput(split[2], val, 1)
-                        self.handler.press_delay(self.macro)
-                elif op == "urelease":
-                    if len(split) < 3:                        
-                        logger.error("Invalid operation in macro script. '%s'", macro_text)
-                    else:
-                        self.down -= 1
-                        self._send_uinput(split[2], val, 0)
-                elif op == "wait":
-                    if self.all_keys_up:
-                        logger.warn("All keys for the macro %s are already up, " \
-                                    "the rest of the script will be ignored", self.macro.name)
-                        return False
-                    else:
-                        val = val.lower()
-                        if val == "release":
-                            if self.macro.activate_on == g15driver.KEY_STATE_UP:
-                                logger.error("WaitRelease cannot be used with macros that activate on release")
-                            else:
-                                self.wait_for_state = g15driver.KEY_STATE_UP
-                                self.wait_for_keys = list(self.macro.keys)
-                                return True
-                        elif val == "hold":
-                            if self.macro.activate_on == g15driver.KEY_STATE_DOWN:
-                                self.wait_for_state = g15driver.KEY_STATE_HELD
-                                self.wait_for_keys = list(self.macro.keys)
-                                return True
-                            else:                        
-                                logger.error("WaitHold cannot be used with macros that activate on hold or release")
-                        else:                        
-                            logger.error("Wait may only have an argument of release or hold")
-                elif op == "label":
-                    # Ignore label / comment
-                    pass
+            op = ops[self.pc]
+            self.pc += 1
+            code = op[0]
+            if code == g15profile.OP_GOTO:
+                self.pc = op[1]
+            elif code == g15profile.OP_DELAY:
+                if not self.handler.cancelled and profile.send_delays and not profile.fixed_delays:
+                    self._delay(op[1])
+            elif code == g15profile.OP_PRESS:
+                if self.down > 0:
+                    self._delay(release_delay)
+                self.handler.send_string(op[1], True)
+                self.down += 1
+                self._delay(press_delay)
+            elif code == g15profile.OP_RELEASE:
+                self.handler.send_string(op[1], False)
+                self.down -= 1
+            elif code == g15profile.OP_UPRESS:
+                if self.down > 0:
+                    self._delay(release_delay)
+                self.down += 1
+                g15uinput.emit(op[1], op[2], 1, True)
+                self._delay(press_delay)
+            elif code == g15profile.OP_URELEASE:
+                self.down -= 1
+                g15uinput.emit(op[1], op[2], 0, True)
+            elif code == g15profile.OP_WAIT:
+                if self.all_keys_up:
+                    logger.warn("All keys for the macro %s are already up, " \
+                                "the rest of the script will be ignored", self.macro.name)
+                    return False
                 else:
-                    logger.error("Invalid operation in macro script. '%s'", macro_text)
+                    self.wait_for_state = op[1]
+                    self.wait_for_keys = list(self.macro.keys)
+                    return True
                 
-            else:
-                if len(split) > 0:
-                    logger.error("Insufficient arguments in macro script. '%s'", macro_text)
-                    
+    def _delay(self, delay):
+        now = g15os.monotonic()
+        if self.deadline is None or now - self.deadline > MACRO_MAX_LAG:
+            self.deadline = now
+        self.deadline += delay
+        remaining = self.deadline - now
+        if remaining > 0:
+            time.sleep(remaining)
+            
+def benchmark_macros(keys = 1000, delay = 10, delays = 100):
+    """
+    Measure how quickly macro scripts run, without sending any events. Returns
+    a tuple of the number of key presses and releases per second sent by a 
+    script with no delays, and the mean and maximum error (in seconds) of the
+    intervals between key presses separated by a delay.
+    
+    Keyword arguments:
+    keys        -- number of keys to press and release for the throughput test
+    delay       -- delay (in milliseconds) to use for the timing test
+    delays      -- number of delays in the timing test
+    """
+    class Profile():
+        send_delays = True
+        fixed_delays = False
+        
+    class Macro():
+        def __init__(self, text):
+            self.profile = Profile()
+            self.macro = text
+            self.name = "Benchmark"
+            self.keys = []
+            self.activate_on = g15driver.KEY_STATE_UP
+            self.script = g15profile.MacroScript(text, self.activate_on)
+        def get_script(self):
+            return self.script
         
-    def _send_uinput(self, target, val, state):
-        if val in g15uinput.capabilities:
-            g15uinput.emit(target, g15uinput.capabilities[val], state, True)
-        else:                        
-            logger.error("Unknown uinput key %s.", val)
+    class Handler():
+        def __init__(self):
+            self.cancelled = False
+            self.pressed = []
+        def send_string(self, ch, press):
+            if press:
+                self.pressed.append(g15os.monotonic())
+    
+    handler = Handler()
+    execution = MacroScriptExecution(Macro("Press a\nRelease a\n" * keys), handler)
+    started = g15os.monotonic()
+    execution.execute()
+    keys_per_second = ( keys * 2 ) / ( g15os.monotonic() - started )
+    
+    handler = Handler()
+    MacroScriptExecution(Macro("Press a\nRelease a\nDelay %d\n" % delay * delays), handler).execute()
+    errors = [ abs(( handler.pressed[i] - handler.pressed[i - 1] ) - delay / 1000.0) for i in range(1, len(handler.pressed)) ]
+    return keys_per_second, sum(errors) / max(1, len(errors)), max(errors) if errors else 0.0
 
 class G15Service(g15desktop.G15AbstractService):
     
@@ -556,6 +574,7 @@ class G15Service(g15desktop.G15AbstractService):
         self.active_window = None
         self.shutting_down = False
         self.starting_up = True
+        self.start_time = time.time()
         self.conf_client = gconf.client_get_default()
         self.screens = []
         self.started = False
@@ -797,8 +816,11 @@ class G15Service(g15desktop.G15AbstractService):
         self.session_bus = dbus.SessionBus()
         self.system_bus = dbus.SystemBus()
         
-        # Create a screen for each device        
-        self.conf_client.add_dir("/apps/gnome15", gconf.CLIENT_PRELOAD_NONE)
+        # Load all of the configuration at once. The client keeps its copy up to date
+        # from change notifications, so later reads do not go to the configuration daemon 
+        self.conf_client.add_dir("/apps/gnome15", gconf.CLIENT_PRELOAD_RECURSIVE)
+        
+        # Create a screen for each device
         logger.info("Looking for devices")
         if len(self.devices) == 0:
             if g15devices.have_udev and not self.exit_on_no_devices:
@@ -1077,6 +1099,8 @@ class G15Service(g15desktop.G15AbstractService):
         self.all_off_on_disconnect = g15gconf.get_bool_or_default(self.conf_client, '/apps/gnome15/all_off_on_disconnect', True)
         self.fade_keyboard_backlight_on_close = g15gconf.get_bool_or_default(self.conf_client, '/apps/gnome15/fade_keyboard_backlight_on_close', True)
         self.start_in_threads = g15gconf.get_bool_or_default(self.conf_client, '/apps/gnome15/start_in_threads', False)
+        self.plugin_activation_threads = g15gconf.get_int_or_default(self.conf_client, '/apps/gnome15/plugin_activation_threads', 4)
+        self.plugin_activation_timeout = g15gconf.get_int_or_default(self.conf_client, '/apps/gnome15/plugin_activation_timeout', 5000) / 1000.0
         self._mark_all_pages_dirty()
         
     def _mark_all_pages_dirty(self):
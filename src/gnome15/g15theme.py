@@ -57,16 +57,29 @@ import base64
 import dbusmenu
 import logging
 import time
+import math
+import bisect
 logger = logging.getLogger(__name__)
 from string import Template
 from copy import deepcopy
 from cStringIO import StringIO
 from lxml import etree
 from threading import RLock
+from collections import OrderedDict
 import ConfigParser
 
 BASE_PX=18.0
 DEBUG_SVG=False
+COMPILE_THEMES=True
+
+# Memory (in bytes) rasterised theme renders may use before the least recently used are discarded
+RENDER_CACHE_SIZE=8 * 1024 * 1024
+
+# The types of theme property value that may be used to identify a rasterised render
+CACHEABLE_TYPES=( str, unicode, int, long, float, bool, type(None) )
+
+# Number of items either side of the visible window that virtual menus prepare in advance
+MENU_OVERSCAN=2
 
 # The color in SVG theme files that by default gets replaced with the current 'highlight' color
 DEFAULT_HIGHLIGHT_COLOR="#ff0000"
@@ -137,6 +150,45 @@ def get_themes(model_id, plugin_module):
             if definition.supports(model_id):
                 themes.append(definition)
     return themes
+
+def benchmark(screen, theme_dirs, renders = 20):
+    """
+    Render each theme repeatedly, first processing the complete document for
+    every render and then using the compiled theme. A list of tuples containing
+    the theme directory and the renders per second achieved by each method is
+    returned. Themes that cannot be loaded for the screen's model are skipped.
+
+    Keyword arguments:
+    screen           -- screen to render for
+    theme_dirs       -- list of theme directories
+    renders          -- number of renders of each theme to time
+    """
+    global COMPILE_THEMES
+    results = []
+    was_compiled = COMPILE_THEMES
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, screen.width, screen.height)
+    try:
+        for theme_dir in theme_dirs:
+            try:
+                theme = G15Theme(theme_dir)
+                G15Page("benchmark", screen, theme = theme)
+            except Exception as e:
+                logger.debug("Skipping theme %s", theme_dir, exc_info = e)
+                continue
+
+            rates = []
+            for compiled in [ False, True ]:
+                COMPILE_THEMES = compiled
+                started = time.time()
+                for i in range(0, renders):
+                    theme.mark_dirty()
+                    theme.draw(cairo.Context(surface), { "benchmark" : str(i) })
+                rates.append(renders / max(time.time() - started, 0.000001))
+            theme._component_removed()
+            results.append(( theme_dir, rates[0], rates[1] ))
+    finally:
+        COMPILE_THEMES = was_compiled
+    return results
             
 class Render(object):
     def __init__(self, document, properties, text_boxes, attributes, processing_result):
@@ -210,7 +262,363 @@ class TextBox(object):
         self.reverse_shadow = False
         self.transforms = []
         self.base = 0
-        
+
+class ClippedText(object):
+    """
+    A text element with a clip path found while preparing a compiled theme
+    document. Everything but the text itself is worked out once.
+    """
+    def __init__(self, element, t_span_node, text, css, clip, bounds, vertical_wrap):
+        self.element = element
+        self.t_span_node = t_span_node
+        self.text = text
+        self.css = css
+        self.clip = clip
+        self.bounds = bounds
+        self.vertical_wrap = vertical_wrap
+        self.normal_shadow = False
+        self.reverse_shadow = False
+        self.x = element.get("x")
+        self.t_span_x = t_span_node.get("x")
+
+    def restore(self):
+        """
+        Put back any position changed by scrolling during the previous render
+        """
+        if self.x is not None:
+            self.element.set("x", self.x)
+        if self.t_span_x is not None:
+            self.t_span_node.set("x", self.t_span_x)
+
+class PreparedDocument(object):
+    """
+    A copy of a theme document that has had everything that does not depend on
+    the values of theme properties already applied, along with the nodes that
+    do depend on them.
+    """
+    def __init__(self, document):
+        self.document = document
+        self.progress_bars = []
+        self.images = []
+        self.clipped_text = []
+        self.text_boxes = []
+
+class CompiledTheme(object):
+    """
+    Caches prepared copies of a theme document so that G15Theme.draw() does not
+    have to copy and search the whole document on every render. A document is
+    prepared once for each combination of deleted elements, child components
+    and colours, after which a render only has to patch the handful of nodes
+    whose content depends on property values.
+    """
+
+    MAX_PREPARED = 8
+
+    def __init__(self, theme):
+        self.theme = theme
+        self.prepared = {}
+        self.prepared_order = []
+        self.deletes = []
+
+        root = theme.document.getroot()
+        positions = dict((element, i) for i, element in enumerate(root.iter()))
+        for element in root.xpath('//svg:*[@title]',namespaces=theme.nsmap):
+            args = element.get("title").split(" ")
+            if args[0] == "del":
+                var = args[1]
+                condition = True
+                if var.startswith("!"):
+                    var = var[1:]
+                    condition = False
+                self.deletes.append((positions[element], var, condition))
+
+    def is_supported(self):
+        """
+        Get if the theme may be drawn using a prepared document. Anything that
+        may manipulate the document in arbitrary ways on every render (SVG
+        processors, the python portion of the theme or child components that
+        draw themselves) requires the full document to be processed.
+        """
+        theme = self.theme
+        if theme.svg_processor is not None:
+            return False
+        if theme.instance is not None and hasattr(theme.instance, 'process_svg'):
+            return False
+        if theme.component:
+            for child in theme.component.child_map.values():
+                if getattr(child.draw, "im_func", None) is not Component.draw.im_func:
+                    return False
+        return True
+
+    def get_prepared(self, properties):
+        """
+        Get the prepared document for the given theme properties, creating it
+        if required.
+
+        Keyword arguments:
+        properties  -- theme properties
+        """
+        key = self._get_key(properties)
+        prepared = self.prepared.get(key)
+        if prepared is None:
+            prepared = self._prepare(key)
+            self.prepared[key] = prepared
+            self.prepared_order.append(key)
+            if len(self.prepared_order) > self.MAX_PREPARED:
+                del self.prepared[self.prepared_order.pop(0)]
+        return prepared
+
+    def _get_key(self, properties):
+        driver = self.theme.driver
+        deleted = []
+        for position, var, condition in self.deletes:
+            if condition:
+                deleted.append(var in properties and properties[var] != "" and properties[var] != False)
+            else:
+                deleted.append(not var in properties or properties[var] == "" or properties[var] == False)
+        highlight = None
+        if driver.get_control_for_hint(g15driver.HINT_HIGHLIGHT):
+            highlight = driver.get_color_as_hexrgb(g15driver.HINT_HIGHLIGHT, (255, 0, 0 ))
+        fg_c = driver.get_control_for_hint(g15driver.HINT_FOREGROUND)
+        component = self.theme.component
+        return ( tuple(deleted),
+                 tuple(sorted(component.child_map.keys())) if component else (),
+                 driver.get_color_as_hexrgb(g15driver.HINT_BACKGROUND, (255, 255,255)),
+                 driver.get_color_as_hexrgb(g15driver.HINT_FOREGROUND, (0, 0, 0)),
+                 highlight,
+                 tuple(fg_c.value[:3]) if fg_c != None else None )
+
+    def _prepare(self, key):
+        theme = self.theme
+        nsmap = theme.nsmap
+        document = deepcopy(theme.document)
+        root = document.getroot()
+        prepared = PreparedDocument(document)
+
+        # A copy has the same structure as the original, so elements can be
+        # found by position. Resolve them all before removing any
+        deleted = key[0]
+        all_elements = list(root.iter())
+        elements = []
+        for i in range(0, len(self.deletes)):
+            if deleted[i]:
+                elements.append(all_elements[self.deletes[i][0]])
+        for element in elements:
+            element.getparent().remove(element)
+
+        theme._process_components(root)
+        theme._set_relative_image_paths(root)
+        theme._do_shadow("shadow", key[2], root)
+        theme._do_shadow("reverseshadow", key[3], root)
+        theme._set_highlight_color(root)
+        theme._set_default_style(root)
+
+        # Record the nodes that are changed by property values. Shadows are
+        # copies, so this must happen after they have been created
+        for element in root.xpath('//svg:rect[@class=\'progress\']',namespaces=nsmap):
+            id = element.get("id")
+            if id.endswith("_progress"):
+                prepared.progress_bars.append((element, id[:-9], element.get("width"), g15svg.get_bounds(element)[2]))
+            else:
+                logger.warning("Found progress element with an ID that doesn't end in _progress")
+
+        for element in root.xpath('//svg:image',namespaces=nsmap):
+            id = element.get("title")
+            if id != None:
+                prepared.images.append((element, id, element.get("{http://www.w3.org/1999/xlink}href")))
+
+        for element in root.xpath('//svg:text[@clip-path]',namespaces=nsmap):
+            clip_path_node = theme._get_clip_path_element(element)
+            if clip_path_node is not None:
+                vertical_wrap = "vertical-wrap" == element.get("title")
+                t_span_node = theme.get_element_by_tag("tspan", root = element)
+                if t_span_node is None:
+                    t_span_node = element
+                t_span_text = t_span_node.text
+                if not t_span_text:
+                    raise Exception("Text node had clip path, but no text/tspan->text could be found")
+                clip_path_rect_node = theme.get_element_by_tag("rect", clip_path_node)
+                if clip_path_rect_node is None:
+                    raise Exception("No svg:rect for clip %s" % str(clip_path_node))
+
+                clipped = ClippedText(element, t_span_node, t_span_text,
+                                      theme.parse_css(element.get("style")),
+                                      g15svg.get_actual_bounds(clip_path_rect_node, element),
+                                      g15svg.get_actual_bounds(element),
+                                      vertical_wrap)
+                text_class = element.get("class")
+                if text_class:
+                    if "reverseshadow" in text_class:
+                        clipped.reverse_shadow = True
+                    elif "shadow" in text_class:
+                        clipped.normal_shadow = True
+                prepared.clipped_text.append(clipped)
+
+                # Wrapped text is rendered by Pango, not rsvg
+                if vertical_wrap:
+                    element.getparent().remove(element)
+
+        for element in root.xpath('//svg:rect[@class=\'textbox\']',namespaces=nsmap):
+            id = element.get("id")
+            logger.warning("DEPRECATED Text box with ID %s in %s", id, theme.dir)
+            text_node = root.xpath('//*[@id=\'' + id + '_text\']',namespaces=nsmap)[0]
+            if text_node != None:
+                prepared.text_boxes.append((id, theme.parse_css(text_node.get("style")), g15svg.get_actual_bounds(element)))
+                text_node.getparent().remove(text_node)
+                element.getparent().remove(element)
+
+        return prepared
+
+class RenderCache(object):
+    """
+    A least recently used cache of rasterised theme renders, shared by all themes.
+    Entries are discarded once the total size of the cached surfaces exceeds the
+    memory budget.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.lock = RLock()
+        self.entries = OrderedDict()
+        self.clear()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.entries.clear()
+            self.used = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+        finally:
+            self.lock.release()
+
+    def get(self, key):
+        """
+        Get the surface for a key, or None if there is no such render cached
+
+        Keyword arguments:
+        key         -- key
+        """
+        self.lock.acquire()
+        try:
+            surface = self.entries.pop(key, None)
+            if surface is None:
+                self.misses += 1
+            else:
+                self.entries[key] = surface
+                self.hits += 1
+            return surface
+        finally:
+            self.lock.release()
+
+    def put(self, key, surface):
+        """
+        Add a rendered surface, discarding the least recently used entries if
+        the memory budget is exceeded.
+
+        Keyword arguments:
+        key         -- key
+        surface     -- cairo.ImageSurface
+        """
+        surface_size = surface.get_stride() * surface.get_height()
+        if surface_size > self.size:
+            return
+        self.lock.acquire()
+        try:
+            old_surface = self.entries.pop(key, None)
+            if old_surface is not None:
+                self.used -= old_surface.get_stride() * old_surface.get_height()
+            while self.entries and self.used + surface_size > self.size:
+                old_key, old_surface = self.entries.popitem(last = False)
+                self.used -= old_surface.get_stride() * old_surface.get_height()
+                self.evictions += 1
+            self.entries[key] = surface
+            self.used += surface_size
+        finally:
+            self.lock.release()
+
+    def is_cacheable(self, width, height):
+        """
+        Get if a render of the given size could be held within the memory budget
+        at all.
+
+        Keyword arguments:
+        width       -- width of render
+        height      -- height of render
+        """
+        return cairo.ImageSurface.format_stride_for_width(cairo.FORMAT_ARGB32, width) * height <= self.size
+
+    def get_statistics(self):
+        self.lock.acquire()
+        try:
+            return { "render_cache_hits" : self.hits,
+                     "render_cache_misses" : self.misses,
+                     "render_cache_evictions" : self.evictions,
+                     "render_cache_entries" : len(self.entries),
+                     "render_cache_bytes" : self.used,
+                     "render_cache_size" : self.size }
+        finally:
+            self.lock.release()
+
+render_cache = RenderCache(RENDER_CACHE_SIZE)
+
+class DocumentStore(object):
+    """
+    Parsed and processed theme SVG documents, shared read-only by every theme
+    instance that uses the same theme directory, variant and model. A document
+    is parsed again only when the file it came from is modified. Instances that
+    need to change their document take a private copy first (see
+    G15Theme.get_writable_document).
+    """
+    def __init__(self):
+        self.lock = RLock()
+        self.documents = {}
+        self.parses = 0
+        self.hits = 0
+
+    def get(self, key, path, load):
+        """
+        Get the shared document for a key, calling load() to parse and process
+        it if it is not yet known or the file has changed since it was loaded.
+
+        Keyword arguments:
+        key         -- key
+        path        -- path of the SVG file
+        load        -- function returning the processed lxml.etree.ElementTree
+        """
+        mtime = os.path.getmtime(path)
+        self.lock.acquire()
+        try:
+            entry = self.documents.get(key)
+            if entry is not None and entry[0] == mtime:
+                self.hits += 1
+                return entry[1]
+            document = load()
+            self.parses += 1
+            self.documents[key] = ( mtime, document, len(etree.tostring(document)) )
+            return document
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.documents.clear()
+        finally:
+            self.lock.release()
+
+    def get_statistics(self):
+        self.lock.acquire()
+        try:
+            return { "document_store_parses" : self.parses,
+                     "document_store_hits" : self.hits,
+                     "document_store_documents" : len(self.documents),
+                     "document_store_bytes" : sum(e[2] for e in self.documents.values()) }
+        finally:
+            self.lock.release()
+
+document_store = DocumentStore()
+
 class LayoutManager(object):
     def __init__(self):
         pass
@@ -304,7 +712,10 @@ class Component(object):
         return self.showing
     
     def set_showing(self, showing):
-        self.showing = showing
+        if showing != self.showing:
+            self.showing = showing
+            if self.parent is not None:
+                self.parent._child_showing_changed(self)
         
     def get_showing_count(self):
         i = 0
@@ -337,7 +748,7 @@ class Component(object):
             theme._set_component(self)
             self.view_bounds = theme.bounds
             for c in self.get_children():
-                c.configure(self)
+                self._configure_child(c)
         finally:
             self.get_tree_lock().release()
         
@@ -404,7 +815,7 @@ class Component(object):
         return self.child_map[id] if id in self.child_map else None
         
     def contains_child(self, child):
-        return child in self._children
+        return self.child_map.get(child.id) is child
         
     def get_child_count(self):
         return len(self._children)
@@ -438,7 +849,7 @@ class Component(object):
             if child.id in self.child_map:
                 raise Exception("Child with ID of %s already exists in component %s. Trying to add %s, but %s exists" % (child.id, self.id, str(child), str(self.child_map[child.id])))
             self._check_has_parent()
-            child.configure(self)
+            self._configure_child(child)
             self.child_map[child.id] = child
             if index == -1:
                 self._children.append(child)
@@ -557,17 +968,7 @@ class Component(object):
                 self.paint_theme(canvas, properties, self.get_theme_attributes())
                 canvas.restore()
                 
-            # Layout any children
-            if self.layout_manager != None:
-                self.layout_manager.layout(self)
-                
-            # Paint children
-            for c in self._children:
-                if c.is_showing():
-                    canvas.save()
-                    if not self.do_clip or c.view_bounds is None or self.overlaps(self.view_bounds, c.view_bounds):
-                        c.paint(canvas)
-                    canvas.restore()
+            self._paint_children(canvas)
             
             canvas.restore()
         finally:
@@ -602,6 +1003,25 @@ class Component(object):
     '''
     Private
     '''
+    def _paint_children(self, canvas):
+        # Layout any children
+        if self.layout_manager != None:
+            self.layout_manager.layout(self)
+            
+        # Paint children
+        for c in self._children:
+            if c.is_showing():
+                canvas.save()
+                if not self.do_clip or c.view_bounds is None or self.overlaps(self.view_bounds, c.view_bounds):
+                    c.paint(canvas)
+                canvas.restore()
+    
+    def _configure_child(self, child):
+        child.configure(self)
+        
+    def _child_showing_changed(self, child):
+        pass
+        
     def _check_has_parent(self):
 #        if not self.parent:
 #            raise Exception("%s must be added to a parent before children can be added to it." % self.id)
@@ -898,7 +1318,9 @@ class Scrollbar(Component):
         
     def on_configure(self):
         Component.on_configure(self)
-        self._configure_track_and_bounds(self.get_theme(), self.get_theme().get_element(self.id))
+        # The theme document may be shared with other instances of the theme
+        theme = self.get_theme()
+        self._configure_track_and_bounds(theme, theme.get_element(self.id, theme.get_writable_document().getroot()))
         
     def _configure_track_and_bounds(self, theme, element):
         max_s, view_size, position = self.values_callback()
@@ -919,7 +1341,16 @@ class Scrollbar(Component):
         self._configure_track_and_bounds(theme, element)
 
 class Menu(Component):
-    def __init__(self, component_id):
+    """
+    A vertical list of MenuItem components, one of which is selected. 
+    
+    When virtual is True (it must be set before any items are added), the
+    offset of each item is kept in an index of item heights, and items are
+    only laid out, painted and given their themes when they come within
+    MENU_OVERSCAN items of the visible area. Use this for menus that may hold
+    a very large number of items.
+    """
+    def __init__(self, component_id, virtual = False):
         Component.__init__(self, component_id)
         self.selected = None
         self.on_selected = None
@@ -928,6 +1359,12 @@ class Menu(Component):
         self.do_clip = True
         self.layout_manager = GridLayoutManager(1)
         self.scroll_timer = None
+        self.virtual = virtual
+        self._offsets = None
+        self._deferred = set()
+        self._window = set()
+        self._estimated_heights = {}
+        self._enabled_range = None
         
     def set_scrollbar(self, scrollbar):
         scrollbar.values_callback = self.get_scroll_values
@@ -936,7 +1373,8 @@ class Menu(Component):
     def select_last_item(self):
         c = self.get_child_count()
         if c > 0:
-            self.set_selected_item(self.get_children()[c - 1])
+            self.i = c - 1
+            self._do_selected()
         
     def set_selected_item(self, item):
         i = self.index_of_child(item)
@@ -970,12 +1408,38 @@ class Menu(Component):
     
     def add_child(self, child, index = -1):
         Component.add_child(self, child, index)
+        if self._offsets is not None and index == -1:
+            self._offsets.append(self._offsets[-1] + ( self._get_virtual_height(child) if child.is_showing() else 0 ))
+        else:
+            self._offsets = None
+        if self._enabled_range is not None and index == -1:
+            if self._is_navigable(child):
+                first = self._enabled_range[0]
+                last = self.get_child_count() - 1
+                self._enabled_range = ( last if first == -1 else first, last )
+        else:
+            self._enabled_range = None
         self.select_first()
         self._recalc_scroll_values()
         self.centre_on_selected()
     
     def remove_child(self, child):
+        index = self._children.index(child) if self.contains_child(child) else -1
         Component.remove_child(self, child)
+        self._deferred.discard(child)
+        self._window.discard(child)
+        if self._offsets is not None:
+            # Close the gap left by the item rather than measuring every item again
+            height = self._offsets[index + 1] - self._offsets[index]
+            del self._offsets[index + 1]
+            if height != 0:
+                self._offsets[index + 1:] = [ y - height for y in self._offsets[index + 1:] ]
+        if self._enabled_range is not None:
+            first, last = self._enabled_range
+            if index == first or index == last:
+                self._enabled_range = None
+            elif first > -1:
+                self._enabled_range = ( first - 1 if index < first else first, last - 1 if index < last else last )
         self.select_first()
         self._recalc_scroll_values()
         self.centre_on_selected()
@@ -983,18 +1447,23 @@ class Menu(Component):
     def set_children(self, children):
         was_selected = self.selected
         Component.set_children(self, children)
-        if was_selected in self.get_children():
+        self._offsets = None
+        self._enabled_range = None
+        if was_selected is not None and self.contains_child(was_selected):
             self.selected = was_selected
         else:
             self.select_first()
         self.centre_on_selected()
             
     def centre_on_selected(self):
-        y = 0
-        c = self.get_children()
-        for r in range(0, self._get_selected_index()):
-            if c[r].is_showing():
-                y += self.get_item_height(c[r], True)
+        if self.virtual:
+            y = self._get_offsets()[max(0, self._get_selected_index())]
+        else:
+            y = 0
+            c = self.get_children()
+            for r in range(0, self._get_selected_index()):
+                if c[r].is_showing():
+                    y += self.get_item_height(c[r], True)
         self.base = max(0, y - ( self.view_bounds[3] / 2 ))
         self._recalc_scroll_values()
         self.get_root().redraw()
@@ -1017,15 +1486,24 @@ class Menu(Component):
             self.select_first()                 
             
             # Get the Y position of the selected item
-            y = 0 
             selected_y = -1
-            for item in self.get_children():
-                # Only include items that are "showing"
-                if item.is_showing():
-                    ih = self.get_item_height(item, True)
-                    if item == self.selected:
-                        selected_y = y
-                    y += ih
+            if self.virtual:
+                if self.selected is not None and self.selected.is_showing():
+                    offsets = self._get_offsets()
+                    selected_index = self._get_selected_index()
+                    selected_y = offsets[selected_index]
+                    selected_height = offsets[selected_index + 1] - selected_y
+            else:
+                y = 0 
+                for item in self.get_children():
+                    # Only include items that are "showing"
+                    if item.is_showing():
+                        ih = self.get_item_height(item, True)
+                        if item == self.selected:
+                            selected_y = y
+                        y += ih
+                if self.selected != None:
+                    selected_height = self.get_item_height(self.selected, True)
                     
             new_base = self.base
                     
@@ -1033,8 +1511,8 @@ class Menu(Component):
             v_space = self.view_bounds[3]
                 
             # If the position of the selected item is offscreen below, change the offset so it is just visible
-            if self.selected != None:
-                ih = self.get_item_height(self.selected, True)
+            if self.selected != None and ( selected_y >= 0 or not self.virtual ):
+                ih = selected_height
                 if selected_y >= new_base + v_space - ih:
                     new_base = ( selected_y + ih ) - v_space
                 # If the position of the selected item is offscreen above base, change the offset so it is just visible
@@ -1067,9 +1545,12 @@ class Menu(Component):
     def get_items_per_page(self):
         self.get_tree_lock().acquire()
         try:
-            total_size = 0
-            for item in self.get_children():
-                total_size += self.get_item_height(item, True)            
+            if self.virtual:
+                total_size = self._get_offsets()[-1]
+            else:
+                total_size = 0
+                for item in self.get_children():
+                    total_size += self.get_item_height(item, True)            
             avg_size = total_size / self.get_child_count()
             return int(self.view_bounds[3] / avg_size)
         finally:
@@ -1121,6 +1602,37 @@ class Menu(Component):
                 
         return False
         
+    def mark_dirty(self):
+        if not self.virtual:
+            Component.mark_dirty(self)
+            return
+        
+        # Items outside of the window are marked dirty as they come into view
+        if self.theme is not None:
+            self.theme.mark_dirty()
+        for c in self._window:
+            c.mark_dirty()
+        
+    def do_scroll(self):
+        if not self.virtual:
+            Component.do_scroll(self)
+            return
+        for c in self._window:
+            c.do_scroll()
+        if self.theme and self.get_allow_scrolling():
+            self.theme.do_scroll()
+    
+    def check_for_scroll(self):
+        if not self.virtual:
+            return Component.check_for_scroll(self)
+        scroll = False
+        for c in self._window:
+            if c.check_for_scroll():
+                scroll = True
+        if self.theme and self.get_allow_scrolling() and self.theme.is_scroll_required():
+            scroll = True
+        return scroll
+        
     def select_first(self):
         self.get_tree_lock().acquire()
         try:
@@ -1144,15 +1656,18 @@ class Menu(Component):
     '''
     
     def _recalc_scroll_values(self):
-        max_val = 0
-        for item in self.get_children():
-            if item.is_showing():
-                max_val += self.get_item_height(item, True)
+        if self.virtual:
+            max_val = self._get_offsets()[-1]
+        else:
+            max_val = 0
+            for item in self.get_children():
+                if item.is_showing():
+                    max_val += self.get_item_height(item, True)
                 
         self.scroll_values = max(max_val, self.view_bounds[3]), self.view_bounds[3], self.base
     
     def _check_selected(self):
-        if not self.selected in self.get_children():
+        if self.selected is None or not self.contains_child(self.selected):
             if self.i >= self.get_child_count():
                 return
             self.selected = self.get_child(self.i)
@@ -1167,12 +1682,99 @@ class Menu(Component):
         self.get_root().redraw()
         
     def _get_selected_index(self):
-        c = self.get_children()
-        if not self.selected in c:
+        c = self._children
+        if self.selected is None or not self.contains_child(self.selected):
             return 0 if len(c) > 0 else -1
+        elif 0 <= self.i < len(c) and c[self.i] is self.selected:
+            return self.i
         else:
             return self.index_of_child(self.selected)
         
+    def _configure_child(self, child):
+        if self.virtual:
+            # Configuring (and so creating the theme for) the item is left until it is near the visible area 
+            if self.contains_child(child):
+                self._offsets = None
+                self._window.discard(child)
+            child.parent = self
+            self._deferred.add(child)
+        else:
+            Component._configure_child(self, child)
+            
+    def _child_showing_changed(self, child):
+        self._offsets = None
+        self._enabled_range = None
+        
+    def _get_height_key(self, item):
+        return ( item.__class__, getattr(item, "group", True) )
+            
+    def _get_virtual_height(self, item):
+        if item in self._deferred:
+            return self._estimated_heights.get(self._get_height_key(item), 10)
+        return self.get_item_height(item, True)
+    
+    def _get_offsets(self):
+        """
+        Get the Y position of every item, plus the total height of the items at
+        the end.  
+        """
+        if self._offsets is None:
+            offsets = [ 0 ]
+            y = 0
+            for item in self._children:
+                if item.is_showing():
+                    y += self._get_virtual_height(item)
+                offsets.append(y)
+            self._offsets = offsets
+        return self._offsets
+    
+    def _get_window(self, overscan = 0):
+        offsets = self._get_offsets()
+        first = max(0, bisect.bisect_right(offsets, self.base) - 1 - overscan)
+        last = min(len(self._children), bisect.bisect_left(offsets, self.base + self.view_bounds[3]) + overscan)
+        return first, last
+    
+    def _configure_deferred(self, item):
+        self._deferred.discard(item)
+        key = self._get_height_key(item)
+        estimated_height = self._estimated_heights.get(key, 10)
+        Component._configure_child(self, item)
+        height = self.get_item_height(item, True)
+        self._estimated_heights[key] = height
+        if height != estimated_height and item.is_showing():
+            self._offsets = None
+    
+    def _paint_children(self, canvas):
+        if not self.virtual:
+            Component._paint_children(self, canvas)
+            return
+        
+        # Configure the items about to be shown. Their actual heights may differ
+        # from the estimates, which changes the window, so repeat until settled
+        while True:
+            first, last = self._get_window(MENU_OVERSCAN)
+            deferred = [ c for c in self._children[first:last] if c in self._deferred ]
+            if len(deferred) == 0:
+                break
+            for c in deferred:
+                self._configure_deferred(c)
+            self._recalc_scroll_values()
+        
+        offsets = self._get_offsets()
+        first, last = self._get_window()
+        window = set()
+        for i in range(first, last):
+            c = self._children[i]
+            if c.is_showing() and c.view_bounds is not None:
+                if not c in self._window:
+                    c.mark_dirty()
+                c.view_bounds = ( 0, offsets[i], c.view_bounds[2], c.view_bounds[3] )
+                canvas.save()
+                c.paint(canvas)
+                canvas.restore()
+                window.add(c)
+        self._window = window
+        
     def _move_up(self, amount = 1):
         self.get_tree_lock().acquire()
         try:
@@ -1199,8 +1801,7 @@ class Menu(Component):
                                     return
                                 else:
                                     self.i = first_enabled
-                            c = self.get_child(self.i)
-                            if not isinstance(c, MenuSeparator) and c.is_enabled() and c.is_showing() and c.activatable:
+                            if self._is_navigable(self.get_child(self.i)):
                                 break
             finally:
                 self._do_selected()
@@ -1208,18 +1809,36 @@ class Menu(Component):
             self.get_tree_lock().release()
             
     def _get_first_enabled(self):
-        for ci in range(0, self.get_child_count()):
-            c = self.get_child(ci)
-            if not isinstance(c, MenuSeparator) and c.is_enabled() and c.is_showing() and c.activatable:
-                return ci
-        return -1
+        return self._get_enabled_range()[0]
             
     def _get_last_enabled(self):
-        for ci in range(self.get_child_count() - 1, 0, -1):
-            c = self.get_child(ci)
-            if not isinstance(c, MenuSeparator) and c.is_enabled() and c.is_showing() and c.activatable:
-                return ci
-        return -1
+        return self._get_enabled_range()[1]
+    
+    def _get_enabled_range(self):
+        """
+        Get the indexes of the first and last items that may be selected, or
+        -1 for both if there are none. These are kept until items are added
+        or removed, or an item at either end can no longer be selected.
+        """
+        if self._enabled_range is not None:
+            first, last = self._enabled_range
+            if first > -1 and self._is_navigable(self._children[first]) and self._is_navigable(self._children[last]):
+                return self._enabled_range
+        first = last = -1
+        for ci in range(0, len(self._children)):
+            if self._is_navigable(self._children[ci]):
+                first = ci
+                break
+        if first > -1:
+            for ci in range(len(self._children) - 1, first - 1, -1):
+                if self._is_navigable(self._children[ci]):
+                    last = ci
+                    break
+        self._enabled_range = ( first, last )
+        return self._enabled_range
+    
+    def _is_navigable(self, item):
+        return not isinstance(item, MenuSeparator) and item.is_enabled() and item.is_showing() and item.activatable
                 
             
     def _move_down(self, amount = 1):
@@ -1250,8 +1869,7 @@ class Menu(Component):
                                     return
                                 else:
                                     self.i = self._get_last_enabled()
-                            c = self.get_child(self.i)
-                            if not isinstance(c, MenuSeparator) and c.is_enabled() and c.is_showing() and c.activatable:
+                            if self._is_navigable(self.get_child(self.i)):
                                 break
             finally:
                 self._do_selected()
@@ -1445,6 +2063,7 @@ class G15Theme(object):
         else:
             self.dir = None
         self.document = None       
+        self.shared_document = False
         self.variant = variant
         self.page = None
         self.instance = None
@@ -1457,6 +2076,7 @@ class G15Theme(object):
         self.component = None
         self.auto_dirty = auto_dirty
         self.render = None
+        self.compiled = None
         self.scroll_state = {}
         self.nsmap = {
             'sodipodi': 'http://sodipodi.sourceforge.net/DTD/sodipodi-0.dtd',
@@ -1490,6 +2110,7 @@ class G15Theme(object):
                 
             
             self.component = component
+            self.compiled = None
             page = component.get_root() if component is not None else None
             
             if self.page is not None:
@@ -1518,7 +2139,7 @@ class G15Theme(object):
                     module_name = self.get_path_for_variant(self.dir, self.variant, "py", fatal = False, prefix = prefix_path)
                     module = None
                     if module_name != None:
-                        if not dir in sys.path:
+                        if not self.dir in sys.path:
                             sys.path.insert(0, self.dir)
                         module = __import__(os.path.basename(module_name)[:-3])
                         self.instance = module
@@ -1529,28 +2150,53 @@ class G15Theme(object):
                     actual_variant = os.path.splitext(os.path.basename(path))[0]
                     self.translation = g15locale.get_translation(actual_variant, self.dir)
                     
-                    self.document = etree.parse(path)
-                    
-                        
-                    # Give the python portion of the theme chance to initialize
+                    # Give the python portion of the theme chance to initialize. As it
+                    # may change the document, such themes get their own copy
                     if self.instance is not None and hasattr(self.instance, 'create'):
+                        self.document = etree.parse(path)
+                        self.shared_document = False
                         try:
                             self.instance.create(self)
                         except Exception as e:
                             logger.debug("Error creating instance", exc_info = e)
+                        self.process_svg()
+                    else:
+                        key = ( self.dir, self.variant, self.driver.get_model_name(),
+                                self.driver.__class__.__name__,
+                                self.screen.service.disable_svg_glow )
+                        self.document = document_store.get(key, path, lambda: self._load_document(path))
+                        self.shared_document = True
                             
                 elif self.svg_text != None:
                     self.document = etree.ElementTree(etree.fromstring(self.svg_text))
+                    self.shared_document = False
+                    self.process_svg()
                 else:
                     raise Exception("Must either supply theme directory or SVG text")
                     
-                self.process_svg()
                 self.bounds = g15svg.get_bounds(self.document.getroot())
+                self.compiled = CompiledTheme(self)
         finally:
             self.render_lock.release()
         
+    def get_writable_document(self):
+        """
+        Get a document this theme instance may change. If the current document
+        is shared with other instances, a private copy is taken first.
+        """
+        if self.shared_document:
+            self.document = deepcopy(self.document)
+            self.shared_document = False
+        return self.document
+        
+    def _load_document(self, path):
+        self.document = etree.parse(path)
+        self.shared_document = False
+        self.process_svg()
+        return self.document
+        
     def process_svg(self):        
-        self.driver.process_svg(self.document)
+        self.driver.process_svg(self.get_writable_document())
         root = self.document.getroot()
         
         # Remove glow effects
@@ -1572,7 +2218,7 @@ class G15Theme(object):
                 
         
     def del_namespace(self, prefix, uri):
-        for e in self.document.getroot().xpath("//*[namespace-uri()='%s' or @*[namespace-uri()='%s']]" % ( uri, uri ) ,namespaces=self.nsmap):
+        for e in self.get_writable_document().getroot().xpath("//*[namespace-uri()='%s' or @*[namespace-uri()='%s']]" % ( uri, uri ) ,namespaces=self.nsmap):
             attr = e.attrib
             for k in list(attr.keys()):
                 if k.startswith("{%s}" % uri):
@@ -1687,6 +2333,13 @@ class G15Theme(object):
         self.dirty = True
             
     def draw(self, canvas, properties = {}, attributes = {}):
+        cache_key = self._get_cache_key(canvas, properties)
+        if cache_key is not None:
+            surface = render_cache.get(cache_key)
+            if surface is not None:
+                self._paint_surface(canvas, surface)
+                return self.render.document if self.render is not None else None
+        
         if self.render != None and self.auto_dirty:
             if self.render.properties != properties or self.render.attributes != attributes or \
                self.render.properties.values() != properties.values() or self.render.attributes.values() != attributes.values():
@@ -1701,55 +2354,37 @@ class G15Theme(object):
             self.text.set_canvas(canvas)
             
             try:
-                document = deepcopy(self.document)
-                processing_result = None
-                
                 # Give the python portion of the theme chance to draw stuff under the SVG
                 if self.instance is not None and hasattr(self.instance, 'paint_background'):
                     try:
                         self.instance.paint_background(properties, attributes)
                     except Exception as e:
                         logger.debug("Error painting background", exc_info = e)
-                    
-                root = document.getroot()
-                         
-                # Process the SVG         
-                self._process_deletes(root, properties)
-                self._process_components(root)
-                self._set_progress_bars(root, properties) 
-                self._set_relative_image_paths(root)
-                self._convert_image_urls(root, properties)
-                self._do_shadow("shadow", self.screen.driver.get_color_as_hexrgb(g15driver.HINT_BACKGROUND, (255, 255,255)), root)
-                self._do_shadow("reverseshadow", self.screen.driver.get_color_as_hexrgb(g15driver.HINT_FOREGROUND, (0, 0, 0)), root)
-                self._set_highlight_color(root)
-                
-                text_boxes = []
-                self._handle_text_boxes(root, text_boxes, properties, canvas)        
-                    
-                # Pass the SVG document to the SVG processor if there is one
-                if self.svg_processor != None:
-                    self.svg_processor(document, properties, attributes)
-                
-                # Pass the SVG document to the theme's python code to manipulate the document if required
-                if self.instance is not None and hasattr(self.instance, 'process_svg'):
-                    try:
-                        processing_result = self.instance.process_svg(self.driver,
-                                                                      root,
-                                                                      properties,
-                                                                      self.nsmap)
-                    except Exception as e:
-                        logger.debug("Error processing SVG", exc_info = e)
-                    
-                self._set_default_style(root)
-                    
-                self.render = Render(document, properties, text_boxes, attributes, processing_result)
+
+                if COMPILE_THEMES and self.compiled is not None and self.compiled.is_supported():
+                    self.render = self._draw_compiled(properties, attributes)
+                else:
+                    self.render = self._draw_document(canvas, properties, attributes)
                 self.dirty = False
             finally:
                 self.render_lock.release()
         else:
             self.text.set_canvas(canvas)
             
-        self._render_document(canvas, self.render)
+        if cache_key is None or len(self.scroll_state) > 0 or not render_cache.is_cacheable(cache_key[0], cache_key[1]):
+            self._render_document(canvas, self.render)
+        else:
+            # Render straight into the surface that is cached, so it can be re-used while the properties are the same 
+            surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, cache_key[0], cache_key[1])
+            surface_canvas = cairo.Context(surface)
+            self.screen.configure_canvas(surface_canvas)
+            self.text.set_canvas(surface_canvas)
+            try:
+                self._render_document(surface_canvas, self.render)
+            finally:
+                self.text.set_canvas(canvas)
+            render_cache.put(cache_key, surface)
+            self._paint_surface(canvas, surface)
         return self.render.document
             
     def is_scroll_required(self):
@@ -1769,6 +2404,165 @@ class G15Theme(object):
     Private
     """
     
+    def _get_cache_key(self, canvas, properties):
+        """
+        Get the key a rasterised render of the given properties would be stored
+        under in the render cache, or None if the render may not be cached. Only
+        themes that are a product of their properties alone may be cached, i.e.
+        those that are compiled, have no python code that paints and are not
+        currently scrolling text.
+        
+        Keyword arguments:
+        canvas      -- canvas being drawn on
+        properties  -- theme properties
+        """
+        if self.document is None or self.compiled is None or len(self.scroll_state) > 0 or \
+                not self.compiled.is_supported():
+            return None
+        if self.instance is not None and ( hasattr(self.instance, 'paint_background') or \
+                                           hasattr(self.instance, 'paint_foreground') ):
+            return None
+        
+        # The render is painted at device pixel positions, so it must not be scaled 
+        xx, yx, xy, yy, x0, y0 = canvas.get_matrix()
+        if xx != 1 or yy != 1 or xy != 0 or yx != 0 or x0 != int(x0) or y0 != int(y0):
+            return None
+        width = int(math.ceil(self.bounds[0] + self.bounds[2]))
+        height = int(math.ceil(self.bounds[1] + self.bounds[3]))
+        if width < 1 or height < 1:
+            return None
+        
+        items = []
+        for key, value in properties.items():
+            if not isinstance(value, CACHEABLE_TYPES):
+                return None
+            if isinstance(value, basestring) and ( value.startswith("/") or value.startswith("file:") ):
+                # Image files may be rewritten under the same name
+                value = ( value, self._get_mtime(value[5:] if value.startswith("file:") else value) )
+            items.append(( key, value ))
+        
+        controls = []
+        for control in self.driver.get_controls() or []:
+            if control.hint & ( g15driver.HINT_FOREGROUND | g15driver.HINT_BACKGROUND | g15driver.HINT_HIGHLIGHT ):
+                controls.append(( control.id, tuple(control.value) if isinstance(control.value, list) else control.value ))
+        
+        return ( width, height,
+                 self.dir if self.dir is not None else self.svg_text,
+                 self.variant,
+                 self.driver.get_model_name(),
+                 self.driver.__class__.__name__,
+                 self.screen.service.disable_svg_glow,
+                 tuple(controls),
+                 tuple(sorted(self.component.child_map.keys())) if self.component else (),
+                 frozenset(items) )
+        
+    def _get_mtime(self, path):
+        try:
+            return os.path.getmtime(path)
+        except OSError:
+            return None
+        
+    def _paint_surface(self, canvas, surface):
+        canvas.save()
+        canvas.set_source_surface(surface, 0, 0)
+        canvas.paint()
+        canvas.restore()
+        
+    def _draw_document(self, canvas, properties, attributes):
+        """
+        Process a complete copy of the theme document for the given properties.
+        
+        Keyword arguments:
+        canvas      -- canvas being drawn on
+        properties  -- theme properties
+        attributes  -- theme attributes
+        """
+        document = deepcopy(self.document)
+        processing_result = None
+        root = document.getroot()
+                 
+        # Process the SVG         
+        self._process_deletes(root, properties)
+        self._process_components(root)
+        self._set_progress_bars(root, properties) 
+        self._set_relative_image_paths(root)
+        self._convert_image_urls(root, properties)
+        self._do_shadow("shadow", self.screen.driver.get_color_as_hexrgb(g15driver.HINT_BACKGROUND, (255, 255,255)), root)
+        self._do_shadow("reverseshadow", self.screen.driver.get_color_as_hexrgb(g15driver.HINT_FOREGROUND, (0, 0, 0)), root)
+        self._set_highlight_color(root)
+        
+        text_boxes = []
+        self._handle_text_boxes(root, text_boxes, properties, canvas)        
+            
+        # Pass the SVG document to the SVG processor if there is one
+        if self.svg_processor != None:
+            self.svg_processor(document, properties, attributes)
+        
+        # Pass the SVG document to the theme's python code to manipulate the document if required
+        if self.instance is not None and hasattr(self.instance, 'process_svg'):
+            try:
+                processing_result = self.instance.process_svg(self.driver,
+                                                              root,
+                                                              properties,
+                                                              self.nsmap)
+            except Exception as e:
+                logger.debug("Error processing SVG", exc_info = e)
+            
+        self._set_default_style(root)
+            
+        return Render(document, properties, text_boxes, attributes, processing_result)
+
+    def _draw_compiled(self, properties, attributes):
+        """
+        Patch the property dependent nodes of a prepared copy of the theme document
+        for the given properties.
+
+        Keyword arguments:
+        properties  -- theme properties
+        attributes  -- theme attributes
+        """
+        prepared = self.compiled.get_prepared(properties)
+
+        for element, property_key, width, full_width in prepared.progress_bars:
+            if property_key in properties:
+                value = float(properties[property_key])
+                if value == 0:
+                    value = 0.1
+                element.set("width", str(int((full_width / 100.0) * value)))
+            elif width is not None:
+                element.set("width", width)
+
+        for element, id, href in prepared.images:
+            if id in properties and properties[id] != None:
+                element.set("{http://www.w3.org/1999/xlink}href", self._get_image_url(properties[id]))
+            elif href is not None:
+                element.set("{http://www.w3.org/1999/xlink}href", href)
+
+        text_boxes = []
+        for clipped in prepared.clipped_text:
+            clipped.restore()
+            text_box = TextBox()
+            text_box.text = Template(clipped.text).safe_substitute(properties)
+            text_box.css = clipped.css
+            text_box.normal_shadow = clipped.normal_shadow
+            text_box.reverse_shadow = clipped.reverse_shadow
+            text_box.clip = clipped.clip
+            self._update_text(text_box, clipped.vertical_wrap)
+            tx, ty, text_width, text_height = self.text.measure()
+            text_box.bounds = ( clipped.bounds[0], clipped.bounds[1], text_width, text_height )
+            self._scroll_text_boxes(clipped.vertical_wrap, text_box, text_boxes, clipped.t_span_node, clipped.element, remove_wrapped = False)
+
+        for id, css, bounds in prepared.text_boxes:
+            text_box = TextBox()
+            text_box.text = properties[id]
+            text_box.css = css
+            text_box.wrap = True
+            text_box.bounds = bounds
+            text_box.clip = bounds
+            text_boxes.append(text_box)
+
+        return Render(prepared.document, properties, text_boxes, attributes, None)
+
     def _process_components(self, root):
         """
         Find all elements that are associated with child components in the component this
@@ -1872,21 +2666,30 @@ class G15Theme(object):
         for element in root.xpath('//svg:image',namespaces=self.nsmap):
             id = element.get("title")
             if id != None and id in properties and properties[id] != None:
-                file_str = StringIO()
-                val = properties[id]
-                if isinstance(val, str) and str(val).startswith("file:"):
-                    file_str.write(val[5:])
-                elif isinstance(val, str) and str(val).startswith("/"):
-                    file_str.write(val)
-                else:
-                    file_str.write("data:image/png;base64,")
-                    img_data = StringIO()
-                    if isinstance(val, cairo.Surface):
-                        val.write_to_png(img_data)
-                        file_str.write(base64.b64encode(img_data.getvalue()))
-                    else: 
-                        file_str.write(val)
-                element.set("{http://www.w3.org/1999/xlink}href", file_str.getvalue())
+                element.set("{http://www.w3.org/1999/xlink}href", self._get_image_url(properties[id]))
+                
+    def _get_image_url(self, val):
+        """
+        Get either a local file URL or an embedded image URL for an image property
+        value.
+        
+        Keyword arguments:
+        val         -- file path, URL or cairo surface
+        """
+        file_str = StringIO()
+        if isinstance(val, str) and str(val).startswith("file:"):
+            file_str.write(val[5:])
+        elif isinstance(val, str) and str(val).startswith("/"):
+            file_str.write(val)
+        else:
+            file_str.write("data:image/png;base64,")
+            img_data = StringIO()
+            if isinstance(val, cairo.Surface):
+                val.write_to_png(img_data)
+                file_str.write(base64.b64encode(img_data.getvalue()))
+            else: 
+                file_str.write(val)
+        return file_str.getvalue()
     
     def _set_default_style(self, root):        
         """
@@ -1980,7 +2783,7 @@ class G15Theme(object):
                 text_node.getparent().remove(text_node)
                 element.getparent().remove(element)
                 
-    def _scroll_text_boxes(self, vertical_wrap, text_box, text_boxes, t_span_node, element):        
+    def _scroll_text_boxes(self, vertical_wrap, text_box, text_boxes, t_span_node, element, remove_wrapped = True):        
         id = element.get("id")
         text_height = text_box.bounds[3]
         text_width =  text_box.bounds[2]
@@ -2005,7 +2808,8 @@ class G15Theme(object):
             elif id in self.scroll_state:
                 del self.scroll_state[id]
                 
-            element.getparent().remove(element)
+            if remove_wrapped:
+                element.getparent().remove(element)
         else:
 #            text_boxes.append(text_box)
             
@@ -25,50 +25,273 @@ This class is stop gap until a better solution can be found
 
 import os
 import time
+import random
+import shutil
+import tempfile
+from collections import deque
+from threading import RLock
 
-class CPU():
-    def __init__(self, name):
-        self.name = name
-        self.user = 0
-        self.nice = 0
-        self.sys = 0
-        self.idle = 0
+"""
+Minimum number of seconds between reads of the same /proc source. Callers asking
+more often than this all share the same sample
+"""
+TICK = 0.5
 
-class CPUS(CPU):
-    def __init__(self):
-        CPU.__init__(self, "CPUS")
-        cpudata = open('/proc/stat')
-        self.cpus = []
+"""
+Number of samples of CPU times and network counters kept for calculating rates
+"""
+HISTORY = 60
+
+"""
+Number of known processes whose start time is read again on each refresh of a
+ProcessTable, in rotation, to find process IDs that have been reused
+"""
+VERIFY_BATCH = 64
+
+class ProcFile():
+    """
+    A file in /proc that is kept open and read again from the start for
+    each sample, rather than opened and closed every time.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+        
+    def read(self):
+        for attempt in range(0, 2):
+            try:
+                if self.fd is None:
+                    self.fd = os.open(self.path, os.O_RDONLY)
+                os.lseek(self.fd, 0, os.SEEK_SET)
+                chunks = []
+                while True:
+                    chunk = os.read(self.fd, 8192)
+                    if not chunk:
+                        return "".join(chunks)
+                    chunks.append(chunk)
+            except OSError:
+                self.close()
+                if attempt == 1:
+                    raise
+            
+    def close(self):
+        if self.fd is not None:
+            try:
+                os.close(self.fd)
+            except OSError:
+                pass
+            self.fd = None
+
+def _parse_stat(data):
+    # List of ( name, user, nice, sys, idle )
+    cpus = []
+    for line in data.splitlines():
+        if line.startswith("cpu"):
+            vals = line.split(None, 5)
+            cpus.append(( vals[0], int(vals[1]), int(vals[2]), int(vals[3]), int(vals[4]) ))
+    return cpus
+
+def _parse_meminfo(data):
+    # ( total, free, cached )
+    vals = {}
+    for line in data.splitlines():
+        if line.startswith("MemTotal:") or line.startswith("MemFree:") or line.startswith("Cached:"):
+            key, val = line.split(":", 1)
+            vals[key] = int(val.split()[0]) * 1024
+    return ( vals.get("MemTotal", 0), vals.get("MemFree", 0), vals.get("Cached", 0) )
+
+def _parse_net_dev(data):
+    # List of ( interface name, bytes in, bytes out )
+    nets = []
+    for line in data.splitlines()[2:]:
+        if ":" in line:
+            name, vals = line.split(":", 1)
+            vals = vals.split()
+            nets.append(( name.strip(), int(vals[0]), int(vals[8]) ))
+    return nets
+
+def _parse_uptime(data):
+    vals = data.split()
+    return ( float(vals[0]), float(vals[1]) )
+
+class Sampler():
+    """
+    Reads /proc sources on behalf of all consumers. Each source is read at most
+    once every TICK seconds, everyone else gets the same parsed sample. The most
+    recent samples of CPU times and network counters are kept so that usage and
+    transfer rates may be calculated without each consumer tracking them.
+    """
+    
+    def __init__(self, tick = TICK, history = HISTORY):
+        self.tick = tick
+        self.lock = RLock()
+        self.sources = {
+            "stat" : ( ProcFile("/proc/stat"), _parse_stat ),
+            "meminfo" : ( ProcFile("/proc/meminfo"), _parse_meminfo ),
+            "net" : ( ProcFile("/proc/net/dev"), _parse_net_dev ),
+            "uptime" : ( ProcFile("/proc/uptime"), _parse_uptime )
+            }
+        self.samples = {}
+        self.proc_states = {}
+        self.history = {
+            "stat" : deque(maxlen = history),
+            "net" : deque(maxlen = history)
+            }
+        
+    def get(self, source):
+        """
+        Get the most recent parsed sample of a source, reading it again if it
+        is older than the tick.
+        
+        Keyword arguments:
+        source        -- one of "stat", "meminfo", "net", "uptime" or "pids"
+        """
+        self.lock.acquire()
         try:
-            for line in cpudata:
-                if line.startswith("cpu"):
-                    (name, cuse, cn, csys, idle, tail) = line.split(None, 5)
-                    cpu = self if name == "cpu" else CPU(name)
-                    self.user = int(cuse)
-                    self.nice = int(cn)
-                    self.sys = int(csys)
-                    self.idle = int(idle)
-                    self.cpus.append(cpu)
+            now = time.time()
+            sample = self.samples.get(source)
+            if sample is not None and now - sample[0] < self.tick and now >= sample[0]:
+                return sample[1]
+            if source == "pids":
+                value = [ int(d) for d in os.listdir("/proc") if d.isdigit() ]
+            else:
+                proc_file, parse = self.sources[source]
+                value = parse(proc_file.read())
+            self.samples[source] = ( now, value )
+            if source in self.history:
+                self.history[source].append(( now, value ))
+            return value
         finally:
-            cpudata.close()
+            self.lock.release()
             
-class ProcState():
-    
-    def __init__(self, pid):
-        self.uid = 0
-        self.cmd = ""
+    def get_proc_state(self, pid):
+        """
+        Get a tuple of ( uid, name ) for a process, reading its status at most
+        once a tick.
+        
+        Keyword arguments:
+        pid        --    process ID
+        """
+        self.lock.acquire()
+        try:
+            now = time.time()
+            sample = self.proc_states.get(pid)
+            if sample is not None and now - sample[0] < self.tick and now >= sample[0]:
+                return sample[1]
+            if len(self.proc_states) > 4096:
+                self.proc_states = {}
+        finally:
+            self.lock.release()
+            
+        uid = 0
+        cmd = ""
         memdata = open('/proc/%d/status' % pid)
         try:
             for line in memdata:
                 if line.startswith("Uid:"):
-                    self.uid = int(self._get_value(line)[0])
+                    uid = int(line[line.index(':') + 1:].split()[0])
                 elif line.startswith("Name:"):
-                    self.cmd = self._get_value(line)[0]
+                    cmd = line[line.index(':') + 1:].strip()
         finally:
             memdata.close()
             
-    def _get_value(self, line):
-        return line[line.index(':') + 1:].strip().split()
+        self.lock.acquire()
+        try:
+            self.proc_states[pid] = ( now, ( uid, cmd ) )
+        finally:
+            self.lock.release()
+        return ( uid, cmd )
+            
+    def get_history(self, source):
+        """
+        Get a list of the recent ( time, sample ) tuples of either the "stat" or
+        "net" source, oldest first.
+        
+        Keyword arguments:
+        source        -- "stat" or "net"
+        """
+        self.lock.acquire()
+        try:
+            return list(self.history[source])
+        finally:
+            self.lock.release()
+            
+    def get_cpu_usage(self):
+        """
+        Get a dictionary of the fraction (0.0 to 1.0) of time each CPU ("cpu" being
+        all of them) was busy between the last two samples.
+        """
+        self.get("stat")
+        history = self.get_history("stat")
+        usage = {}
+        if len(history) > 1:
+            previous = dict([ ( cpu[0], cpu ) for cpu in history[-2][1] ])
+            for cpu in history[-1][1]:
+                last = previous.get(cpu[0])
+                if last is not None:
+                    busy = ( cpu[1] - last[1] ) + ( cpu[2] - last[2] ) + ( cpu[3] - last[3] )
+                    total = busy + ( cpu[4] - last[4] )
+                    usage[cpu[0]] = float(busy) / total if total > 0 else 0.0
+        return usage
+    
+    def get_net_rates(self):
+        """
+        Get a dictionary of ( bytes in per second, bytes out per second ) for
+        each network interface, between the last two samples.
+        """
+        self.get("net")
+        history = self.get_history("net")
+        rates = {}
+        if len(history) > 1:
+            ( then, previous ), ( now, current ) = history[-2], history[-1]
+            previous = dict([ ( net[0], net ) for net in previous ])
+            elapsed = now - then
+            for net in current:
+                last = previous.get(net[0])
+                if last is not None and elapsed > 0:
+                    rates[net[0]] = ( max(0, net[1] - last[1]) / elapsed, max(0, net[2] - last[2]) / elapsed )
+        return rates
+    
+    def close(self):
+        self.lock.acquire()
+        try:
+            for proc_file, parse in self.sources.values():
+                proc_file.close()
+        finally:
+            self.lock.release()
+            
+"""
+Shared sampler used by all of the module functions
+"""
+sampler = Sampler()
+
+class CPU():
+    def __init__(self, name, user = 0, nice = 0, sys = 0, idle = 0):
+        self.name = name
+        self.user = user
+        self.nice = nice
+        self.sys = sys
+        self.idle = idle
+
+class CPUS(CPU):
+    def __init__(self):
+        CPU.__init__(self, "CPUS")
+        self.cpus = []
+        for name, user, nice, sys, idle in sampler.get("stat"):
+            if name == "cpu":
+                self.user = user
+                self.nice = nice
+                self.sys = sys
+                self.idle = idle
+                self.cpus.append(self)
+            else:
+                self.cpus.append(CPU(name, user, nice, sys, idle))
+            
+class ProcState():
+    
+    def __init__(self, pid):
+        self.uid, self.cmd = sampler.get_proc_state(pid)
             
 class NetworkLoad():
     
@@ -80,23 +303,7 @@ class NetworkLoad():
 class Mem():
     
     def __init__(self):
-        self.total = 0
-        self.free = 0
-        self.cached = 0
-        memdata = open('/proc/meminfo')
-        try:
-            for line in memdata:
-                if line.startswith("MemTotal"):
-                    self.total = self._get_value(line)
-                elif line.startswith("MemFree"):
-                    self.free = self._get_value(line)
-                elif line.startswith("Cached"):
-                    self.cached = self._get_value(line)
-        finally:
-            memdata.close()
-            
-    def _get_value(self, line):
-        return int(line[line.index(':') + 1:line.index('kB')]) * 1024
+        self.total, self.free, self.cached = sampler.get("meminfo")
             
 def netload(net):
     """
@@ -106,32 +313,29 @@ def netload(net):
     Keyword arguments:
     net        --    network interface name
     """
-    prefix = '%6s:' % net
-    netdata = open('/proc/net/dev')
-    try:
-        for line in netdata:
-            if line.startswith(prefix):
-                data = line[line.index(':') + 1:].split()
-                return NetworkLoad(net, int(data[0]), int(data[8]))
-    finally:
-        netdata.close()
-    
+    for name, bytes_in, bytes_out in sampler.get("net"):
+        if name == net:
+            return NetworkLoad(net, bytes_in, bytes_out)
             
 def netlist():
     """
     Returns a list of Net objects, one for each available network interface 
     """
-    nets = []
-    f = open("/proc/net/dev", "r")
-    tmp = f.readlines(2000)
-    f.close()
-    for line in tmp:
-        line = line.strip()
-        line = line.split(' ')
-        if len(line) > 0 and line[0].endswith(":"):
-            nets.append(line[0][:-1])
-            
-    return nets
+    return [ net[0] for net in sampler.get("net") ]
+
+def net_rates():
+    """
+    Returns a dictionary of ( bytes in per second, bytes out per second ) for
+    each network interface 
+    """
+    return sampler.get_net_rates()
+
+def cpu_usage():
+    """
+    Returns a dictionary of the fraction of time each CPU was busy recently, 
+    with "cpu" being the total of all CPUs
+    """
+    return sampler.get_cpu_usage()
     
 def cpu():
     """
@@ -149,14 +353,7 @@ def proclist():
     """
     Get a list of all process IDs
     """
-    n = []
-    for d in os.listdir("/proc"):
-        if os.path.isdir("/proc/%s" % d):
-            try:
-                n.append(int(d))
-            except ValueError:
-                pass
-    return n
+    return list(sampler.get("pids"))
 
 def proc_state(pid):
     """
@@ -167,6 +364,27 @@ def proc_state(pid):
     """
     return ProcState(pid)
 
+def proc_start_time(pid, root = "/proc"):
+    """
+    Get the time a process started, in clock ticks after boot, or None if
+    there is no such process. Together with the process ID this identifies
+    a process, as process IDs are eventually reused.
+    
+    Keyword arguments:
+    pid        --    process ID
+    root       --    location of the proc filesystem
+    """
+    try:
+        f = open(os.path.join(root, str(pid), "stat"))
+        try:
+            data = f.read()
+        finally:
+            f.close()
+    except (IOError, OSError):
+        return None
+    # The name may contain spaces and brackets, so start after the last one
+    return int(data[data.rindex(")") + 2:].split()[19])
+
 def proc_args(pid):
     """
     Get the arguments used to launch a process
@@ -191,14 +409,220 @@ def uptime():
     """
     Get the uptime of the computer
     """
-    cmddata = open('/proc/uptime')
-    try:
-        for line in cmddata:
-            vals = line.strip('\n').split(' ')
-    finally:
-        cmddata.close()
+    uptime, idletime = sampler.get("uptime")
+    return Uptime(uptime, idletime)
 
-    return Uptime(float(vals[0]), float(vals[1]))
+class Process():
+    """
+    The details of a process that are read once, when it is first seen. The
+    uid may change if the process changes its credentials, but it is not worth
+    reading it again for every process on every refresh.
+    """
+    
+    def __init__(self, pid, start_time, uid, name, args):
+        self.pid = pid
+        self.start_time = start_time
+        self.uid = uid
+        self.name = name
+        self.args = args
+        
+    def get_key(self):
+        """
+        Get the key that uniquely identifies this process, taking into
+        account that process IDs are eventually reused.
+        """
+        return ( self.pid, self.start_time )
+        
+class ProcessTable():
+    """
+    A table of running processes that is brought up to date incrementally.
+    Each refresh lists the process directories, and only reads the processes
+    that have appeared since the last refresh. The processes that have 
+    appeared and disappeared are returned so consumers may apply just the
+    changes.
+    
+    Processes are keyed by their process ID and start time. A process ID
+    that is reused between refreshes is seen as one process exiting and
+    another starting once the start time of the process ID is read again.
+    That happens for a rotating batch of the known processes on each refresh,
+    or for all of them if verify is set.
+    """
+    
+    def __init__(self, root = "/proc", verify = False, verify_batch = VERIFY_BATCH):
+        """
+        Create a new process table.
+        
+        Keyword arguments:
+        root         -- location of the proc filesystem
+        verify       -- if True, the start time of every known process is read again
+                        on each refresh
+        verify_batch -- otherwise, the number of known processes whose start time is
+                        read again on each refresh
+        """
+        self.root = root
+        self.verify = verify
+        self.verify_batch = verify_batch
+        self.lock = RLock()
+        self.processes = {}
+        self._pids = {}
+        self._verify_queue = deque()
+        
+    def refresh(self):
+        """
+        Bring the table up to date, returning a tuple of the lists of
+        Process objects that have been added and removed since the last
+        refresh.
+        """
+        pids = set([ int(d) for d in os.listdir(self.root) if d.isdigit() ])
+        self.lock.acquire()
+        try:
+            removed = [ self._remove(pid) for pid in set(self._pids.keys()) - pids ]
+            new_pids = pids - set(self._pids.keys())
+            for pid in self._get_pids_to_verify():
+                if proc_start_time(pid, self.root) != self._pids[pid][1]:
+                    removed.append(self._remove(pid))
+                    new_pids.add(pid)
+            added = []
+            for pid in new_pids:
+                process = self._read_process(pid)
+                if process is not None:
+                    key = process.get_key()
+                    self.processes[key] = process
+                    self._pids[pid] = key
+                    added.append(process)
+            return added, removed
+        finally:
+            self.lock.release()
+            
+    def get_processes(self):
+        """
+        Get a list of all the processes currently in the table
+        """
+        self.lock.acquire()
+        try:
+            return list(self.processes.values())
+        finally:
+            self.lock.release()
+            
+    def get_process(self, pid):
+        """
+        Get the process with the given ID, or None if it is not in the table.
+        
+        Keyword arguments:
+        pid        --    process ID
+        """
+        self.lock.acquire()
+        try:
+            key = self._pids.get(pid)
+            return self.processes.get(key) if key is not None else None
+        finally:
+            self.lock.release()
+            
+    def _remove(self, pid):
+        return self.processes.pop(self._pids.pop(pid))
+    
+    def _get_pids_to_verify(self):
+        if self.verify:
+            return list(self._pids.keys())
+        if len(self._verify_queue) == 0:
+            # Start the next round
+            self._verify_queue.extend(sorted(self._pids.keys()))
+        pids = []
+        while len(pids) < self.verify_batch and len(self._verify_queue) > 0:
+            pid = self._verify_queue.popleft()
+            if pid in self._pids:
+                pids.append(pid)
+        return pids
+    
+    def _read_process(self, pid):
+        try:
+            start_time = proc_start_time(pid, self.root)
+            if start_time is None:
+                return None
+            uid = 0
+            name = ""
+            f = open(os.path.join(self.root, str(pid), "status"))
+            try:
+                for line in f:
+                    if line.startswith("Uid:"):
+                        uid = int(line[line.index(':') + 1:].split()[0])
+                    elif line.startswith("Name:"):
+                        name = line[line.index(':') + 1:].strip()
+            finally:
+                f.close()
+            f = open(os.path.join(self.root, str(pid), "cmdline"))
+            try:
+                cmdline = f.read()
+            finally:
+                f.close()
+        except (IOError, OSError):
+            # Process has gone away
+            return None
+        return Process(pid, start_time, uid, name, cmdline.rstrip("\0").split("\0") if cmdline else [])
+            
+def benchmark(processes = 2000, refreshes = 20, churn = 0.02):
+    """
+    Measure the time taken to refresh the list of processes in a synthetic
+    proc tree, both by reading every process on every refresh and with a
+    ProcessTable (with and without verify). Between refreshes, the given
+    fraction of the processes exit and are replaced with new ones. Returns a
+    tuple of the mean time per refresh (in seconds) for each of the three.
+    
+    Keyword arguments:
+    processes        -- number of processes in the synthetic tree
+    refreshes        -- number of refreshes to time
+    churn            -- fraction of processes replaced between refreshes
+    """
+    def spawn(root, pid):
+        proc_dir = os.path.join(root, str(pid))
+        os.mkdir(proc_dir)
+        for name, content in [ ( "stat", "%d (proc %d) S 1 %d %d 0 -1 4194560 %s %d\n" % ( pid, pid, pid, pid, " ".join([ "0" ] * 12), 1000 + pid ) ),
+                               ( "status", "Name:\tproc%d\nState:\tS (sleeping)\nPid:\t%d\nUid:\t%d\t%d\t%d\t%d\n" % ( pid, pid, pid % 3, pid % 3, pid % 3, pid % 3 ) ),
+                               ( "cmdline", "/usr/bin/proc%d\0--option\0%d\0" % ( pid, pid ) ) ]:
+            f = open(os.path.join(proc_dir, name), "w")
+            try:
+                f.write(content)
+            finally:
+                f.close()
+    
+    def read_all(root):
+        for pid in [ int(d) for d in os.listdir(root) if d.isdigit() ]:
+            ProcessTable(root)._read_process(pid)
+    
+    def run(refresh):
+        root = tempfile.mkdtemp(prefix = "g15top-benchmark")
+        try:
+            r = random.Random(0)
+            pids = range(1, processes + 1)
+            for pid in pids:
+                spawn(root, pid)
+            next_pid = processes + 1
+            taken = 0.0
+            for i in range(0, refreshes + 1):
+                started = time.time()
+                refresh(root)
+                if i > 0:
+                    # The first refresh reads everything whichever way it is done
+                    taken += time.time() - started
+                for j in range(0, int(processes * churn)):
+                    pid = pids.pop(r.randint(0, len(pids) - 1))
+                    shutil.rmtree(os.path.join(root, str(pid)))
+                    spawn(root, next_pid)
+                    pids.append(next_pid)
+                    next_pid += 1
+            return taken / refreshes
+        finally:
+            shutil.rmtree(root)
+    
+    tables = {}
+    def refresh_table(root, verify):
+        if not root in tables:
+            tables[root] = ProcessTable(root, verify)
+        tables[root].refresh()
+        
+    return ( run(read_all),
+             run(lambda root: refresh_table(root, False)),
+             run(lambda root: refresh_table(root, True)) )
 
 if __name__ == "__main__":
     for d in proclist():
@@ -19,13 +19,21 @@
 # Free Software Foundation, Inc., 51 Franklin St, Fifth Floor,
 # Boston, MA 02110-1301, USA.
 """
-GdkPixbuf thumbnail sink
+GdkPixbuf thumbnail sink, and a sink that has GStreamer deliver frames
+already scaled and converted for the LCD.
 """
 
 import gobject
 import gst
+import cairo
 import struct
+import sys
 import time
+import threading
+
+# Logging
+import logging
+logger = logging.getLogger(__name__)
 
 big_to_cairo_alpha_mask = struct.unpack('=i', '\xFF\x00\x00\x00')[0]
 big_to_cairo_red_mask = struct.unpack('=i', '\x00\xFF\x00\x00')[0]
@@ -90,3 +98,295 @@ class CairoSurfaceThumbnailSink(gst.BaseSink):
         return self.do_render(buf)
 
 gobject.type_register(CairoSurfaceThumbnailSink)
+
+"""
+Frame formats delivered by LCDVideoSink. Each is laid out in memory exactly
+as the equivalent cairo image surface format, so frames need no conversion
+before painting.
+"""
+FORMAT_RGB24 = "rgb24"
+FORMAT_RGB565 = "rgb565"
+FORMAT_GRAY = "gray"
+
+# Cairo's 16 bit format was disabled in some versions, drivers use the value directly
+CAIRO_FORMAT_RGB16_565 = getattr(cairo, "FORMAT_RGB16_565", 4)
+
+# Number of surfaces in the pool. One is being painted, one holds the latest
+# frame waiting to be painted, and one is being filled by GStreamer
+POOL_SIZE = 3
+
+# Seconds over which frame rates are averaged
+STATISTICS_WINDOW = 5.0
+
+def get_format_for_bpp(bpp):
+    """
+    Get the frame format that best matches a device's colour depth. RGB565
+    is only used if the installed cairo supports it.
+    
+    Keyword arguments:
+    bpp        -- bits per pixel of the device
+    """
+    if bpp == 1:
+        return FORMAT_GRAY
+    if bpp == 16:
+        try:
+            cairo.ImageSurface(CAIRO_FORMAT_RGB16_565, 1, 1)
+            return FORMAT_RGB565
+        except Exception as e:
+            logger.debug("Cairo does not support RGB565, using RGB24 for video", exc_info = e)
+    return FORMAT_RGB24
+
+def get_caps(frame_format, width = None, height = None):
+    """
+    Get the GStreamer caps for a frame format, optionally fixed to a size.
+    
+    Keyword arguments:
+    frame_format    -- one of FORMAT_RGB24, FORMAT_RGB565 or FORMAT_GRAY
+    width           -- width, or None for any
+    height          -- height, or None for any
+    """
+    if frame_format == FORMAT_GRAY:
+        caps = "video/x-raw-gray, bpp = (int) 8, depth = (int) 8"
+    elif frame_format == FORMAT_RGB565:
+        caps = "video/x-raw-rgb, bpp = (int) 16, depth = (int) 16, endianness = (int) %d, " \
+               "red_mask = (int) 63488, green_mask = (int) 2016, blue_mask = (int) 31" % \
+               ( 1234 if sys.byteorder == "little" else 4321 )
+    else:
+        caps = "video/x-raw-rgb, bpp = (int) 32, depth = (int) 32, endianness = (int) BIG_ENDIAN, " \
+               "alpha_mask = (int) %i, red_mask = (int) %i, green_mask = (int) %i, blue_mask = (int) %i" % \
+               ( big_to_cairo_alpha_mask, big_to_cairo_red_mask, big_to_cairo_green_mask, big_to_cairo_blue_mask )
+    if width is None:
+        caps += ", width = (int) [ 1, max ], height = (int) [ 1, max ]"
+    else:
+        caps += ", width = (int) %d, height = (int) %d" % ( width, height )
+    return gst.Caps(caps)
+
+def create_surface(frame_format, width, height):
+    if frame_format == FORMAT_GRAY:
+        return cairo.ImageSurface(cairo.FORMAT_A8, width, height)
+    elif frame_format == FORMAT_RGB565:
+        return cairo.ImageSurface(CAIRO_FORMAT_RGB16_565, width, height)
+    else:
+        # We don't use FORMAT_ARGB32 because Cairo uses premultiplied
+        # alpha, and gstreamer does not
+        return cairo.ImageSurface(cairo.FORMAT_RGB24, width, height)
+    
+def paint_frame(canvas, frame_format, surface):
+    """
+    Paint a frame at the origin of the canvas. Grey frames are held as an
+    alpha mask, so white is painted through them onto black.
+    
+    Keyword arguments:
+    canvas        -- cairo context
+    frame_format  -- format of the frame
+    surface       -- frame surface
+    """
+    if frame_format == FORMAT_GRAY:
+        canvas.set_source_rgb(0, 0, 0)
+        canvas.rectangle(0, 0, surface.get_width(), surface.get_height())
+        canvas.fill()
+        canvas.set_source_rgb(1, 1, 1)
+        canvas.mask_surface(surface, 0, 0)
+    else:
+        canvas.set_source_surface(surface)
+        canvas.paint()
+
+class LCDVideoSink(gst.BaseSink):
+    """
+    GStreamer sink element that copies each frame straight into one of a
+    fixed pool of cairo surfaces. Frames should already be in the size and
+    format they will be shown in. Frames that arrive faster than the LCD can
+    be redrawn, or that are replaced by a newer frame before they are
+    painted, are dropped.
+    
+    The "frame" signal is emitted from the streaming thread when a new
+    frame is ready, the painter then calls acquire_frame() to get it.
+    """
+
+    __gsignals__ = {
+        "frame": (gobject.SIGNAL_RUN_LAST,
+                  gobject.TYPE_NONE,
+                  ([gobject.TYPE_UINT64]))
+        }
+
+    __gsttemplates__ = (
+        gst.PadTemplate("sink",
+                         gst.PAD_SINK,
+                         gst.PAD_ALWAYS,
+                         get_caps(FORMAT_RGB24) + get_caps(FORMAT_RGB565) + get_caps(FORMAT_GRAY)),
+        )
+
+    def __init__(self, frame_format = FORMAT_RGB24, max_fps = 0):
+        gst.BaseSink.__init__(self)
+        self.frame_format = frame_format
+        self.max_fps = max_fps
+        self.width = 1
+        self.height = 1
+        self.set_sync(True)
+        self.set_qos_enabled(True)
+        self._lock = threading.Lock()
+        self._pool = []
+        self._ready = None
+        self._painting = None
+        self._last_accepted = 0
+        self._decoded = 0
+        self._presented = 0
+        self._dropped = 0
+        self._window_start = time.time()
+        self._window_decoded = 0
+        self._window_presented = 0
+        self._decode_fps = 0.0
+        self._present_fps = 0.0
+
+    def do_set_caps(self, caps):
+        self.log("caps %s" % caps.to_string())
+        width = caps[0]["width"]
+        height = caps[0]["height"]
+        self._lock.acquire()
+        try:
+            if width != self.width or height != self.height or len(self._pool) == 0:
+                self.width = width
+                self.height = height
+                self._pool = [ create_surface(self.frame_format, width, height) for i in range(0, POOL_SIZE) ]
+                self._ready = None
+                self._painting = None
+        finally:
+            self._lock.release()
+        return True
+
+    def do_render(self, buf):
+        now = time.time()
+        self._lock.acquire()
+        try:
+            self._decoded += 1
+            self._window_decoded += 1
+            self._update_rates(now)
+            if self.max_fps > 0 and now - self._last_accepted < 1.0 / self.max_fps:
+                # The LCD could not show this frame anyway
+                self._dropped += 1
+                return gst.FLOW_OK
+            self._last_accepted = now
+            index = [ i for i in range(0, len(self._pool)) if i != self._ready and i != self._painting ][0]
+            surface = self._pool[index]
+        finally:
+            self._lock.release()
+        
+        # No other thread uses a surface that is neither ready nor being painted
+        surface.flush()
+        data = surface.get_data()
+        stride = surface.get_stride()
+        row = buf.size / self.height
+        if row == stride:
+            data[:buf.size] = buffer(buf)
+        else:
+            row_bytes = min(row, stride)
+            for y in range(0, self.height):
+                data[y * stride:y * stride + row_bytes] = buffer(buf, y * row, row_bytes)
+        surface.mark_dirty()
+        
+        self._lock.acquire()
+        try:
+            if self._ready is not None:
+                # Replaced before it was painted
+                self._dropped += 1
+            self._ready = index
+        finally:
+            self._lock.release()
+        self.emit('frame', buf.timestamp)
+        return gst.FLOW_OK
+ 
+    def do_preroll(self, buf):
+        return self.do_render(buf)
+    
+    def acquire_frame(self):
+        """
+        Get the surface to paint. This is the newest frame, if there is one
+        that has not been painted yet, otherwise the frame painted last
+        time. None is returned if there have been no frames yet. The
+        surface remains valid until the next call.
+        """
+        self._lock.acquire()
+        try:
+            if self._ready is not None:
+                self._painting = self._ready
+                self._ready = None
+                self._presented += 1
+                self._window_presented += 1
+                self._update_rates(time.time())
+            return self._pool[self._painting] if self._painting is not None else None
+        finally:
+            self._lock.release()
+    
+    def get_current_frame(self):
+        """
+        Get the frame that was last painted, without taking a newer one.
+        """
+        self._lock.acquire()
+        try:
+            return self._pool[self._painting] if self._painting is not None else None
+        finally:
+            self._lock.release()
+    
+    def get_statistics(self):
+        """
+        Get a dictionary of statistics. The frame rates of frames decoded
+        (arriving at the sink) and presented (painted), averaged over
+        the last few seconds, and total frames decoded, presented and
+        dropped.
+        """
+        self._lock.acquire()
+        try:
+            return { "video_decode_fps" : self._decode_fps,
+                     "video_present_fps" : self._present_fps,
+                     "video_decoded" : self._decoded,
+                     "video_presented" : self._presented,
+                     "video_dropped" : self._dropped }
+        finally:
+            self._lock.release()
+    
+    """
+    Private
+    """
+    def _update_rates(self, now):
+        taken = now - self._window_start
+        if taken >= STATISTICS_WINDOW:
+            self._decode_fps = self._window_decoded / taken
+            self._present_fps = self._window_presented / taken
+            self._window_start = now
+            self._window_decoded = 0
+            self._window_presented = 0
+
+gobject.type_register(LCDVideoSink)
+
+class LCDVideoBin(gst.Bin):
+    """
+    Bin that scales and converts video to the size and format the LCD
+    uses, before handing it to an LCDVideoSink. It may be linked into a
+    pipeline like any other sink.
+    """
+    
+    def __init__(self, frame_format, width, height, max_fps = 0):
+        gst.Bin.__init__(self)
+        self.frame_format = frame_format
+        
+        # Scale first, so there is less to convert
+        self._scale = gst.element_factory_make("videoscale")
+        self._color_space = gst.element_factory_make("ffmpegcolorspace")
+        self._filter = gst.element_factory_make("capsfilter")
+        self._filter.set_property("caps", get_caps(frame_format, width, height))
+        self.sink = LCDVideoSink(frame_format, max_fps)
+        self.add(self._scale, self._color_space, self._filter, self.sink)
+        gst.element_link_many(self._scale, self._color_space, self._filter, self.sink)
+        self.add_pad(gst.GhostPad("sink", self._scale.get_pad("sink")))
+        
+    def set_size(self, width, height):
+        """
+        Change the size frames are scaled to.
+        
+        Keyword arguments:
+        width        -- width
+        height       -- height
+        """
+        self._filter.set_property("caps", get_caps(self.frame_format, width, height))
+        
+gobject.type_register(LCDVideoBin)
@@ -21,6 +21,7 @@ Various conversions
 
 import gtk.gdk
 import math
+import g15pixels
 
 def rgb_to_string(rgb):
     if rgb == None:
@@ -56,18 +57,7 @@ def to_color(rgb):
     return gtk.gdk.Color(rgb[0] <<8, rgb[1] <<8,rgb[2] <<8)
 
 def rgb_to_uint16(r, g, b):
-    rBits = r * 32 / 255
-    gBits = g * 64 / 255
-    bBits = b * 32 / 255
-
-    rBits = rBits if rBits <= 31 else 31
-    gBits = gBits if gBits <= 63 else 63
-    bBits = bBits if bBits <= 31 else 31
-
-    valueH = (rBits << 3) | (gBits >> 3)
-    valueL = (gBits << 5) | bBits
-
-    return chr(valueL & 0xff) + chr(valueH & 0xff)
+    return g15pixels.rgb_to_uint16(r, g, b)
 
 def rgb_to_hex(rgb):
     # Currently this method is implemented in g15driver so that it avoids
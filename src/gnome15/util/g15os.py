@@ -22,11 +22,28 @@ filesystem, getting OS information...)
 
 from gnome15 import g15globals
 import os
+import time
+import ctypes
+import ctypes.util
 
 # Logging
 import logging
 logger = logging.getLogger(__name__)
 
+# Monotonic clock, if the C library provides one 
+CLOCK_MONOTONIC = 1
+
+class _timespec(ctypes.Structure):
+    _fields_ = [ ( "tv_sec", ctypes.c_long ), ( "tv_nsec", ctypes.c_long ) ]
+
+try:
+    _librt = ctypes.CDLL(ctypes.util.find_library("rt") or "librt.so.1", use_errno = True)
+    _clock_gettime = _librt.clock_gettime
+    _clock_gettime.argtypes = [ ctypes.c_int, ctypes.POINTER(_timespec) ]
+except Exception as e:
+    logger.debug("No clock_gettime, falling back to wall clock time", exc_info = e)
+    _clock_gettime = None
+
 def run_script(script, args = None, background = True):
     """
     Runs a python script from the scripts directory.
@@ -131,3 +148,15 @@ def get_lsb_distributor():
     ret, r = get_command_output('lsb_release -is')
     return r if ret == 0 else "Unknown"
 
+def monotonic():
+    """
+    Get the number of seconds from a clock that never goes backwards (it is 
+    not affected by changes to the system time). Use this for measuring
+    intervals and deadlines. If no such clock is available, the wall clock
+    time is returned.
+    """
+    if _clock_gettime is not None:
+        t = _timespec()
+        if _clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) == 0:
+            return t.tv_sec + t.tv_nsec * 1e-9
+    return time.time()
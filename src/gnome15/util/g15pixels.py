@@ -0,0 +1,509 @@
+#  Gnome15 - Suite of tools for the Logitech G series keyboards and headsets
+#  Copyright (C) 2010 Brett Smith <tanktarta@blueyonder.co.uk>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Pixel format conversions
+Converts the contents of cairo surfaces into the frame formats the devices
+expect, i.e. 16bit highcolor for the G19 and packed monochrome bitmaps for
+the G15, G110, G13 and similar. Each conversion has a pure Python reference implementation, plus
+batched implementations that use NumPy (when it is installed) or the
+array module. The fastest available path is used by default.
+
+This module must not depend on gtk, as it is used by the drivers and
+pylibg19, which may run without a DISPLAY.
+'''
+
+import array
+import cairo
+import hashlib
+import operator
+import sys
+import time
+
+# Logging
+import logging
+logger = logging.getLogger(__name__)
+
+try:
+    import numpy
+except Exception as e:
+    logger.debug("Could not import numpy. Falling back to array based pixel conversion", exc_info = e)
+    numpy = None
+
+"""
+Conversion paths
+"""
+PATH_NUMPY = "numpy"
+PATH_ARRAY = "array"
+PATH_PYTHON = "python"
+
+"""
+Dithering modes for monochrome conversion
+"""
+DITHER_NONE = "none"
+DITHER_ORDERED = "ordered"
+
+"""
+4x4 Bayer matrix used for ordered dithering
+"""
+BAYER_MATRIX = [ [  0,  8,  2, 10 ],
+                 [ 12,  4, 14,  6 ],
+                 [  3, 11,  1,  9 ],
+                 [ 15,  7, 13,  5 ] ]
+
+"""
+MD5 digests of the frames the 160x43 benchmark frame must produce in the
+libg15 layout, keyed by dithering mode and invert. These were produced
+independently of this module, and the frames themselves are kept as PBM
+images with the tests
+"""
+MONO_GOLDEN_SIZE = ( 160, 43 )
+MONO_GOLDEN = { ( DITHER_NONE, False ) : "0282b907fc2fc9f9645072f1994a10e6",
+                ( DITHER_NONE, True ) : "070ab059d3d9b372a94a9dc5b208c244",
+                ( DITHER_ORDERED, False ) : "9b23058d1d6fef4a8d8e3b565b319b4f",
+                ( DITHER_ORDERED, True ) : "3c133939089f99791db2ca052d184b61" }
+
+"""
+Lookup tables for the array path. These are built on first use
+"""
+__rgb565_low = None
+__rgb565_high = None
+__mono_levels = {}
+__mono_pack_tables = {}
+
+"""
+Weights used to calculate luminance (ITU-R 601, as used by PIL), scaled by 2^16
+"""
+_LUM_R = [ i * 19595 for i in range(256) ]
+_LUM_G = [ i * 38470 for i in range(256) ]
+_LUM_B = [ i * 7471 + 0x8000 for i in range(256) ]
+
+def get_available_paths():
+    """
+    Get the conversion paths available on this system, fastest first.
+    """
+    paths = []
+    if numpy is not None:
+        paths.append(PATH_NUMPY)
+    paths.append(PATH_ARRAY)
+    paths.append(PATH_PYTHON)
+    return paths
+
+def get_default_path():
+    return get_available_paths()[0]
+
+def rgb_to_uint16(r, g, b):
+    """
+    Converts a single RGB value to 16bit highcolor (5-6-5), returned as
+    a 2 character little-endian string. This is the reference that all
+    other conversions must match.
+    """
+    rBits = r * 32 / 255
+    gBits = g * 64 / 255
+    bBits = b * 32 / 255
+
+    rBits = rBits if rBits <= 31 else 31
+    gBits = gBits if gBits <= 63 else 63
+    bBits = bBits if bBits <= 31 else 31
+
+    valueH = (rBits << 3) | (gBits >> 3)
+    valueL = (gBits << 5) | bBits
+
+    return chr(valueL & 0xff) + chr(valueH & 0xff)
+
+def argb32_to_rgb565(data, path = None):
+    """
+    Convert the data of a cairo.FORMAT_ARGB32 surface (or any string or
+    buffer in the same layout) to a string of little-endian 16bit highcolor
+    (5-6-5) pixels. The alpha channel is ignored.
+
+    Keyword arguments:
+    data        -- ARGB32 data, as returned by cairo.ImageSurface.get_data()
+    path        -- conversion path to use, defaults to the fastest available
+    """
+    if path is None:
+        path = get_default_path()
+    if path == PATH_NUMPY:
+        return _argb32_to_rgb565_numpy(data)
+    elif path == PATH_ARRAY:
+        return _argb32_to_rgb565_array(data)
+    elif path == PATH_PYTHON:
+        return _argb32_to_rgb565_python(data)
+    raise ValueError("Unknown conversion path %s" % path)
+
+def surface_to_rgb565(surface, path = None):
+    """
+    Convert a cairo.ImageSurface to a string of 16bit highcolor pixels.
+    Surfaces that are already in 5-6-5 format are returned as is.
+
+    Keyword arguments:
+    surface     -- surface to convert
+    path        -- conversion path to use, defaults to the fastest available
+    """
+    if surface.get_format() == cairo.FORMAT_ARGB32:
+        return argb32_to_rgb565(surface.get_data(), path)
+    return str(surface.get_data())
+
+def argb32_to_mono(data, width, height, invert = False, dither = DITHER_NONE, path = None):
+    """
+    Convert ARGB32 data to a monochrome pixel map of one byte per pixel, row
+    by row. Each byte is 1 if the pixel should be lit on the LCD, or 0 if not.
+    By default dark pixels are lit. The alpha channel is ignored.
+
+    Keyword arguments:
+    data        -- ARGB32 data, as returned by cairo.ImageSurface.get_data()
+    width       -- width of image
+    height      -- height of image
+    invert      -- light pixels are lit instead of dark pixels
+    dither      -- dithering mode, DITHER_NONE for a simple threshold or DITHER_ORDERED
+    path        -- conversion path to use, defaults to the fastest available
+    """
+    if path is None:
+        path = get_default_path()
+    if path == PATH_NUMPY:
+        return _lit_to_string_numpy(_argb32_to_lit_numpy(data, width, height, invert, dither))
+    elif path == PATH_ARRAY:
+        return _argb32_to_mono_array(data, width, height, invert, dither)
+    elif path == PATH_PYTHON:
+        return _argb32_to_mono_python(data, width, height, invert, dither)
+    raise ValueError("Unknown conversion path %s" % path)
+
+def pack_mono(pixels, width, height, line_length = None, lsb_first = False, buffer_size = None, path = None):
+    """
+    Pack a monochrome pixel map of one byte per pixel (any non-zero value is
+    lit) into the bitmap layout used by the LCDs. Each row starts on a new
+    byte.
+
+    Keyword arguments:
+    pixels      -- string of width * height bytes
+    width       -- width of image
+    height      -- height of image
+    line_length -- number of bytes per row in the packed bitmap. Defaults to the least needed
+    lsb_first   -- the left most pixel is the least significant bit (the kernel framebuffer),
+                   rather than the most significant bit (libg15 and g15daemon)
+    buffer_size -- pad the packed bitmap with zeros to this size
+    path        -- conversion path to use, defaults to the fastest available
+    """
+    if path is None:
+        path = get_default_path()
+    if line_length is None:
+        line_length = ( width + 7 ) / 8
+    if path == PATH_NUMPY:
+        lit = numpy.frombuffer(pixels, dtype = numpy.uint8).reshape(height, width) != 0
+        buf = _pack_lit_numpy(lit, line_length, lsb_first)
+    elif path == PATH_ARRAY:
+        buf = _pack_mono_array(pixels, width, height, line_length, lsb_first)
+    elif path == PATH_PYTHON:
+        buf = _pack_mono_python(pixels, width, height, line_length, lsb_first)
+    else:
+        raise ValueError("Unknown conversion path %s" % path)
+    return _pad(buf, buffer_size)
+
+def argb32_to_lcd(data, width, height, invert = False, dither = DITHER_NONE, line_length = None, \
+                  lsb_first = False, buffer_size = None, path = None):
+    """
+    Threshold (or dither), invert and bit pack ARGB32 data in a single step,
+    returning a string in the layout expected by the LCD. See argb32_to_mono()
+    and pack_mono() for the arguments.
+    """
+    if path is None:
+        path = get_default_path()
+    if path == PATH_NUMPY:
+        if line_length is None:
+            line_length = ( width + 7 ) / 8
+        lit = _argb32_to_lit_numpy(data, width, height, invert, dither)
+        return _pad(_pack_lit_numpy(lit, line_length, lsb_first), buffer_size)
+    return pack_mono(argb32_to_mono(data, width, height, invert, dither, path), width, height, \
+                     line_length, lsb_first, buffer_size, path)
+
+def surface_to_lcd(surface, width, height, invert = False, dither = DITHER_NONE, line_length = None, \
+                   lsb_first = False, buffer_size = None, path = None):
+    """
+    Convert a cairo surface to the bitmap layout expected by the LCD. ARGB32
+    image surfaces of the right size are read directly, anything else is
+    painted on to a temporary ARGB32 surface first. See argb32_to_lcd() for
+    the arguments.
+    """
+    if isinstance(surface, cairo.ImageSurface) and surface.get_format() == cairo.FORMAT_ARGB32 and \
+            surface.get_width() == width and surface.get_height() == height:
+        surface.flush()
+        argb_surface = surface
+    else:
+        argb_surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+        argb_context = cairo.Context(argb_surface)
+        argb_context.set_source_surface(surface)
+        argb_context.paint()
+    return argb32_to_lcd(argb_surface.get_data(), width, height, invert, dither, \
+                         line_length, lsb_first, buffer_size, path)
+
+"""
+Private
+"""
+
+def _little_endian_argb32(data):
+    """
+    Get ARGB32 data as a string in little endian (BGRA) byte order. Cairo stores
+    pixels in native order, so this only does any work on big endian hosts.
+    """
+    if sys.byteorder == "little":
+        return str(data)
+    pixels = array.array('I', str(data))
+    pixels.byteswap()
+    return pixels.tostring()
+
+def _argb32_to_rgb565_python(data):
+    data = _little_endian_argb32(data)
+    buf = []
+    for i in range(0, len(data), 4):
+        r = ord(data[i + 2])
+        g = ord(data[i + 1])
+        b = ord(data[i + 0])
+        buf.append(rgb_to_uint16(r, g, b))
+    return "".join(buf)
+
+def _get_rgb565_tables():
+    """
+    The low byte of a 5-6-5 pixel depends only on green and blue, the high
+    byte only on red and green. So two 64K tables indexed by pairs of
+    adjacent source bytes are enough to convert a pixel without any
+    arithmetic.
+    """
+    global __rgb565_low
+    global __rgb565_high
+    if __rgb565_low is None:
+        low = []
+        high = []
+        for hi in range(256):
+            for lo in range(256):
+                # Low table is indexed by (g << 8 | b), high by (r << 8 | g)
+                low.append(rgb_to_uint16(0, hi, lo)[0])
+                high.append(rgb_to_uint16(hi, lo, 0)[1])
+        __rgb565_low = "".join(low)
+        __rgb565_high = "".join(high)
+    return __rgb565_low, __rgb565_high
+
+def _argb32_to_rgb565_array(data):
+    data = _little_endian_argb32(data)
+    low_table, high_table = _get_rgb565_tables()
+    pixels = len(data) / 4
+
+    # Native order is little endian here, so each short is (second << 8 | first)
+    bg = array.array('H', data)[0::2]
+    gr = array.array('H', data[1:-1])[0::2]
+    if sys.byteorder != "little":
+        bg.byteswap()
+        gr.byteswap()
+
+    buf = bytearray(pixels * 2)
+    buf[0::2] = "".join(map(low_table.__getitem__, bg))
+    buf[1::2] = "".join(map(high_table.__getitem__, gr))
+    return str(buf)
+
+def _argb32_to_rgb565_numpy(data):
+    pixels = numpy.frombuffer(data, dtype = numpy.uint32)
+    r = (pixels >> 16) & 0xff
+    g = (pixels >> 8) & 0xff
+    b = pixels & 0xff
+
+    # Same as the reference scaling (x * 32 / 255 clamped to 31 etc)
+    rgb = ((r >> 3) << 11) | ((g >> 2) << 5) | (b >> 3)
+    return rgb.astype('<u2').tostring()
+
+def _pad(buf, buffer_size):
+    if buffer_size is not None and len(buf) < buffer_size:
+        buf += chr(0) * ( buffer_size - len(buf) )
+    return buf
+
+def _get_mono_level(x, y, dither):
+    """
+    Get the luminance at or above which the pixel at x,y is considered light
+    """
+    if dither == DITHER_ORDERED:
+        return BAYER_MATRIX[y % 4][x % 4] * 16 + 8
+    elif dither == DITHER_NONE:
+        return 128
+    raise ValueError("Unknown dithering mode %s" % dither)
+
+def _get_mono_levels(width, height, dither):
+    """
+    Get the luminance levels for every pixel of an image, scaled by 2^16 to
+    match the luminance sums of the array path.
+    """
+    key = ( width, height, dither )
+    if not key in __mono_levels:
+        levels = []
+        for y in range(height):
+            for x in range(width):
+                levels.append(_get_mono_level(x, y, dither) << 16)
+        __mono_levels[key] = levels
+    return __mono_levels[key]
+
+def _get_mono_pack_table(lsb_first):
+    """
+    Get a table mapping strings of 8 pixel bytes (0 or 1) to a packed byte
+    """
+    if not lsb_first in __mono_pack_tables:
+        table = {}
+        for value in range(256):
+            bits = []
+            for bit in range(8):
+                bits.append(chr(( value >> ( bit if lsb_first else 7 - bit ) ) & 1))
+            table["".join(bits)] = chr(value)
+        __mono_pack_tables[lsb_first] = table
+    return __mono_pack_tables[lsb_first]
+
+def _argb32_to_mono_python(data, width, height, invert, dither):
+    data = _little_endian_argb32(data)
+    buf = []
+    for y in range(height):
+        for x in range(width):
+            i = ( y * width + x ) * 4
+            r = ord(data[i + 2])
+            g = ord(data[i + 1])
+            b = ord(data[i + 0])
+            lum = ( r * 19595 + g * 38470 + b * 7471 + 0x8000 ) >> 16
+            light = lum >= _get_mono_level(x, y, dither)
+            buf.append(chr(1) if light == invert else chr(0))
+    return "".join(buf)
+
+def _argb32_to_mono_array(data, width, height, invert, dither):
+    data = _little_endian_argb32(data)[:width * height * 4]
+    lum = map(operator.add, map(operator.add,
+                                map(_LUM_R.__getitem__, bytearray(data[2::4])),
+                                map(_LUM_G.__getitem__, bytearray(data[1::4]))),
+              map(_LUM_B.__getitem__, bytearray(data[0::4])))
+    levels = _get_mono_levels(width, height, dither)
+    return str(bytearray(map(operator.ge if invert else operator.lt, lum, levels)))
+
+def _pack_mono_python(pixels, width, height, line_length, lsb_first):
+    buf = array.array('B', chr(0) * ( line_length * height ))
+    for y in range(height):
+        for x in range(width):
+            if pixels[y * width + x] != chr(0):
+                bit = x % 8 if lsb_first else 7 - ( x % 8 )
+                buf[y * line_length + x / 8] |= 1 << bit
+    return buf.tostring()
+
+def _pack_mono_array(pixels, width, height, line_length, lsb_first):
+    table = _get_mono_pack_table(lsb_first)
+    pixels = pixels.translate(chr(0) + chr(1) * 255)
+    row_bytes = ( width + 7 ) / 8
+    row_padding = chr(0) * ( row_bytes * 8 - width )
+    line_padding = chr(0) * ( line_length - row_bytes )
+    buf = []
+    for y in range(height):
+        row = pixels[y * width:( y + 1 ) * width] + row_padding
+        buf.append("".join([ table[row[i:i + 8]] for i in range(0, len(row), 8) ]))
+        buf.append(line_padding)
+    return "".join(buf)
+
+def _argb32_to_lit_numpy(data, width, height, invert, dither):
+    pixels = numpy.frombuffer(data, dtype = numpy.uint32)[:width * height].reshape(height, width)
+    r = (pixels >> 16) & 0xff
+    g = (pixels >> 8) & 0xff
+    b = pixels & 0xff
+    lum = ( r * 19595 + g * 38470 + b * 7471 + 0x8000 ) >> 16
+    if dither == DITHER_ORDERED:
+        matrix = numpy.array(BAYER_MATRIX, dtype = numpy.uint32) * 16 + 8
+        levels = numpy.tile(matrix, ( ( height + 3 ) / 4, ( width + 3 ) / 4 ))[:height, :width]
+    elif dither == DITHER_NONE:
+        levels = 128
+    else:
+        raise ValueError("Unknown dithering mode %s" % dither)
+    light = lum >= levels
+    return light if invert else ~light
+
+def _lit_to_string_numpy(lit):
+    return lit.astype(numpy.uint8).tostring()
+
+def _pack_lit_numpy(lit, line_length, lsb_first):
+    height = lit.shape[0]
+    packed = numpy.packbits(lit, axis = 1)
+    if lsb_first:
+        bits = numpy.unpackbits(numpy.arange(256, dtype = numpy.uint8).reshape(256, 1), axis = 1)
+        packed = numpy.packbits(bits[:, ::-1], axis = 1).reshape(256)[packed]
+    buf = numpy.zeros(( height, line_length ), dtype = numpy.uint8)
+    buf[:, :packed.shape[1]] = packed
+    return buf.tostring()
+
+def _test_frame(width, height):
+    buf = array.array('B')
+    for y in range(height):
+        for x in range(width):
+            buf.extend(((x * 7) & 0xff, (y * 3) & 0xff, ((x + y) * 5) & 0xff, 0xff))
+    return buf.tostring()
+
+def benchmark(width = 320, height = 240, frames = 10, paths = None):
+    """
+    Measure the frames per second each conversion path can achieve for a
+    frame of the given size. Returns a list of (path, fps) tuples.
+    """
+    if paths is None:
+        paths = get_available_paths()
+    data = _test_frame(width, height)
+    reference = _argb32_to_rgb565_python(data)
+    results = []
+    for path in paths:
+        if argb32_to_rgb565(data, path) != reference:
+            raise Exception("Conversion path %s does not match the reference" % path)
+        count = 1 if path == PATH_PYTHON else frames
+        started = time.time()
+        for i in range(count):
+            argb32_to_rgb565(data, path)
+        results.append((path, count / max(time.time() - started, 0.000001)))
+    return results
+
+def benchmark_mono(width = 160, height = 43, frames = 100, paths = None):
+    """
+    Measure the frames per second each monochrome conversion path can achieve
+    for a frame of the given size, checking each against the reference for
+    every combination of options. At the golden size, every path (and the
+    reference) is first checked against the golden frames. Returns a list of
+    (path, fps) tuples.
+    """
+    if paths is None:
+        paths = get_available_paths()
+    data = _test_frame(width, height)
+    if ( width, height ) == MONO_GOLDEN_SIZE:
+        for path in [ PATH_PYTHON ] + [ p for p in paths if p != PATH_PYTHON ]:
+            for ( dither, invert ), digest in MONO_GOLDEN.items():
+                if hashlib.md5(argb32_to_lcd(data, width, height, invert, dither, path = path)).hexdigest() != digest:
+                    raise Exception("Monochrome conversion path %s does not match the golden frame for dither %s, invert %s" % (path, dither, str(invert)))
+    options = []
+    for dither in [ DITHER_NONE, DITHER_ORDERED ]:
+        for invert in [ False, True ]:
+            for lsb_first in [ False, True ]:
+                options.append(( invert, dither, width / 8 + 2, lsb_first, 1024 ))
+    references = [ argb32_to_lcd(data, width, height, *o, path = PATH_PYTHON) for o in options ]
+    results = []
+    for path in paths:
+        for o, reference in zip(options, references):
+            if argb32_to_lcd(data, width, height, *o, path = path) != reference:
+                raise Exception("Monochrome conversion path %s does not match the reference for %s" % (path, str(o)))
+        count = frames / 10 if path == PATH_PYTHON else frames
+        started = time.time()
+        for i in range(count):
+            argb32_to_lcd(data, width, height, path = path)
+        results.append((path, count / max(time.time() - started, 0.000001)))
+    return results
+
+if __name__ == "__main__":
+    print "RGB565 (320x240)"
+    for path, fps in benchmark():
+        print "    %-10s %8.2f frames/sec" % ( path, fps )
+    print "Monochrome (160x43)"
+    for path, fps in benchmark_mono():
+        print "    %-10s %8.2f frames/sec" % ( path, fps )
@@ -51,6 +51,12 @@ def run_on_gobject(function, *args):
         gobject.idle_add(function, *args)
         return True
 
+def set_max_concurrency(queue_name, max_concurrency):
+    scheduler.set_max_concurrency(queue_name, max_concurrency)
+
+def set_dedicated(queue_name):
+    scheduler.set_dedicated(queue_name)
+
 def stop_queue(queue_name):
     scheduler.stop_queue(queue_name)
 
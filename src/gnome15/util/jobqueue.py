@@ -14,18 +14,32 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import Queue
 import threading
 import traceback
-import sys
+import heapq
+import bisect
 import gobject
 import time
+import math
+import g15os
+from collections import deque
 from threading import RLock
 from threading import local
 
 # Can be adjusted to speed up time to aid debugging.
 TIME_FACTOR=1
 
+# The maximum number of threads shared by all job queues
+MAX_WORKERS=8
+
+# Capture the stack of the caller for every job, so it may be logged if the job fails.
+# This is expensive, so is off unless debugging
+CAPTURE_STACKS=False
+
+# Upper bounds (in seconds) of the buckets of the wait and run time histograms. There 
+# is one more bucket for anything longer
+HISTOGRAM_BOUNDS=( 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0 )
+
 # Logging
 import logging
 logger = logging.getLogger(__name__)
@@ -49,9 +63,24 @@ def is_on_queue(queue_name):
         return True
     return False
 
+def get_time():
+    """
+    Get the elapsed real time in seconds from an arbitrary point. Unlike time.time(),
+    this is not affected by changes to the system clock, so is used for timers.
+    """
+    return g15os.monotonic()
+
 class GTimer:    
+    """
+    A job that will be added to a queue after an interval. All timers share a
+    single gobject timeout, which is set for whichever timer is due first.
+    """
     def __init__(self, scheduler, task_queue, task_name, interval, function, stack, *args):
         self.function = function
+        self.complete = False
+        self.cancelled = False
+        self.fired = False
+        self.job = None
         if function == None:
             logger.warning("Attempt to run empty job %s on %s", task_name, task_queue.name)
             traceback.print_stack()
@@ -60,156 +89,469 @@ class GTimer:
         self.scheduler = scheduler
         self.task_queue = task_queue
         self.task_name = task_name
-        self.source = gobject.timeout_add(int(float(interval) * 1000.0 * TIME_FACTOR), self.exec_item, function, *args)
-        self.complete = False
-        self.scheduler.all_jobs.append(self)
+        self.args = args
+        self.due = get_time() + float(interval) * TIME_FACTOR
+        self.scheduler.timers.add(self)
         
-    def exec_item(self, function, *args):
+    def exec_item(self):
+        if self.cancelled:
+            return
         try:
             logger.debug("Executing GTimer %s", str(self.task_name))
-            ji = self.task_queue.run(self.stack, function, *args)
+            self.job = self.task_queue.add(JobQueue.JobItem(self.stack, self.function, self.args, self.task_name))
             logger.debug("Executed GTimer %s", str(self.task_name))
         finally:
-            self.scheduler.all_jobs_lock.acquire()
-            try:
-                if self in self.scheduler.all_jobs:
-                    self.scheduler.all_jobs.remove(self)
-                self.complete = True
-            finally:
-                self.scheduler.all_jobs_lock.release()
+            self.complete = True
         
     def is_complete(self):
         return self.complete
+    
+    def is_pending(self):
+        """
+        Get if the job has yet to start. This is False once the timer is cancelled,
+        or once the job it queued has started or been cleared from the queue.
+        """
+        if self.cancelled or self.function == None:
+            return False
+        if not self.complete:
+            return True
+        return self.job is not None and self.job.is_pending()
         
     def cancel(self, *args):
-        self.scheduler.all_jobs_lock.acquire()
+        if self.function != None:
+            self.scheduler.timers.cancel(self)
+            logger.debug("Cancelled GTimer %s", str(self.task_name))
+            
+class Timers():
+    """
+    All pending timers, ordered by the time they are due. Rather than each timer
+    having a gobject timeout of its own, a single timeout is kept set for the
+    earliest. Cancelled timers are left in place and skipped when they become
+    due, unless enough build up to be worth removing.
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.heap = []
+        self.sequence = 0
+        self.cancelled = 0
+        self.source = None
+        self.source_due = None
+        
+    def add(self, timer):
+        self.lock.acquire()
+        try:
+            self.sequence += 1
+            heapq.heappush(self.heap, ( timer.due, self.sequence, timer ))
+            self._set_timeout()
+        finally:
+            self.lock.release()
+            
+    def cancel(self, timer):
+        self.lock.acquire()
         try:
-            if self in self.scheduler.all_jobs:
-                self.scheduler.all_jobs.remove(self)
+            if not timer.cancelled and not timer.fired:
+                self.cancelled += 1
+            timer.cancelled = True
+            if self.cancelled > 32 and self.cancelled > len(self.heap) / 2:
+                self.heap = [ entry for entry in self.heap if not entry[2].cancelled ]
+                heapq.heapify(self.heap)
+                self.cancelled = 0
+                self._set_timeout()
+        finally:
+            self.lock.release()
+            
+    def get_timers(self):
+        self.lock.acquire()
+        try:
+            return [ entry[2] for entry in sorted(self.heap) if not entry[2].cancelled ]
+        finally:
+            self.lock.release()
+            
+    def _set_timeout(self):
+        if len(self.heap) == 0:
+            return
+        due = self.heap[0][0]
+        if self.source is not None:
+            if self.source_due <= due:
+                return
             gobject.source_remove(self.source)
-            logger.debug("Cancelled GTimer %s", str(self.task_name))
+        self.source_due = due
+        # Round up, a timeout that fires early would find nothing due and have to be set again
+        self.source = gobject.timeout_add(max(0, int(math.ceil((due - get_time()) * 1000.0))), self._timeout)
+        
+    def _timeout(self):
+        due = []
+        self.lock.acquire()
+        try:
+            self.source = None
+            now = get_time()
+            while len(self.heap) > 0 and self.heap[0][0] <= now:
+                timer = heapq.heappop(self.heap)[2]
+                timer.fired = True
+                if timer.cancelled:
+                    self.cancelled -= 1
+                else:
+                    due.append(timer)
+            self._set_timeout()
+        finally:
+            self.lock.release()
+        for timer in due:
+            timer.exec_item()
+        return False
+        
+class JobMetrics():
+    """
+    Counts, failures and histograms of the time spent waiting in the queue
+    and running for each job, grouped by queue and job name.
+    """
+    
+    class Entry():
+        def __init__(self, queue_name, job_name):
+            self.queue_name = queue_name
+            self.job_name = job_name
+            self.count = 0
+            self.failures = 0
+            self.total_wait = 0.0
+            self.total_run = 0.0
+            self.wait_histogram = [ 0 ] * ( len(HISTOGRAM_BOUNDS) + 1 )
+            self.run_histogram = [ 0 ] * ( len(HISTOGRAM_BOUNDS) + 1 )
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+        
+    def record(self, queue_name, job_name, wait, run, failed):
+        """
+        Record a job that has finished running
+        
+        Keyword arguments:
+        queue_name        -- queue name
+        job_name          -- job name
+        wait              -- seconds spent waiting in the queue
+        run               -- seconds spent running
+        failed            -- whether the job raised an exception
+        """
+        key = ( queue_name, job_name )
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = self.Entry(queue_name, job_name)
+                self.entries[key] = entry
+            entry.count += 1
+            if failed:
+                entry.failures += 1
+            entry.total_wait += wait
+            entry.total_run += run
+            entry.wait_histogram[bisect.bisect_left(HISTOGRAM_BOUNDS, wait)] += 1
+            entry.run_histogram[bisect.bisect_left(HISTOGRAM_BOUNDS, run)] += 1
+        finally:
+            self.lock.release()
+            
+    def get_entries(self):
+        """
+        Get copies of all of the entries
+        """
+        self.lock.acquire()
+        try:
+            entries = []
+            for entry in self.entries.values():
+                copy = self.Entry(entry.queue_name, entry.job_name)
+                copy.__dict__.update(entry.__dict__)
+                copy.wait_histogram = list(entry.wait_histogram)
+                copy.run_histogram = list(entry.run_histogram)
+                entries.append(copy)
+            return entries
+        finally:
+            self.lock.release()
+            
+    def reset(self):
+        self.lock.acquire()
+        try:
+            self.entries = {}
+        finally:
+            self.lock.release()
+        
+class WorkerPool():
+    """
+    A bounded pool of threads shared by all job queues. Threads are only started
+    when there are no idle ones, up to the maximum. Queues with jobs waiting are
+    served in the order they became ready, so one busy queue cannot starve the
+    others.
+    """
+    
+    def __init__(self, max_workers = MAX_WORKERS, name = "JobWorker"):
+        self.max_workers = max_workers
+        self.name = name
+        self.condition = threading.Condition(threading.Lock())
+        self.ready = deque()
+        self.threads = []
+        self.idle = 0
+        self.stopping = False
+        
+    def submit(self, queue):
+        """
+        Request that a worker runs the next job from a queue
+        
+        Keyword arguments:
+        queue        -- queue
+        """
+        self.condition.acquire()
+        try:
+            self.ready.append(queue)
+            if self.idle == 0 and len(self.threads) < self.max_workers and not self.stopping:
+                t = threading.Thread(target = self._worker)
+                t.name = "%s-%d" % ( self.name, len(self.threads) )
+                t.setDaemon(True)
+                self.threads.append(t)
+                t.start()
+            else:
+                self.condition.notify()
+        finally:
+            self.condition.release()
+            
+    def stop(self):
+        """
+        Stop the threads of the pool once any jobs they have been given are done.
+        """
+        self.condition.acquire()
+        try:
+            self.stopping = True
+            self.condition.notify_all()
         finally:
-            self.scheduler.all_jobs_lock.release()
+            self.condition.release()
+            
+    def _worker(self):
+        while True:
+            self.condition.acquire()
+            try:
+                while len(self.ready) == 0:
+                    if self.stopping:
+                        self.threads.remove(threading.currentThread())
+                        return
+                    self.idle += 1
+                    try:
+                        self.condition.wait()
+                    finally:
+                        self.idle -= 1
+                queue = self.ready.popleft()
+            finally:
+                self.condition.release()
+            queue._run_next()
         
 '''
 Task scheduler. Tasks may be added to the queue to execute
-after a specified interval. The timer is done by the gobject
+after a specified interval. The timers are driven by the gobject
 event loop, which then executes the job on a different thread
 '''
 
 class JobScheduler():
     
-    def __init__(self):
+    def __init__(self, max_workers = MAX_WORKERS):
         self.queues = {}
-        self.all_jobs = []
-        self.all_jobs_lock = RLock()
+        self.queues_lock = RLock()
+        self.pool = WorkerPool(max_workers)
+        self.timers = Timers()
+        self.metrics = JobMetrics()
         
     def print_all_jobs(self):
         print "Scheduled"
         print "------"
-        for j in self.all_jobs:
+        for j in self.timers.get_timers():
             print "    %s - %s" % ( j.task_name, str(j.function))
         print
         print "Running"
         print "-------"
-        for q in self.queues:
-            self.queues[q].print_all_jobs()
+        for q in self.queues.values():
+            q.print_all_jobs()
         
     def schedule(self, name, interval, function, *args):
         return self.queue("default", name, interval, function, *args)
     
     def stop_all(self):
         logger.info("Stopping all queues")
-        for queue_name in self.queues:
-            self.queues[queue_name].stop()
+        for queue in self.queues.values():
+            queue.stop()
     
     def clear_jobs(self, queue_name):
         if queue_name in self.queues:
             self.queues[queue_name].clear()
             
     def stop_queue(self, queue_name):
-        if queue_name in self.queues:
-            self.queues[queue_name].stop()
-            del self.queues[queue_name]
+        self.queues_lock.acquire()
+        try:
+            if queue_name in self.queues:
+                self.queues[queue_name].stop()
+                del self.queues[queue_name]
+        finally:
+            self.queues_lock.release()
+            
+    def set_max_concurrency(self, queue_name, max_concurrency):
+        """
+        Set how many jobs from a queue may run at the same time. By default queues
+        run one job at a time, in the order they were added.
+        
+        Keyword arguments:
+        queue_name        -- queue name
+        max_concurrency   -- maximum number of jobs to run at once
+        """
+        self.get_queue(queue_name).set_max_concurrency(max_concurrency)
+        
+    def set_dedicated(self, queue_name):
+        """
+        Give a queue a worker thread of its own rather than using the shared
+        pool, for jobs that must start promptly regardless of how busy the other
+        queues are.
+        
+        Keyword arguments:
+        queue_name        -- queue name
+        """
+        queue = self.get_queue(queue_name)
+        queue.all_jobs_lock.acquire()
+        try:
+            if queue.pool is self.pool:
+                queue.pool = WorkerPool(queue.number_of_workers, queue_name)
+                queue.dedicated = True
+        finally:
+            queue.all_jobs_lock.release()
+        
+    def get_queue(self, queue_name):
+        self.queues_lock.acquire()
+        try:
+            if not queue_name in self.queues:
+                self.queues[queue_name] = JobQueue(name=queue_name, pool=self.pool, metrics=self.metrics)
+            return self.queues[queue_name]
+        finally:
+            self.queues_lock.release()
+    
+    def get_metrics(self):
+        """
+        Get the metrics for every job name on every queue that has run a job,
+        as a list of JobMetrics.Entry. Each entry also has a backlog attribute
+        with the number of jobs of that name waiting in the queue.
+        """
+        entries = self.metrics.get_entries()
+        backlog = {}
+        for queue in self.queues.values():
+            for job_name, count in queue.get_backlog().items():
+                backlog[( queue.name, job_name )] = count
+        for entry in entries:
+            entry.backlog = backlog.pop(( entry.queue_name, entry.job_name ), 0)
+        for ( queue_name, job_name ), count in backlog.items():
+            entry = JobMetrics.Entry(queue_name, job_name)
+            entry.backlog = count
+            entries.append(entry)
+        return entries
     
     def execute(self, queue_name, name, function, *args):
         logger.debug("Executing on queue %s", queue_name)
-        if not queue_name in self.queues:
-            self.queues[queue_name] = JobQueue(name=queue_name)   
-        self.queues[queue_name].run(self._get_stack(), function, *args)        
+        return self.get_queue(queue_name).add(JobQueue.JobItem(self._get_stack(), function, args, name))
         
     def _get_stack(self):
-        try: 1/0
-        except:
-            tb = sys.exc_info()[2]
-            return traceback.extract_stack()[:-5]
+        if CAPTURE_STACKS:
+            return traceback.extract_stack()[:-3]
     
     def queue(self, queue_name, name, interval, function, *args):
         if not hasattr(function, "__call__"):
             raise Exception("Not a function")
         logger.debug("Queueing %s on %s for execution in %f", name, queue_name, interval)
-        if not queue_name in self.queues:
-            self.queues[queue_name] = JobQueue(name=queue_name)
+        queue = self.get_queue(queue_name)
         
         if interval == 0:
-            # Optimisation, if this is un-timed, avoid putting on main loop
-            self.queues[queue_name].run(self._get_stack(), function, *args)
+            # Optimisation, if this is un-timed, avoid the timers
+            return queue.add(JobQueue.JobItem(self._get_stack(), function, args, name))
         else:
-            timer = GTimer(self, self.queues[queue_name], name, interval, function, self._get_stack(), *args)
+            timer = GTimer(self, queue, name, interval, function, self._get_stack(), *args)
             logger.debug("Queued %s", name)
             return timer
 
 
 class JobQueue():
+    """
+    A named queue of jobs. Jobs are run by the threads of a shared pool, no more
+    than number_of_workers at once. With the default of one, jobs run in the order
+    they were added.
+    """
     
     class JobItem():
-        def __init__(self, stack, item, args = None):
+        def __init__(self, stack, item, args = None, name = None):
             self.args = args
             self.item = item
+            self.name = name
             self.queued = time.time()
             self.started = None
             self.finished = None
+            self.cleared = False
             self.stack = stack
+            
+        def is_pending(self):
+            """
+            Get if the job has yet to start, and has not been cleared from the queue
+            """
+            return not self.cleared and self.started is None
         
-    def __init__(self,number_of_workers=1, name="JobQueue"):
+    def __init__(self,number_of_workers=1, name="JobQueue", pool=None, metrics=None):
         logger.debug("Creating job queue %s with %d workers", name, number_of_workers)
-        self.work_queue = Queue.Queue()
+        self.jobs = deque()
         self.queued_jobs = []
         self.name = name
         self.stopping = False
         self.all_jobs_lock = threading.Lock()
         self.number_of_workers = number_of_workers
-        self.threads = []
-        for __ in range(number_of_workers):
-            t = threading.Thread(target = self.worker)
-            t.name = name
-            t.setDaemon(True)
-            t.start()
-            self.threads.append(t)
+        self.running = 0
+        self.dedicated = pool is None
+        self.pool = pool if pool is not None else WorkerPool(number_of_workers, name)
+        self.metrics = metrics
             
     def print_all_jobs(self):
         print "Queue %s" % self.name
         for s in self.queued_jobs:
             print "     %s - %s" % (str(s.item), str(s.queued))
             
+    def set_max_concurrency(self, max_concurrency):
+        self.all_jobs_lock.acquire()
+        try:
+            self.number_of_workers = max_concurrency
+            if self.dedicated:
+                self.pool.max_workers = max_concurrency
+            start = min(len(self.jobs), self.number_of_workers - self.running)
+            self.running += max(0, start)
+        finally:
+            self.all_jobs_lock.release()
+        for __ in range(0, start):
+            self.pool.submit(self)
+            
+    def get_backlog(self):
+        """
+        Get the number of jobs waiting to run, by job name
+        """
+        self.all_jobs_lock.acquire()
+        try:
+            backlog = {}
+            for item in self.jobs:
+                backlog[item.name] = backlog.get(item.name, 0) + 1
+            return backlog
+        finally:
+            self.all_jobs_lock.release()
+            
     def stop(self):
         logger.info("Stopping queue %s", self.name)
         self.stopping = True
         self.clear()
-        for i in range(0, self.number_of_workers):
-            self.work_queue.put(self.JobItem("Stopping", self._dummy))
+        if self.dedicated:
+            self.pool.stop()
         logger.info("Stopped queue %s", self.name)
-        
-    def _dummy(self):
-        pass
             
     def clear(self):
-        jobs = self.work_queue.qsize()
-        if jobs > 0:
-            logger.info("Clearing queue %s as it has %d jobs", self.name, jobs)
-            try :
-                while True:
-                    item = self.work_queue.get_nowait()
+        self.all_jobs_lock.acquire()
+        try:
+            jobs = len(self.jobs)
+            if jobs > 0:
+                logger.info("Clearing queue %s as it has %d jobs", self.name, jobs)
+                while len(self.jobs) > 0:
+                    item = self.jobs.popleft()
+                    item.cleared = True
                     logger.debug("Removed func = %s, args = %s, queued = %s, " \
                                  "started = %s, finished = %s",
                                  str(item.item),
@@ -219,63 +561,84 @@ class JobQueue():
                                  str(item.finished))
                     if item in self.queued_jobs:
                         self.queued_jobs.remove(item)
-            except Queue.Empty as e:
-                logger.debug("The queue is already empty", exc_info = e)
-                pass
-            logger.info("Cleared queue %s", self.name)
+                logger.info("Cleared queue %s", self.name)
+        finally:
+            self.all_jobs_lock.release()
             
     def run(self, stack, item, *args):
+        return self.add(self.JobItem(stack, item, args))
+            
+    def add(self, ji):
         if self.stopping:
             return
-        if item == None:
+        if ji.item == None:
             logger.warning("Attempt to run empty job.")
             traceback.print_stack()
             return
+        start = False
         self.all_jobs_lock.acquire()
         try :
             logger.debug("Queued task on %s", self.name)
-            ji = self.JobItem(stack, item, args)
             self.queued_jobs.append(ji)
-            self.work_queue.put(ji)
-            jobs = self.work_queue.qsize()
-            if jobs > 1:
-                logger.debug("Queue %s filling, now at %d jobs.", self.name, jobs)
-                
+            self.jobs.append(ji)
+            if self.running < self.number_of_workers:
+                self.running += 1
+                start = True
+            elif len(self.jobs) > 1:
+                logger.debug("Queue %s filling, now at %d jobs.", self.name, len(self.jobs))
         finally :
             self.all_jobs_lock.release()
+        if start:
+            self.pool.submit(self)
         return ji
             
-    def worker(self):
+    def _run_next(self):
+        self.all_jobs_lock.acquire()
+        try:
+            if len(self.jobs) == 0:
+                self.running -= 1
+                return
+            item = self.jobs.popleft()
+        finally:
+            self.all_jobs_lock.release()
+            
         queue_names.queue_name = self.name
-        while not self.stopping:
-            item = self.work_queue.get()
+        failed = False
+        try:
             try:
-                if item != None:
-                    try:
-                        logger.debug("Running task on %s", self.name)
-                        item.started = time.time()
-                        if item.args and len(item.args) > 0:
-                            item.item(*item.args)
-                        else:
-                            item.item()
-                        item.finished = time.time()
-                        logger.debug("Ran task on %s", self.name)
-                    finally:
-                        if item in self.queued_jobs: 
-                            self.queued_jobs.remove(item)
+                logger.debug("Running task on %s", self.name)
+                item.started = time.time()
+                if item.args and len(item.args) > 0:
+                    item.item(*item.args)
+                else:
+                    item.item()
+                item.finished = time.time()
+                logger.debug("Ran task on %s", self.name)
             except Exception as a:
+                failed = True
                 try:
                     logger.debug("Error on worker", exc_info = a)
                     logger.debug("Caused by job")
-                    logger.debug("%s\n", item.stack)
+                    logger.debug("%s\n", item.stack if item.stack is not None else "(stack capture is off)")
                 except Exception as e:
                     logger.debug("Could not log error on worker", exc_info = e)
                     pass
-            self.work_queue.task_done()
-            
-        if logger:
+        finally:
+            del queue_names.queue_name
+            if self.metrics is not None:
+                finished = time.time()
+                self.metrics.record(self.name, item.name, item.started - item.queued, finished - item.started, failed)
+            more = False
+            self.all_jobs_lock.acquire()
             try:
-                logger.info("Exited queue %s", self.name)
-            except Exception as e:
-                pass
- 
+                if item in self.queued_jobs: 
+                    self.queued_jobs.remove(item)
+                if len(self.jobs) > 0 and self.running <= self.number_of_workers:
+                    more = True
+                else:
+                    self.running -= 1
+            finally:
+                self.all_jobs_lock.release()
+            if more:
+                # Go to the back of the pool's queue so other queues get a turn
+                self.pool.submit(self)
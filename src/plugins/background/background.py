@@ -123,6 +123,7 @@ class G15BackgroundPainter(g15screen.Painter):
         g15screen.Painter.__init__(self, g15screen.BACKGROUND_PAINTER, -9999)
         self.background_image = None
         self.brightness = 0
+        self.cached = True
         self._screen = screen
         
     def paint(self, canvas):
@@ -313,5 +314,6 @@ class G15Background():
                 self.painter.background_image = None
                 
         self.painter.brightness = self.gconf_client.get_int(self.gconf_key + "/brightness")
+        self.painter.mark_dirty()
                 
         self.screen.redraw()
@@ -22,13 +22,12 @@ import gnome15.g15locale as g15locale
 import gnome15.g15accounts as g15accounts
 _ = g15locale.get_translation("cal-evolution", modfile = __file__).ugettext
 import gtk
-import urllib
 import vobject
 import datetime
 import dateutil
 import sys, os, os.path
-import re
 import cal
+import calstore
 import xdg.BaseDirectory
 import logging
 logger = logging.getLogger(__name__)
@@ -72,15 +71,26 @@ class EvolutionCalendarOptions(g15accounts.G15AccountOptions):
 
 class EvolutionEvent(cal.CalendarEvent):
     
-    def __init__(self, parsed_event):
+    def __init__(self, parsed_event, start_date = None, end_date = None):
         cal.CalendarEvent.__init__(self)
         
-        self.start_date = parsed_event.dtstart.value
-        if parsed_event.dtend:
+        self.start_date = parsed_event.dtstart.value if start_date is None else start_date
+        if end_date is not None:
+            self.end_date = end_date
+        elif "dtend" in parsed_event.contents:
             self.end_date = parsed_event.dtend.value
         else:
             self.end_date = datetime.datetime(self.start_date.year,self.start_date.month,self.start_date.day, 23, 59, 0)
             
+        # All day events have dates rather than times, and end the next day
+        if not isinstance(self.start_date, datetime.datetime):
+            self.start_date = datetime.datetime(self.start_date.year, self.start_date.month, self.start_date.day, 0, 0, 0)
+        if not isinstance(self.end_date, datetime.datetime):
+            end = self.end_date - datetime.timedelta(1)
+            self.end_date = datetime.datetime(end.year, end.month, end.day, 23, 59, 0)
+            if self.end_date < self.start_date:
+                self.end_date = datetime.datetime(self.start_date.year,self.start_date.month,self.start_date.day, 23, 59, 0)
+            
         self.summary = parsed_event.summary.value
         self.alt_icon = os.path.join(os.path.dirname(__file__), "icon.png")
         
@@ -89,43 +99,81 @@ class EvolutionBackend(cal.CalendarBackend):
     def __init__(self):
         cal.CalendarBackend.__init__(self)
         
-    def get_events(self, now):
-        calendars = []
-        event_days = {}
-        
-        # Find all the calendar files
-        cal_dir = os.path.join(xdg.BaseDirectory.xdg_data_home, "evolution", "calendar")
-        if not os.path.exists(cal_dir):
-            # Older versions of evolution store their data in ~/.evolution
-            cal_dir = os.path.expanduser("~/.evolution/calendar")
-        if os.path.exists(cal_dir):
-            for root, dirs, files in os.walk(cal_dir):
-                for _file in files:
-                    if _file.endswith(".ics"):
-                        calendars.append(os.path.join(root, _file))
+    def get_sync_token(self, start_date, end_date):
+        return tuple([ ( path, ) + _get_file_state(path) for path in _get_calendar_files() ])
         
-        for cal in calendars:
-            if not re.search("^webcal://", cal[1]):
-                f = open(cal)
-                calstring = ''.join(f.readlines())
-                f.close()
+    def get_window_events(self, start_date, end_date):
+        events = []
+        for path in _get_calendar_files():
+            for parsed_event in _get_parsed_events(path):
                 try:
-                    event_list = vobject.readOne(calstring).vevent_list
-                except AttributeError as ae:
-                    logger.debug("Could not read attribute", exc_info = ae)
-                    continue
-            else: # evolution library does not support webcal ics
-                webcal = urllib.urlopen('http://' + cal[1][9:])
-                webcalstring = ''.join(webcal.readlines())
-                webcal.close()
-                event_list = vobject.readOne(webcalstring).vevent_list
-                
-            for e in event_list:
-                if type(e) != vobject.icalendar.RecurringComponent:
-                    parsed_event = vobject.readOne(e.get_as_string())
-                else:
-                    parsed_event = e
-                    
-                self.check_and_add(EvolutionEvent(parsed_event), now, event_days)
-                
-        return event_days
\ No newline at end of file
+                    events += _expand(parsed_event, start_date, end_date)
+                except Exception as e:
+                    logger.debug("Could not expand event in %s", path, exc_info = e)
+        return events
+
+"""
+Parsing is slow, so the events parsed from each calendar file are kept
+until the file changes. Keys are file paths, values are tuples of the
+file state and the list of events.
+"""
+_parsed_files = {}
+
+def _get_calendar_files():
+    calendars = []
+    cal_dir = os.path.join(xdg.BaseDirectory.xdg_data_home, "evolution", "calendar")
+    if not os.path.exists(cal_dir):
+        # Older versions of evolution store their data in ~/.evolution
+        cal_dir = os.path.expanduser("~/.evolution/calendar")
+    if os.path.exists(cal_dir):
+        for root, dirs, files in os.walk(cal_dir):
+            for _file in files:
+                if _file.endswith(".ics"):
+                    calendars.append(os.path.join(root, _file))
+    return sorted(calendars)
+
+def _get_file_state(path):
+    try:
+        st = os.stat(path)
+        return ( st.st_mtime, st.st_size )
+    except OSError:
+        return ( None, None )
+
+def _get_parsed_events(path):
+    state = _get_file_state(path)
+    if path in _parsed_files and _parsed_files[path][0] == state:
+        return _parsed_files[path][1]
+    f = open(path)
+    try:
+        calstring = f.read()
+    finally:
+        f.close()
+    try:
+        event_list = vobject.readOne(calstring).vevent_list
+    except AttributeError as ae:
+        logger.debug("Could not read attribute", exc_info = ae)
+        event_list = []
+    _parsed_files[path] = ( state, event_list )
+    return event_list
+
+def _expand(parsed_event, start_date, end_date):
+    """
+    Get an event for each occurrence of a (possibly recurring) event that
+    starts before the end of the window and ends after the start of it.
+    """
+    event = EvolutionEvent(parsed_event)
+    rruleset = parsed_event.getrruleset(True)
+    if rruleset is None:
+        if calstore.to_date(event.start_date) <= end_date and calstore.to_date(event.end_date) >= start_date:
+            return [ event ]
+        return []
+    
+    duration = event.end_date - event.start_date
+    dtstart = parsed_event.dtstart.value
+    tzinfo = dtstart.tzinfo if isinstance(dtstart, datetime.datetime) else None
+    window_start = datetime.datetime(start_date.year, start_date.month, start_date.day, tzinfo = tzinfo) - duration
+    window_end = datetime.datetime(end_date.year, end_date.month, end_date.day, 23, 59, 59, tzinfo = tzinfo)
+    events = []
+    for occurrence in rruleset.between(window_start, window_end, True):
+        events.append(EvolutionEvent(parsed_event, occurrence, occurrence + duration))
+    return events
@@ -23,7 +23,6 @@ import cal
 import gtk
 import os
 import datetime
-import calendar
 import gdata.calendar.data
 import gdata.calendar.client
 import gdata.acl.data
@@ -121,7 +120,7 @@ class GoogleCalendarBackend(cal.CalendarBackend):
         self.account = account
         self.account_manager = account_manager
         
-    def get_events(self, now):
+    def get_window_events(self, start_date, end_date):
         self.cal_client = gdata.calendar.client.CalendarClient(source='%s-%s' % ( g15globals.name, g15globals.version ) )
         
         # Reload the account
@@ -134,7 +133,7 @@ class GoogleCalendarBackend(cal.CalendarBackend):
                     raise Exception(_("Authentication cancelled"))
                 
                 try :
-                    return self._retrieve_events(now, password)
+                    return self._retrieve_events(start_date, end_date, password)
                 except gdata.client.BadAuthentication as e:
                     logger.debug("Error authenticating", exc_info = e)
                     pass
@@ -142,16 +141,14 @@ class GoogleCalendarBackend(cal.CalendarBackend):
         raise Exception(_("Authentication attempted too many times"))  
         
         
-    def _retrieve_events(self, now, password):
-        event_days = {}
+    def _retrieve_events(self, start_date, end_date, password):
+        events = []
         self.cal_client.ClientLogin(self.account.get_property("username", ""), password, self.cal_client.source)
         self.account_manager.store_password(self.account, password, "www.google.com", None)
-        start_date = datetime.date(now.year, now.month, 1)
-        end_date = datetime.date(now.year, now.month, calendar.monthrange(now.year, now.month)[1])
         feeds = self.cal_client.GetAllCalendarsFeed()
         
         for i, a_calendar in zip(xrange(len(feeds.entry)), feeds.entry):
-            query = gdata.calendar.client.CalendarEventQuery(start_min=start_date, start_max=end_date)
+            query = gdata.calendar.client.CalendarEventQuery(start_min=start_date, start_max=end_date + datetime.timedelta(1))
             logger.info("Retrieving events from %s to %s", str(start_date), str(end_date))
             feed = self.cal_client.GetCalendarEventFeed(a_calendar.content.src, q = query)
             
@@ -165,8 +162,8 @@ class GoogleCalendarBackend(cal.CalendarBackend):
                 An event may have multiple times. cal doesn't support multiple times, so we add multiple events instead
                 """
                 for a_when in an_event.when:
-                    self.check_and_add(GoogleEvent(a_when, an_event, color, a_calendar.content.src), now, event_days)
+                    events.append(GoogleEvent(a_when, an_event, color, a_calendar.content.src))
                 
-        return event_days
+        return events
         
 
@@ -34,6 +34,7 @@ import time
 import os, os.path
 import gtk
 import calendar
+import calstore
 
 # Logging
 import logging
@@ -75,6 +76,7 @@ REFRESH_INTERVAL = 15 * 60
 # Configuration
 CONFIG_PATH = os.path.join(g15globals.user_config_dir, "plugin-data", "cal", "calendars.xml")
 CONFIG_ITEM_NAME = "calendar"
+CACHE_FILE = os.path.join(g15globals.user_cache_dir, "cal", "events.cache")
 
 """
 Functions
@@ -132,13 +134,48 @@ class CalendarBackend():
             day = ve.start_date.day
             while day <= ve.end_date.day:
                 key = str(day)
-                day_event_list = event_days[key] if key is event_days else None
+                day_event_list = event_days[key] if key in event_days else None
                 if day_event_list is None:
                     day_event_list = list()
                     event_days[key] = day_event_list
                 day_event_list.append(ve)
                 day += 1
     
+    def get_sync_token(self, start_date, end_date):
+        """
+        Get a value that changes whenever the events between two dates
+        change, such as a modification time or an ETag. The events will only
+        be fetched again when the token differs from the one they were
+        fetched with. None means the backend cannot tell, and the events
+        will be fetched again once they are older than REFRESH_INTERVAL. 
+        
+        Keyword arguments:
+        start_date          -- first day
+        end_date            -- last day
+        """
+        return None
+    
+    def get_window_events(self, start_date, end_date):
+        """
+        Get a list of all events that fall between two dates (inclusive).
+        Recurring events should be expanded into an event for each
+        occurrence. Backends that only implement get_events() will be
+        asked for the month in the middle of the window.
+        
+        Keyword arguments:
+        start_date          -- first day
+        end_date            -- last day
+        """
+        middle = start_date + ( end_date - start_date ) / 2
+        event_days = self.get_events(datetime.datetime(middle.year, middle.month, middle.day))
+        events = []
+        if event_days is not None:
+            for day_events in event_days.values():
+                for event in day_events:
+                    if not event in events:
+                        events.append(event)
+        return events
+    
     def get_events(self, now):
         raise Exception("Not implemented")
     
@@ -262,7 +299,11 @@ class G15Cal(g15plugin.G15Plugin):
         g15plugin.G15Plugin.activate(self)
         
         self._active = True
-        self._event_days = None
+        self._store = calstore.EventStore(CACHE_FILE)
+        self._store_loaded = False
+        self._cells = {}
+        self._cells_month = None
+        self._menu_date = None
         self._calendar_date = None
         self._page = None
         self._theme = g15theme.G15Theme(os.path.join(os.path.dirname(__file__), "default"), auto_dirty = False)
@@ -368,7 +409,7 @@ class G15Cal(g15plugin.G15Plugin):
         if amount == 0 or o_date.month != self._calendar_date.month or o_date.year != self._calendar_date.year:
             self._load_month_events(self._calendar_date)
         else:            
-            g15screen.run_on_redraw(self._rebuild_components, self._calendar_date)
+            g15screen.run_on_redraw(self._update_components, self._calendar_date, set())
         
     def _get_calendar_date(self):
         now = datetime.datetime.now()
@@ -411,7 +452,7 @@ class G15Cal(g15plugin.G15Plugin):
         properties["cal_year"] = calendar_date.strftime("%Y")
         properties["cal_short_year"] = calendar_date.strftime("%y")
         properties["cal_locale_date"] = calendar_date.strftime("%x")
-        if self._event_days is None or not str(calendar_date.day) in self._event_days:
+        if not self._store.has_events(calendar_date.date()):
             properties["message"] = "No events"
             properties["events"] = False
         else:
@@ -420,13 +461,13 @@ class G15Cal(g15plugin.G15Plugin):
         return properties
     
     def _load_month_events(self, now):
-        self._event_days = {}
-        
-        for c in self._page.get_children():
-            if isinstance(c, Cell):
-                pass
+        if not self._store_loaded:
+            self._store.load()
+            self._store_loaded = True
             
-        # Get all the events for this month
+        # Bring the events for the days shown this month up to date
+        window = calstore.get_window(now)
+        changed = self._store.retain([ acc.name for acc in self._account_manager.accounts ])
         for acc in self._account_manager.accounts:
             try:
                 backend = get_backend(acc.type)
@@ -437,42 +478,59 @@ class G15Cal(g15plugin.G15Plugin):
                     import gnome15.g15pluginmanager as g15pluginmanager
                     needs_net = g15pluginmanager.is_needs_network(backend)
                     if not needs_net or ( needs_net and self.screen.service.network_manager.is_network_available() ):
-                        backend_events = backend.create_backend(acc, self._account_manager).get_events(now)
-                        if backend_events is None:
-                            logger.warning("Calendar returned no events, skipping")
-                        else:
-                            self._event_days = dict(self._event_days.items() + \
-                                                    backend_events.items())
+                        changed |= self._store.sync(acc, backend.create_backend(acc, self._account_manager), \
+                                                    window, REFRESH_INTERVAL)
                     else:
                         logger.warn("Skipping backend %s because it requires the network, " \
-                                    "and the network is not availabe", acc.type)
+                                    "and the network is not availabe. Cached events will be shown", acc.type)
             except Exception as e:
                 logger.warn("Failed to load events for account %s.", acc.name, exc_info = e)
+        self._store.save()
                     
-        g15screen.run_on_redraw(self._rebuild_components, now)
-        self._page.mark_dirty()
-        
-    def _rebuild_components(self, now):
-        self._menu.remove_all_children()
-        if str(now.day) in self._event_days:
-            events = self._event_days[str(now.day)]
+        g15screen.run_on_redraw(self._update_components, now, changed)
+        
+    def _update_components(self, now, changed):
+        """
+        Update the menu and date cells for the selected date. The cells are
+        only created when the month changes, otherwise just the events of
+        those whose dates have changed are updated.
+        
+        Keyword arguments:
+        now            -- selected date
+        changed        -- set of dates whose events have changed
+        """
+        date = now.date()
+        if self._menu_date != date or date in changed:
+            self._menu_date = date
+            self._menu.remove_all_children()
             i = 0
-            for event in events:
+            for event in self._store.get_events(date):
                 self._menu.add_child(EventMenuItem(self, event, "menuItem-%d" % i))
                 i += 1
             
         # Add the date cell components
-        self._calendar.remove_all_children()
-        cal = calendar.Calendar()
-        i = 0
-        for day in cal.itermonthdates(now.year, now.month):
-            event = None
-            if str(day.day) in self._event_days:
-                event = self._event_days[str(day.day)][0]            
-            self._calendar.add_child(Cell(day, now, event, "cell-%d" % i))
-            i += 1
+        if self._cells_month != ( now.year, now.month ):
+            self._cells_month = ( now.year, now.month )
+            self._cells = {}
+            self._calendar.remove_all_children()
+            cal = calendar.Calendar()
+            i = 0
+            for day in cal.itermonthdates(now.year, now.month):
+                events = self._store.get_events(day)
+                cell = Cell(day, now, events[0] if len(events) > 0 else None, "cell-%d" % i)
+                self._cells[day] = cell
+                self._calendar.add_child(cell)
+                i += 1
+            self._page.mark_dirty()
+        else:
+            # Cell themes redraw themselves when their properties change
+            for day, cell in self._cells.items():
+                cell.now = now
+                if day in changed:
+                    events = self._store.get_events(day)
+                    cell.event = events[0] if len(events) > 0 else None
+            self._theme.mark_dirty()
             
-        self._page.mark_dirty()
         self._page.redraw()
         
     def _schedule_redraw(self):
@@ -0,0 +1,325 @@
+#  Gnome15 - Suite of tools for the Logitech G series keyboards and headsets
+#  Copyright (C) 2010 Brett Smith <tanktarta@blueyonder.co.uk>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Date indexed store of calendar events for the Calendar plugin. Events are
+fetched from each backend a window (the days shown for one month) at a time
+and kept per account, along with the sync token the backend gave for that
+window, so a window is only fetched again when the backend says it has
+changed. Windows are cached on disk so events are available immediately
+(and without a network) when the plugin starts.
+"""
+
+import gnome15.util.g15os as g15os
+import os
+import time
+import datetime
+import calendar
+import threading
+import cPickle
+
+# Logging
+import logging
+logger = logging.getLogger(__name__)
+
+# Increase when the format of the cache changes
+STORE_VERSION = 1
+
+# Most windows to keep for each account
+MAX_WINDOWS = 12
+
+"""
+Functions
+"""
+
+def to_date(value):
+    """
+    Get the date part of a date or datetime.
+
+    Keyword arguments:
+    value        -- date or datetime
+    """
+    return value.date() if isinstance(value, datetime.datetime) else value
+
+def get_window(date):
+    """
+    Get the first and last day shown on the calendar for the month containing
+    the given date. This includes days from the neighbouring months that
+    fill the first and last weeks.
+
+    Keyword arguments:
+    date        -- date within the month
+    """
+    days = list(calendar.Calendar().itermonthdates(date.year, date.month))
+    return ( days[0], days[-1] )
+
+def get_event_dates(event, start_date, end_date):
+    """
+    Get the days between start_date and end_date (inclusive) that an event
+    falls on.
+
+    Keyword arguments:
+    event        -- event
+    start_date   -- first day
+    end_date     -- last day
+    """
+    day = max(to_date(event.start_date), start_date)
+    last = min(to_date(event.end_date if event.end_date is not None else event.start_date), end_date)
+    dates = []
+    while day <= last:
+        dates.append(day)
+        day += datetime.timedelta(1)
+    return dates
+
+def get_window_dates(window):
+    """
+    Get every day in a window.
+
+    Keyword arguments:
+    window        -- tuple of first and last date
+    """
+    dates = []
+    day = window[0]
+    while day <= window[1]:
+        dates.append(day)
+        day += datetime.timedelta(1)
+    return dates
+
+def get_sort_key(event):
+    start = event.start_date
+    return ( to_date(start), getattr(start, "hour", 0), getattr(start, "minute", 0), event.summary )
+
+def get_signature(event):
+    return ( event.summary, str(event.start_date), str(event.end_date), event.alarm, event.color )
+
+def get_account_key(account):
+    return ( account.type, tuple(sorted(account.properties.items())) )
+
+class StoredWindow():
+
+    def __init__(self, account_key, token, events):
+        self.account_key = account_key
+        self.token = token
+        self.events = events
+        self.fetched = time.time()
+        self.used = self.fetched
+
+class EventStore():
+
+    def __init__(self, cache_file, max_windows = MAX_WINDOWS):
+        self.cache_file = cache_file
+        self.max_windows = max_windows
+        self._windows = {}
+        self._days = {}
+        self._dirty = False
+        self._lock = threading.RLock()
+
+    def load(self):
+        """
+        Load the windows cached on disk. Windows that can no longer be read
+        (for example because the backend plugin is no longer installed) are
+        skipped.
+        """
+        if not os.path.exists(self.cache_file):
+            return
+        try:
+            f = open(self.cache_file, "rb")
+            try:
+                cache = cPickle.load(f)
+            finally:
+                f.close()
+        except Exception as e:
+            logger.warning("Failed to load calendar cache %s.", self.cache_file, exc_info = e)
+            return
+        if cache.get("version") != STORE_VERSION:
+            return
+        self._lock.acquire()
+        try:
+            for key, data in cache["windows"].items():
+                try:
+                    self._set_window(key, cPickle.loads(data))
+                except Exception as e:
+                    logger.debug("Skipping cached calendar window %s", str(key), exc_info = e)
+        finally:
+            self._lock.release()
+
+    def save(self):
+        """
+        Write the windows to the cache on disk if any have changed.
+        """
+        self._lock.acquire()
+        try:
+            if not self._dirty:
+                return
+            windows = {}
+            for key, stored in self._windows.items():
+                try:
+                    windows[key] = cPickle.dumps(stored, 2)
+                except Exception as e:
+                    logger.debug("Calendar window %s cannot be cached", str(key), exc_info = e)
+            self._dirty = False
+        finally:
+            self._lock.release()
+        try:
+            g15os.mkdir_p(os.path.dirname(self.cache_file))
+            tmp_file = "%s.%d" % ( self.cache_file, os.getpid() )
+            f = open(tmp_file, "wb")
+            try:
+                cPickle.dump({ "version" : STORE_VERSION, "windows" : windows }, f, 2)
+            finally:
+                f.close()
+            os.rename(tmp_file, self.cache_file)
+        except Exception as e:
+            logger.warning("Failed to save calendar cache %s.", self.cache_file, exc_info = e)
+
+    def sync(self, account, backend, window, max_age):
+        """
+        Bring the events for an account up to date for a window. The backend
+        is only asked for events if its sync token for the window has
+        changed, or if it does not provide tokens and the events are older
+        than max_age seconds. Returns the set of dates whose events changed.
+
+        Keyword arguments:
+        account      -- account
+        backend      -- backend for the account
+        window       -- tuple of first and last date
+        max_age      -- seconds before events without a sync token are fetched again
+        """
+        key = ( account.name, window )
+        account_key = get_account_key(account)
+        changed = set()
+        self._lock.acquire()
+        try:
+            stored = self._windows.get(key)
+            if stored is not None and stored.account_key != account_key:
+                # The account has been edited, everything cached for it is suspect
+                changed |= self.retain([ a for a in self._get_account_names() if a != account.name ])
+                stored = None
+            if stored is not None:
+                stored.used = time.time()
+        finally:
+            self._lock.release()
+
+        token = backend.get_sync_token(window[0], window[1])
+        if stored is not None:
+            if token is None and time.time() - stored.fetched < max_age:
+                return changed
+            if token is not None and token == stored.token:
+                logger.debug("Events for %s from %s to %s are up to date", account.name, str(window[0]), str(window[1]))
+                return changed
+
+        logger.info("Fetching events for %s from %s to %s", account.name, str(window[0]), str(window[1]))
+        started = time.time()
+        events = backend.get_window_events(window[0], window[1])
+        stored = StoredWindow(account_key, token, events)
+        stored.fetched = started
+        self._lock.acquire()
+        try:
+            changed |= self._set_window(key, stored)
+            changed |= self._trim(account.name)
+            self._dirty = True
+        finally:
+            self._lock.release()
+        return changed
+
+    def retain(self, account_names):
+        """
+        Remove the events for any accounts not in the list. Returns the set
+        of dates whose events changed.
+
+        Keyword arguments:
+        account_names -- names of accounts to keep
+        """
+        changed = set()
+        self._lock.acquire()
+        try:
+            for key in list(self._windows.keys()):
+                if not key[0] in account_names:
+                    changed |= self._set_window(key, None)
+                    self._dirty = True
+        finally:
+            self._lock.release()
+        return changed
+
+    def get_events(self, date):
+        """
+        Get all events from all accounts that fall on a date, in the order
+        they start. Neighbouring windows overlap, so for each account the
+        events come from the most recently fetched window that covers the
+        date, even if that window has no events on it (they may have been
+        deleted since the older window was fetched).
+
+        Keyword arguments:
+        date        -- date
+        """
+        self._lock.acquire()
+        try:
+            newest = {}
+            for key, stored in self._windows.items():
+                if key[1][0] <= date <= key[1][1]:
+                    current = newest.get(key[0])
+                    if current is None or stored.fetched > self._windows[current].fetched:
+                        newest[key[0]] = key
+            events = []
+            account_days = self._days.get(date, {})
+            for account_name, key in newest.items():
+                events += account_days.get(account_name, {}).get(key, [])
+            return sorted(events, key = get_sort_key)
+        finally:
+            self._lock.release()
+
+    def has_events(self, date):
+        return len(self.get_events(date)) > 0
+
+    """
+    Private
+    """
+
+    def _get_account_names(self):
+        return set([ key[0] for key in self._windows ])
+
+    def _set_window(self, key, stored):
+        old = self._windows.get(key)
+
+        # The newest window decides the events of every day it covers, not
+        # just the days it has events on
+        dates = set(get_window_dates(key[1]))
+        before = dict([ ( d, [ get_signature(e) for e in self.get_events(d) ] ) for d in dates ])
+
+        if old is not None:
+            del self._windows[key]
+            for d in dates:
+                account_windows = self._days.get(d, {}).get(key[0])
+                if account_windows is not None and key in account_windows:
+                    del account_windows[key]
+                    if len(account_windows) == 0:
+                        del self._days[d][key[0]]
+                        if len(self._days[d]) == 0:
+                            del self._days[d]
+        if stored is not None:
+            self._windows[key] = stored
+            for event in stored.events:
+                for d in get_event_dates(event, key[1][0], key[1][1]):
+                    self._days.setdefault(d, {}).setdefault(key[0], {}).setdefault(key, []).append(event)
+
+        return set([ d for d in dates if before[d] != [ get_signature(e) for e in self.get_events(d) ] ])
+
+    def _trim(self, account_name):
+        changed = set()
+        keys = sorted([ k for k in self._windows if k[0] == account_name ], key = lambda k: self._windows[k].used)
+        for key in keys[:max(0, len(keys) - self.max_windows)]:
+            changed |= self._set_window(key, None)
+        return changed
@@ -23,6 +23,8 @@ import gnome15.g15globals as g15globals
 import gnome15.g15plugin as g15plugin
 import gnome15.g15theme as g15theme
 import gnome15.util.g15scheduler as g15scheduler
+import gnome15.util.jobqueue as jobqueue
+import gnome15.g15dconf as g15dconf
 import pango
 import os
 import sys
@@ -285,6 +287,118 @@ class G15DBUSDebugService(dbus.service.Object):
     def ToggleDebugSVG(self):
         g15theme.DEBUG_SVG = not g15theme.DEBUG_SVG
         
+    @dbus.service.method(DEBUG_IF_NAME)
+    def JobMetrics(self):
+        print "%-30s %-30s %8s %8s %8s %10s %10s %10s" % ( "Queue", "Job", "Count", "Failed", "Backlog", "Avg Wait", "Avg Run", "Total Run" )
+        for entry in sorted(g15scheduler.scheduler.get_metrics(), key = lambda entry: entry.total_run, reverse = True):
+            count = max(1, entry.count)
+            print "%-30s %-30s %8d %8d %8d %10.4f %10.4f %10.4f" % ( entry.queue_name, entry.job_name, entry.count, entry.failures, entry.backlog,
+                                                               entry.total_wait / count, entry.total_run / count, entry.total_run )
+        
+    @dbus.service.method(DEBUG_IF_NAME)
+    def ResetJobMetrics(self):
+        g15scheduler.scheduler.metrics.reset()
+        
+    @dbus.service.method(DEBUG_IF_NAME)
+    def ToggleStackCapture(self):
+        jobqueue.CAPTURE_STACKS = not jobqueue.CAPTURE_STACKS
+        
+    @dbus.service.method(DEBUG_IF_NAME)
+    def ToggleCompiledThemes(self):
+        g15theme.COMPILE_THEMES = not g15theme.COMPILE_THEMES
+        
+    @dbus.service.method(DEBUG_IF_NAME)
+    def RenderCache(self):
+        print "Render Cache"
+        print "------------"
+        for k, v in sorted(g15theme.render_cache.get_statistics().items()):
+            print "%-30s %d" % ( k, v )
+        
+    @dbus.service.method(DEBUG_IF_NAME)
+    def ClearRenderCache(self):
+        g15theme.render_cache.clear()
+        
+    @dbus.service.method(DEBUG_IF_NAME)
+    def ThemeDocuments(self):
+        print "Theme Documents"
+        print "---------------"
+        for k, v in sorted(g15theme.document_store.get_statistics().items()):
+            print "%-30s %d" % ( k, v )
+        
+    @dbus.service.method(DEBUG_IF_NAME)
+    def PluginImports(self):
+        import gnome15.g15pluginmanager as g15pluginmanager
+        print "Plugin Imports"
+        print "--------------"
+        for mod in sorted(g15pluginmanager.imported_plugins, key = lambda m: m.id):
+            if mod.id in g15pluginmanager.import_times:
+                print "%-30s %10.3f" % ( mod.id, g15pluginmanager.import_times[mod.id] )
+            else:
+                print "%-30s %10s" % ( mod.id, "-" )
+        print "%-30s %10.3f" % ( "Total", sum(g15pluginmanager.import_times.values()) )
+        
+    @dbus.service.method(DEBUG_IF_NAME, in_signature='i')
+    def BenchmarkThemes(self, renders):
+        import gnome15.g15pluginmanager as g15pluginmanager
+        theme_dirs = []
+        for plugin_dir in g15pluginmanager.all_plugin_directories:
+            theme_dir = os.path.join(plugin_dir, "default")
+            if os.path.isdir(theme_dir):
+                theme_dirs.append(theme_dir)
+        for scr in self._service.screens:
+            print "Screen %s" % scr.device.uid
+            print "%-40s %12s %12s" % ( "Theme", "Full/s", "Compiled/s" )
+            for theme_dir, full, compiled in g15theme.benchmark(scr, theme_dirs, renders):
+                print "%-40s %12.1f %12.1f" % ( os.path.basename(os.path.dirname(theme_dir)), full, compiled )
+        
+    @dbus.service.method(DEBUG_IF_NAME, in_signature='i')
+    def BenchmarkKeys(self, macros):
+        import gnome15.g15keyboard as g15keyboard
+        scanned, indexed = g15keyboard.benchmark(macros = macros)
+        print "Key dispatch (%d macros)" % macros
+        print "------------"
+        print "%-30s %12.1f" % ( "Scan (us/event)", scanned * 1000000.0 )
+        print "%-30s %12.1f" % ( "Index (us/event)", indexed * 1000000.0 )
+        
+    @dbus.service.method(DEBUG_IF_NAME, in_signature='i')
+    def BenchmarkProcesses(self, processes):
+        import gnome15.g15top as g15top
+        read_all, table, verified = g15top.benchmark(processes = processes)
+        print "Process list refresh (%d processes)" % processes
+        print "--------------------"
+        print "%-30s %12.2f" % ( "Read all (ms)", read_all * 1000.0 )
+        print "%-30s %12.2f" % ( "Table (ms)", table * 1000.0 )
+        print "%-30s %12.2f" % ( "Table, verified (ms)", verified * 1000.0 )
+        
+    @dbus.service.method(DEBUG_IF_NAME, in_signature='i')
+    def BenchmarkSysmon(self, cpus):
+        import gnome15.g15pluginmanager as g15pluginmanager
+        per_cpu, per_tick = g15pluginmanager.get_module_for_id("sysmon").benchmark(cpus = cpus)
+        print "System monitor tick (%d CPUs)" % cpus
+        print "--------------------"
+        print "%-30s %12.1f" % ( "Parse per CPU (us/tick)", per_cpu * 1000000.0 )
+        print "%-30s %12.1f" % ( "Parse per tick (us/tick)", per_tick * 1000000.0 )
+        
+    @dbus.service.method(DEBUG_IF_NAME, in_signature='i')
+    def BenchmarkImpulse(self, frames):
+        import gnome15.g15pluginmanager as g15pluginmanager
+        results = g15pluginmanager.get_module_for_id("impulse15").benchmark(frames = frames)
+        print "Impulse15 frame (320x240)"
+        print "-------------------------"
+        print "%-30s %12s %12s %12s" % ( "", "ms/frame", "% of 30fps", "% of 60fps" )
+        for name, per_frame in results:
+            print "%-30s %12.2f %12.1f %12.1f" % ( name, per_frame * 1000.0, per_frame * 30 * 100.0, per_frame * 60 * 100.0 )
+        
+    @dbus.service.method(DEBUG_IF_NAME, in_signature='i')
+    def BenchmarkMacros(self, delay):
+        import gnome15.g15service as g15service
+        keys_per_second, mean_error, max_error = g15service.benchmark_macros(delay = delay)
+        print "Macro scripts"
+        print "-------------"
+        print "%-30s %12.1f" % ( "Keys/s", keys_per_second )
+        print "%-30s %12.3f" % ( "Mean delay error (ms)", mean_error * 1000.0 )
+        print "%-30s %12.3f" % ( "Max delay error (ms)", max_error * 1000.0 )
+        
     @dbus.service.method(DEBUG_IF_NAME)
     def MostCommonTypes(self):
         print "Most used objects"
@@ -425,6 +539,25 @@ class G15Debug(g15plugin.G15RefreshingPlugin):
         properties["stack_k"] = "%f" % ( self.stack / 1024 )
         properties["stack_mb"] = "%.2f" % ( self.stack / 1024 / 1024 )
         properties["stack_gb"] = "%.2f" % ( self.stack / 1024 / 1024 / 1024 )
+        if self.screen.driver is not None:
+            for k, v in self.screen.driver.get_frame_statistics().items():
+                properties[k] = "%d" % v
+        for k, v in g15theme.render_cache.get_statistics().items():
+            properties[k] = "%d" % v
+        for k, v in g15theme.document_store.get_statistics().items():
+            properties[k] = "%d" % v
+        for k, v in g15dconf.get_statistics().items():
+            properties["dconf_%s" % k] = "%.2f" % v if k == "hit_rate" else "%d" % v
+        for k, v in self.screen.get_redraw_statistics().items():
+            properties[k] = "%.1f" % v if k == "redraw_fps" else "%d" % v
+        jobs = g15scheduler.scheduler.get_metrics()
+        properties["jobs_run"] = "%d" % sum([ entry.count for entry in jobs ])
+        properties["jobs_failed"] = "%d" % sum([ entry.failures for entry in jobs ])
+        properties["jobs_backlog"] = "%d" % sum([ entry.backlog for entry in jobs ])
+        if len(jobs) > 0:
+            slowest = max(jobs, key = lambda entry: entry.total_run)
+            properties["jobs_slowest"] = "%s/%s" % ( slowest.queue_name, slowest.job_name )
+            properties["jobs_slowest_run"] = "%.3f" % slowest.total_run
         return properties
         
     def _silently_remove_from_connector(self, obj):
@@ -25,6 +25,11 @@ import os
 import time
 import cairo
 import random
+import threading
+
+# Logging
+import logging
+logger = logging.getLogger(__name__)
 
 
 # Plugin details - All of these must be provided
@@ -55,6 +60,257 @@ def show_preferences(parent, driver, gconf_client, gconf_key):
     
 effects = [ "vertical-scroll", "horizontal-scroll", "fade", "zoom" ]
 
+# Shortest and longest time a transition takes (seconds)
+MIN_DURATION = 0.1
+MAX_DURATION = 2.0
+
+def get_duration(speed):
+    """
+    Get how long a transition takes at the configured animation speed.
+    
+    Keyword arguments:
+    speed        -- animation speed, 0 - 50
+    """
+    return max(MIN_DURATION, MAX_DURATION / ( 1.0 + max(0.0, speed) ))
+
+def compose(context, effect, direction, progress, old_surface, new_surface, width, height):
+    """
+    Draw one frame of a transition. Each frame is at most two paints of the
+    old and new surfaces, so frames can be generated as they are needed.
+    
+    Keyword arguments:
+    context        -- context to draw the frame on
+    effect         -- effect name
+    direction      -- "up" or "down"
+    progress       -- how far through the transition, 0.0 - 1.0
+    old_surface    -- surface of the page being left
+    new_surface    -- surface of the page being shown
+    width          -- width of the frame
+    height         -- height of the frame
+    """
+    context.save()
+    context.set_operator(cairo.OPERATOR_SOURCE)
+    if effect == "vertical-scroll" or effect == "horizontal-scroll":
+        dx, dy = ( 0, height ) if effect == "vertical-scroll" else ( width, 0 )
+        if direction == "down":
+            first, second, offset = old_surface, new_surface, progress
+        else:
+            first, second, offset = new_surface, old_surface, 1.0 - progress
+        
+        # Whole pixel offsets keep each paint a plain copy
+        context.set_source_surface(first, -int(round(dx * offset)), -int(round(dy * offset)))
+        context.paint()
+        context.set_operator(cairo.OPERATOR_OVER)
+        context.set_source_surface(second, int(round(dx * ( 1.0 - offset ))), int(round(dy * ( 1.0 - offset ))))
+        context.paint()
+    elif effect == "fade":
+        context.set_source_surface(old_surface)
+        context.paint()
+        context.set_operator(cairo.OPERATOR_OVER)
+        context.set_source_surface(new_surface)
+        context.paint_with_alpha(progress)
+    elif effect == "zoom":
+        # Zoom the new page in, or the old page out
+        if direction == "down":
+            back, front, scale = old_surface, new_surface, progress
+        else:
+            back, front, scale = new_surface, old_surface, 1.0 - progress
+        context.set_source_surface(back)
+        context.paint()
+        if scale > 0:
+            context.set_operator(cairo.OPERATOR_OVER)
+            context.translate(( width - width * scale ) / 2, ( height - height * scale ) / 2)
+            context.scale(scale, scale)
+            context.set_source_surface(front)
+            context.paint()
+    context.restore()
+
+class TransitionEngine():
+    """
+    Runs transitions on a thread of its own, so drawing is not held up while
+    a transition is running. The old and new pages are copied when the
+    transition starts, and frames are generated from the copies as they fall
+    due. Frames are paced to the screen's frame rate, or to the time the
+    driver actually takes to paint a frame if that is longer, so a slow
+    device gets fewer frames rather than a longer transition. Starting a
+    new transition interrupts the current one, continuing from whatever
+    frame is on the LCD.
+    """
+    
+    def __init__(self, screen, present):
+        self.screen = screen
+        self.present = present
+        self.paint_time = None
+        self._lock = threading.RLock()
+        self._condition = threading.Condition(self._lock)
+        self._present_lock = threading.Lock()
+        self._dirty = False
+        self._size = None
+        self._started = None
+        self._generation = 0
+        self._stopping = False
+        self._thread = None
+        
+    def is_running(self):
+        return self._started is not None
+        
+    def start(self, old_surface, new_surface, effect, direction, duration):
+        """
+        Start a transition, interrupting any that is already running.
+        
+        Keyword arguments:
+        old_surface    -- surface of the page being left
+        new_surface    -- surface of the page being shown
+        effect         -- effect name
+        direction      -- "up" or "down"
+        duration       -- time the transition takes (seconds)
+        """
+        self._lock.acquire()
+        try:
+            size = ( self.screen.width, self.screen.height )
+            if size != self._size:
+                self._size = size
+                self._old, self._old_context = self._create_surface()
+                self._new, self._new_context = self._create_surface()
+                self._frame, self._frame_context = self._create_surface()
+                self._started = None
+                
+            # If interrupted, carry on from the frame currently shown
+            self._blit(self._old_context, self._frame if self._started is not None else old_surface)
+            self._blit(self._new_context, new_surface)
+            self._effect = effect
+            self._direction = direction
+            self._duration = duration
+            self._started = time.time()
+            self._generation += 1
+            self._frames = 0
+            if self._thread is None:
+                self._stopping = False
+                self._thread = threading.Thread(target = self._run, name = "FxTransition")
+                self._thread.setDaemon(True)
+                self._thread.start()
+            self._condition.notify()
+        finally:
+            self._lock.release()
+        
+    def paint(self, surface):
+        """
+        Paint a surface drawn by the screen. While a transition is running,
+        the surface instead becomes the page being transitioned to, so
+        changes to it are shown as the transition continues.
+        
+        Keyword arguments:
+        surface        -- surface to paint
+        """
+        self._lock.acquire()
+        try:
+            if self._started is not None:
+                self._blit(self._new_context, surface)
+                self._dirty = True
+                return
+            # Wait for any frame still being presented so it cannot replace this one
+            self._present_lock.acquire()
+        finally:
+            self._lock.release()
+        try:
+            self.present(surface)
+        finally:
+            self._present_lock.release()
+        
+    def cancel(self):
+        """
+        Stop any running transition where it is. The next surface painted is
+        shown immediately.
+        """
+        self._lock.acquire()
+        try:
+            self._started = None
+            self._generation += 1
+        finally:
+            self._lock.release()
+    
+    def stop(self):
+        """
+        Stop any running transition and the transition thread.
+        """
+        self._lock.acquire()
+        try:
+            self._started = None
+            self._stopping = True
+            thread = self._thread
+            self._thread = None
+            self._condition.notify()
+        finally:
+            self._lock.release()
+        if thread is not None and thread is not threading.currentThread():
+            thread.join()
+        
+    """
+    Private
+    """
+        
+    def _create_surface(self):
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, self._size[0], self._size[1])
+        return surface, cairo.Context(surface)
+        
+    def _blit(self, context, surface):
+        context.set_operator(cairo.OPERATOR_SOURCE)
+        context.set_source_surface(surface)
+        context.paint()
+        
+    def _get_frame_interval(self):
+        max_fps = self.screen.get_redraw_statistics()["redraw_max_fps"]
+        return 1.0 / max_fps if max_fps > 0 else 1.0 / g15driver.COLOR_MAX_FPS
+        
+    def _run(self):
+        while True:
+            self._lock.acquire()
+            try:
+                while self._started is None and not self._stopping:
+                    self._condition.wait()
+                if self._stopping:
+                    return
+                
+                frame_started = time.time()
+                generation = self._generation
+                progress = min(1.0, ( frame_started - self._started ) / self._duration)
+                compose(self._frame_context, self._effect, self._direction, progress, self._old, self._new, self._size[0], self._size[1])
+                self._dirty = False
+                self._present_lock.acquire()
+            finally:
+                self._lock.release()
+                
+            # Present without the lock, so the screen can keep drawing meanwhile
+            try:
+                self.present(self._frame)
+            finally:
+                self._present_lock.release()
+                
+            self._lock.acquire()
+            try:
+                self._frames += 1
+                
+                # Smoothed time the driver takes to paint a frame
+                paint_time = time.time() - frame_started
+                self.paint_time = paint_time if self.paint_time is None else self.paint_time * 0.7 + paint_time * 0.3
+                
+                if generation != self._generation:
+                    # Cancelled, or interrupted by another transition
+                    continue
+                if progress >= 1.0:
+                    if not self._dirty:
+                        logger.debug("Transition %s took %d frames, %.1fms per frame", self._effect, self._frames, self.paint_time * 1000.0)
+                        self._started = None
+                    # Otherwise the page changed while the last frame was presented, present it again
+                    continue
+                delay = frame_started + max(self._get_frame_interval(), self.paint_time) - time.time()
+            finally:
+                self._lock.release()
+                
+            # Sleep without the lock so pages may still be drawn 
+            if delay > 0:
+                time.sleep(delay)
+
 class G15Fx():
     
     def __init__(self, gconf_key, gconf_client, screen):
@@ -63,12 +319,16 @@ class G15Fx():
         self.gconf_key = gconf_key
     
     def activate(self):
-        self.chained_transition =self.screen.set_transition(self.transition)
+        self.engine = TransitionEngine(self.screen, self._present)
+        self.chained_painter = self.screen.set_painter(self.engine.paint)
+        self.chained_transition = self.screen.set_transition(self.transition)
         self.notify_handler = self.gconf_client.notify_add(self.gconf_key, self.config_changed)
     
     def deactivate(self):
         self.gconf_client.notify_remove(self.notify_handler)
         self.screen.set_transition(self.chained_transition)
+        self.screen.set_painter(self.chained_painter)
+        self.engine.stop()
         
     def destroy(self):
         pass
@@ -81,6 +341,10 @@ class G15Fx():
     
     
     def transition(self, old_surface, new_surface, old_page, new_page, direction="up"):
+        # The screen calls this for every redraw, only page changes are of interest
+        if new_page == None or old_page == None or old_page == new_page:
+            return
+        
         # Determine effect to use
         effect = self.gconf_client.get_string(self.gconf_key + "/transition_effect")
         if effect == "":
@@ -92,116 +356,22 @@ class G15Fx():
         speed_entry =  self.gconf_client.get(self.gconf_key + "/anim_speed")
         speed = 5.0 if speed_entry == None else speed_entry.get_float()
         
-        # Don't transition for high priority screens
-        if new_page == None or old_page == None or new_page.priority == g15screen.PRI_HIGH:
+        # Don't transition for high priority screens, show them straight away
+        if new_page.priority == g15screen.PRI_HIGH or not effect in effects:
+            self.engine.cancel()
             return
         
-        width = self.screen.width
-        height = self.screen.height  
-        
-        # Create a working surface
-        img_surface = cairo.ImageSurface (cairo.FORMAT_ARGB32, self.screen.width, self.screen.height)
-        img_context = cairo.Context(img_surface)
-        if effect == "vertical-scroll":
-            # Vertical scroll
-            step = max( int(speed), 1 )      
-            if direction == "down":                
-                for i in range(0, self.screen.height, step):
-                    img_context.save()
-                    img_context.translate(0, -i)                
-                    img_context.set_source_surface(old_surface)
-                    img_context.paint()
-                    img_context.translate(0, self.screen.height)
-                    img_context.set_source_surface(new_surface)
-                    img_context.paint()
-                    img_context.restore()
-                    self.screen.driver.paint(img_surface)
-                    self.anim_delay(speed)
-            else:                
-                for i in range(0, self.screen.height, step):
-                    img_context.save() 
-                    img_context.translate(0, -(self.screen.height - i))                
-                    img_context.set_source_surface(new_surface)
-                    img_context.paint()
-                    img_context.translate(0, self.screen.height)
-                    img_context.set_source_surface(old_surface)
-                    img_context.paint()
-                    img_context.restore()
-                    self.screen.driver.paint(img_surface)
-                    self.anim_delay(speed)
-                
-        elif effect == "horizontal-scroll":    
-            # Horizontal scroll
-            step = max( ( width / height ) * speed, 1 )
-            if direction == "down":                
-                for i in range(0, self.screen.width, int(step)):
-                    img_context.save()
-                    img_context.translate(-i, 0)                
-                    img_context.set_source_surface(old_surface)
-                    img_context.paint()
-                    img_context.translate(self.screen.width, 0)
-                    img_context.set_source_surface(new_surface)
-                    img_context.paint()
-                    img_context.restore()
-                    self.screen.driver.paint(img_surface)
-                    self.anim_delay(speed)
-            else:                
-                for i in range(0, self.screen.width, int(step)):
-                    img_context.save() 
-                    img_context.translate(-(self.screen.width - i), 0)                
-                    img_context.set_source_surface(new_surface)
-                    img_context.paint()
-                    img_context.translate(self.screen.width, 0)
-                    img_context.set_source_surface(old_surface)
-                    img_context.paint()
-                    img_context.restore()
-                    self.screen.driver.paint(img_surface)
-                    self.anim_delay(speed)
-        elif effect == "fade":
-            step = max( int(speed), 1 )
-            for i in range(0, 256, step):                
-                img_context.set_source_surface(new_surface)
-                img_context.paint_with_alpha(float(i) / 256.0)                
-                img_context.set_source_surface(old_surface)
-                img_context.paint_with_alpha(1.0 - ( float(i) / 256.0 ) )
-                self.screen.driver.paint(img_surface)
-                self.anim_delay(speed)
-        elif effect == "zoom":
-            step = max( int(speed), 1 )
-            if direction == "down":               
-                for i in range(1, self.screen.width, step):
-                    img_context.save()                
-                    img_context.set_source_surface(old_surface)
-                    img_context.paint() 
-                    scale = i / float(self.screen.width)
-                    scaled_width = self.screen.width * scale
-                    scaled_height = self.screen.height * scale
-                    img_context.translate( ( self.screen.width - scaled_width) / 2, ( self.screen.height - scaled_height) / 2)  
-                    img_context.scale(scale, scale)            
-                    img_context.set_source_surface(new_surface)
-                    img_context.paint()               
-                    img_context.restore()             
-                    self.screen.driver.paint(img_surface)
-                    self.anim_delay(speed)
-            else:                
-                for i in range(self.screen.width, 0, step * -1):
-                    img_context.save()             
-                    img_context.set_source_surface(new_surface)
-                    img_context.paint()               
-                    scale = i / float(self.screen.width)
-                    scaled_width = self.screen.width * scale
-                    scaled_height = self.screen.height * scale
-                    img_context.translate( ( self.screen.width - scaled_width) / 2, ( self.screen.height - scaled_height) / 2)  
-                    img_context.scale(scale, scale)            
-                    img_context.set_source_surface(old_surface)
-                    img_context.paint()               
-                    img_context.restore()  
-                    self.screen.driver.paint(img_surface)
-                    self.anim_delay(speed)
+        # The transition runs on the engine's thread, the screen carries on drawing
+        self.engine.start(old_surface, new_surface, effect, direction, get_duration(speed))
                 
         if self.chained_transition != None:
             self.chained_transition(old_surface, new_surface, old_page, new_page, direction)
-
-    def anim_delay(self, speed):
-        if speed < 1.0:
-            time.sleep( ( 1.0 - speed ) / 50.0 )
\ No newline at end of file
+            
+    ''' Private
+    '''
+    
+    def _present(self, surface):
+        if self.chained_painter != None:
+            self.chained_painter(surface)
+        else:
+            self.screen.driver.paint(surface)
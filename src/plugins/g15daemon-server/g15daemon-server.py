@@ -29,6 +29,7 @@ import gnome15.util.g15convert as g15convert
 import gnome15.util.g15uigconf as g15uigconf
 import gnome15.util.g15gconf as g15gconf
 import gnome15.util.g15cairo as g15cairo
+import gnome15.util.g15pixels as g15pixels
 import gobject
 import gtk
 import logging
@@ -278,19 +279,7 @@ class G15DaemonClient(asyncore.dispatcher):
             logger.info(l)
             
     def convert_gbuf(self, g_buffer):
-        r_buffer = array.array('c', chr(0)*1048)
-        new_buf = ""
-        for x in range(160):
-            for y in range(43):
-                pixel_offset = y * 160 + x
-                byte_offset = pixel_offset / 8
-                bit_offset = 7 - (pixel_offset % 8)    
-                val = ord(g_buffer[x + ( y * 160)])
-                if val:
-                    r_buffer[byte_offset] = chr(ord(r_buffer[byte_offset]) | 1 << bit_offset)
-                else:
-                    r_buffer[byte_offset] = chr(ord(r_buffer[byte_offset])  &  ~(1 << bit_offset))
-        return r_buffer.tostring()
+        return g15pixels.pack_mono(g_buffer, 160, 43, buffer_size = 1048)
          
     def convert_rbuf(self, buffer):
         new_buf = ""
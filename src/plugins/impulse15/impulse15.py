@@ -26,6 +26,7 @@ import gtk
 import os
 import sys
 import datetime
+import impulseanalysis
 
 # Logging
 import logging
@@ -53,6 +54,17 @@ def get_source_index(source_name):
     logger.warn("Audio source %s not found, default to first source", source_name)
     return 0
 
+def benchmark(frames = 300):
+    """
+    Time analysing and drawing a spectrum frame on a G19 sized canvas, the
+    way the plugin used to do it and with the Analyser and batched fills.
+    Returns a list of ( name, seconds per frame ) tuples.
+    
+    Keyword arguments:
+    frames        -- number of frames to draw with each method
+    """
+    return impulseanalysis.benchmark(320, 240, frames)
+
 def create(gconf_key, gconf_client, screen):
     return G15Impulse(gconf_key, gconf_client, screen) 
 
@@ -115,16 +127,14 @@ class G15ImpulsePainter(g15screen.Painter):
         self.plugin = plugin
         self.last_sound = datetime.datetime.now()
         
-    def do_lights(self, audio_sample_array = None):     
-        if not audio_sample_array:
-            audio_sample_array = self._get_sample()
-        
+    def do_lights(self):
+        analyser = self.plugin.analyser
         if self.backlight_acquisition is not None:
-            self.backlight_acquisition.set_value(self._col_avg(audio_sample_array))
-        tot_avg = self._tot_avg(audio_sample_array)
+            self.backlight_acquisition.set_value(analyser.levels)
         if self.mkey_acquisition is not None:
-            self._set_mkey_lights(tot_avg)
-        return tot_avg
+            self._set_mkey_lights(analyser.level)
+        if analyser.level > 0:
+            self.last_sound = datetime.datetime.now()
     
     def is_idle(self):
         return datetime.datetime.now() > ( self.last_sound + datetime.timedelta(0, 5.0) )
@@ -132,53 +142,15 @@ class G15ImpulsePainter(g15screen.Painter):
     def paint(self, canvas):
         if not self.theme_module: 
             return
-        audio_sample_array = self._get_sample()
-        tot_avg = self.do_lights(audio_sample_array)
-        if tot_avg > 0:
-            self.last_sound = datetime.datetime.now()
         
+        # The snapshot was analysed by the last tick, themes just draw it
         canvas.save()
-        self.theme_module.on_draw( audio_sample_array, canvas, self.plugin )
+        self.theme_module.on_draw( self.plugin.analyser.samples, canvas, self.plugin )
         canvas.restore()
         
     """
     Private
     """
-    
-    def _get_sample(self):
-        fft = False
-        if hasattr( self.theme_module, "fft" ) and self.theme_module.fft:
-            fft = True
-
-        audio_sample_array = impulse.getSnapshot( fft )
-        if self.plugin.gain != 1:
-            arr = []
-            for a in audio_sample_array:
-                arr.append(a * self.plugin.gain)
-            audio_sample_array = arr
-        
-        return audio_sample_array
-    
-    def _col_avg(self, list):
-        cols = []
-        each = len(list) / 3
-        z = 0
-        for j in range(0, 3):
-            t = 0
-            for x in range(0, each):
-                t += min(255, list[z] * 340)
-                z += 1
-            cols.append(int(t / each))
-        return ( cols[0], cols[1], cols[2] )
-    
-    def _tot_avg(self, list):
-        sz = len(list)
-        z = 0
-        t = 0
-        for x in range(0, sz):
-            t += min(255, list[z] * 340)
-            z += 1
-        return t / sz
                   
     def _set_mkey_lights(self, val):
         if val > 200:
@@ -212,6 +184,7 @@ class G15Impulse():
         self.last_paint = None
         self.audio_source_index = 0
         self.config_change_timer = None
+        self.analyser = impulseanalysis.Analyser()
 
         import impulse
         sys.modules[ __name__ ].impulse = impulse
@@ -264,30 +237,12 @@ class G15Impulse():
     def destroy(self):
         pass
     
-    def paint(self, canvas):
-        if not self.theme_module: 
-            return
-
-        fft = False
-        if hasattr( self.theme_module, "fft" ) and self.theme_module.fft:
-            fft = True
-
-        audio_sample_array = impulse.getSnapshot( fft )
-        
-        if self.backlight_acquisition is not None:
-            self.backlight_acquisition.set_value(self._col_avg(audio_sample_array))
-        
-        if self.mkey_acquisition is not None:
-            self._set_mkey_lights(self._tot_avg(audio_sample_array))
-        
-        canvas.save()
-        self.theme_module.on_draw( audio_sample_array, canvas, self )
-        canvas.restore()
-    
-    def redraw(self):        
-        if self.screen.driver.get_bpp() == 0:
-            self.painter.do_lights()
-        else:
+    def redraw(self):
+        # Analyse once per tick, the result is shared by the lights and the painter
+        theme_module = self.painter.theme_module
+        self.analyser.update(impulse.getSnapshot( theme_module is not None and getattr( theme_module, "fft", False ) ))
+        self.painter.do_lights()
+        if self.screen.driver.get_bpp() != 0:
             if self.paint_mode == "screen" and self.visible:
                 self.screen.redraw(self.page, queue = False)
             elif self.paint_mode != "screen": 
@@ -362,7 +317,11 @@ class G15Impulse():
         self.col1 = g15gconf.get_cairo_rgba_or_default(self.gconf_client, self.gconf_key + "/col1", ( 255, 0, 0, 255 ))
         self.col2 = g15gconf.get_cairo_rgba_or_default(self.gconf_client, self.gconf_key + "/col2", ( 0, 0, 255, 255 ))
             
-        self.peak_heights = [ 0 for i in range( self.bars ) ]
+        self.analyser.gain = self.gain
+        self.analyser.smoothing = g15gconf.get_float_or_default(self.gconf_client, self.gconf_key + "/smoothing", 0.0)
+        log_bands = g15gconf.get_bool_or_default(self.gconf_client, self.gconf_key + "/log_bands", False)
+        if self.bars != self.analyser.band_count or log_bands != self.analyser.log_bands:
+            self.analyser.set_bands(self.bars, log_bands)
 
         paint = self.gconf_client.get_string(self.gconf_key + "/paint")
         if paint != self.last_paint and self.screen.driver.get_bpp() != 0: 
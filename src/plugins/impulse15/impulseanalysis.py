@@ -0,0 +1,336 @@
+#  Gnome15 - Suite of tools for the Logitech G series keyboards and headsets
+#  Copyright (C) 2010 Brett Smith <tanktarta@blueyonder.co.uk>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Audio analysis and batched drawing for the Impulse15 plugin. The Analyser
+works on a whole snapshot at a time (with NumPy when it is available), once
+per tick, and its results are shared by the themes, the backlight and the
+M-Key lights. The fill functions let themes draw all of their bars with a
+single fill rather than one per bar or segment.
+"""
+
+import cairo
+import math
+import array
+import time
+
+# Logging
+import logging
+logger = logging.getLogger(__name__)
+
+try:
+    import numpy
+except Exception as e:
+    logger.debug("Could not import numpy. Falling back to array based analysis", exc_info = e)
+    numpy = None
+
+# Samples are scaled by this (and clipped to 255) for light levels
+LEVEL_SCALE = 340
+
+class Analyser():
+    """
+    Analyses audio snapshots. After each call to update() the following are
+    available :-
+
+    samples        -- the snapshot with gain applied
+    bands          -- average of each band, smoothed. There are band_count
+                      bands unless the snapshot has fewer samples
+    peaks          -- peak-hold level of each band, falling with acceleration
+    levels         -- ( r, g, b ) average level of each third of the spectrum, 0-255
+    level          -- average level of the whole spectrum, 0-255
+    """
+
+    def __init__(self, bands = 16, gain = 1.0, smoothing = 0.0, peak_acceleration = 0.007, log_bands = False):
+        self.gain = gain
+        self.smoothing = smoothing
+        self.peak_acceleration = peak_acceleration
+        self.samples = []
+        self.levels = ( 0, 0, 0 )
+        self.level = 0
+        self._edges = None
+        self._edges_key = None
+        self.set_bands(bands, log_bands)
+
+    def set_bands(self, bands, log_bands = False):
+        """
+        Set the number of bands the spectrum is divided into, and whether
+        they are linear or logarithmic (so that low frequencies, where most
+        of the interest is, get more bands).
+
+        Keyword arguments:
+        bands        -- number of bands
+        log_bands    -- use logarithmic bands
+        """
+        self.band_count = max(1, bands)
+        self.log_bands = log_bands
+        self._edges_key = None
+        self._reset(self.band_count)
+
+    def update(self, snapshot):
+        """
+        Analyse a snapshot of samples.
+
+        Keyword arguments:
+        snapshot        -- sequence of samples, normally 0.0 - 1.0
+        """
+        if len(snapshot) == 0:
+            return
+        edges = self._get_edges(len(snapshot))
+        if numpy is not None:
+            self._update_numpy(snapshot, edges)
+        else:
+            self._update_array(snapshot, edges)
+
+    """
+    Private
+    """
+    def _reset(self, bands):
+        if numpy is not None:
+            self.bands = numpy.zeros(bands, dtype = numpy.float32)
+            self.peaks = numpy.zeros(bands, dtype = numpy.float32)
+            self._velocity = numpy.zeros(bands, dtype = numpy.float32)
+        else:
+            self.bands = [ 0.0 ] * bands
+            self.peaks = [ 0.0 ] * bands
+            self._velocity = [ 0.0 ] * bands
+
+    def _get_edges(self, sample_count):
+        key = ( sample_count, self.band_count, self.log_bands )
+        if key != self._edges_key:
+            self._edges_key = key
+            self._edges = get_band_edges(sample_count, self.band_count, self.log_bands)
+            if len(self._edges) - 1 != len(self.bands):
+                # Fewer samples than bands
+                self._reset(len(self._edges) - 1)
+        return self._edges
+
+    def _update_numpy(self, snapshot, edges):
+        samples = numpy.asarray(snapshot, dtype = numpy.float32)
+        if self.gain != 1:
+            samples = samples * self.gain
+        self.samples = samples
+
+        # Band averages
+        starts = numpy.asarray(edges[:-1])
+        counts = numpy.diff(numpy.asarray(edges)).astype(numpy.float32)
+        bands = numpy.add.reduceat(samples, starts) / counts
+        if self.smoothing > 0:
+            bands = self.bands * self.smoothing + bands * ( 1.0 - self.smoothing )
+        self.bands = bands
+
+        # Peak hold
+        rising = bands > self.peaks
+        self._velocity = numpy.where(rising, 0.0, self._velocity + self.peak_acceleration).astype(numpy.float32)
+        self.peaks = numpy.maximum(numpy.where(rising, bands, self.peaks - self._velocity), 0.0).astype(numpy.float32)
+
+        # Light levels
+        clipped = numpy.minimum(samples * LEVEL_SCALE, 255.0)
+        each = len(clipped) / 3
+        if each > 0:
+            cols = clipped[:each * 3].reshape(3, each).mean(axis = 1)
+            self.levels = ( int(cols[0]), int(cols[1]), int(cols[2]) )
+        self.level = float(clipped.mean())
+
+    def _update_array(self, snapshot, edges):
+        gain = self.gain
+        samples = array.array("f", snapshot) if gain == 1 else array.array("f", [ s * gain for s in snapshot ])
+        self.samples = samples
+
+        # Band averages
+        bands = [ sum(samples[edges[i]:edges[i + 1]]) / ( edges[i + 1] - edges[i] ) for i in range(0, len(edges) - 1) ]
+        if self.smoothing > 0:
+            s = self.smoothing
+            bands = [ o * s + n * ( 1.0 - s ) for o, n in zip(self.bands, bands) ]
+        self.bands = bands
+
+        # Peak hold
+        peaks = self.peaks
+        velocity = self._velocity
+        for i in range(0, len(bands)):
+            if bands[i] > peaks[i]:
+                peaks[i] = bands[i]
+                velocity[i] = 0.0
+            else:
+                velocity[i] += self.peak_acceleration
+                peaks[i] = max(0.0, peaks[i] - velocity[i])
+
+        # Light levels
+        clipped = [ min(255.0, s * LEVEL_SCALE) for s in samples ]
+        each = len(clipped) / 3
+        if each > 0:
+            self.levels = tuple([ int(sum(clipped[j * each:( j + 1 ) * each]) / each) for j in range(0, 3) ])
+        self.level = sum(clipped) / len(clipped)
+
+"""
+Functions
+"""
+
+def get_band_edges(sample_count, bands, log_bands = False):
+    """
+    Get the sample index each band starts at, plus the end of the last band.
+    Every band has at least one sample (unless there are fewer samples than
+    bands, in which case there are fewer bands).
+
+    Keyword arguments:
+    sample_count    -- number of samples
+    bands           -- number of bands
+    log_bands       -- logarithmic rather than linear bands
+    """
+    bands = min(bands, sample_count)
+    edges = [ 0 ]
+    for i in range(1, bands + 1):
+        if log_bands:
+            edge = int(round(math.pow(sample_count, float(i) / bands)))
+        else:
+            edge = int(round(float(sample_count) * i / bands))
+        # Leave room for the remaining bands
+        edge = min(max(edge, edges[-1] + 1), sample_count - ( bands - i ))
+        edges.append(edge)
+    return edges
+
+def fill_bars(canvas, color, bars):
+    """
+    Fill a list of rectangles with a single fill.
+
+    Keyword arguments:
+    canvas        -- cairo context
+    color         -- ( r, g, b, a ), 0.0 - 1.0
+    bars          -- list of ( x, y, width, height )
+    """
+    for bar in bars:
+        canvas.rectangle(*bar)
+    canvas.set_source_rgba(*color)
+    canvas.fill()
+
+def fill_segmented_bars(canvas, color, bars, bottom, segment_height, segment_spacing):
+    """
+    Fill a list of rectangles with a single fill, divided into segments that
+    line up with the bottom edge (like the LEDs of a hardware spectrum
+    analyser). The segments come from a repeating pattern, so each bar
+    is one rectangle however many segments it has.
+
+    Keyword arguments:
+    canvas            -- cairo context
+    color             -- ( r, g, b, a ), 0.0 - 1.0
+    bars              -- list of ( x, y, width, height )
+    bottom            -- y position the segments line up with
+    segment_height    -- height of each segment
+    segment_spacing   -- gap between segments
+    """
+    if segment_spacing <= 0:
+        fill_bars(canvas, color, bars)
+        return
+    for bar in bars:
+        canvas.rectangle(*bar)
+    canvas.set_source(get_segment_pattern(color, segment_height, segment_spacing, bottom))
+    canvas.fill()
+
+_segment_patterns = {}
+
+def get_segment_pattern(color, segment_height, segment_spacing, bottom):
+    key = ( tuple(color), segment_height, segment_spacing )
+    pattern = _segment_patterns.get(key)
+    if pattern is None:
+        period = int(segment_height + segment_spacing)
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, 1, period)
+        ctx = cairo.Context(surface)
+        ctx.set_source_rgba(*color)
+        ctx.rectangle(0, segment_spacing, 1, segment_height)
+        ctx.fill()
+        pattern = cairo.SurfacePattern(surface)
+        pattern.set_extend(cairo.EXTEND_REPEAT)
+        pattern.set_filter(cairo.FILTER_NEAREST)
+        if len(_segment_patterns) > 32:
+            _segment_patterns.clear()
+        _segment_patterns[key] = pattern
+    # Line the bottom of a segment up with the bottom
+    pattern.set_matrix(cairo.Matrix(y0 = -bottom))
+    return pattern
+
+def benchmark(width = 320, height = 240, frames = 300, bars = 32, rows = 48, samples = 256):
+    """
+    Compare analysing and drawing a spectrum frame the way Impulse15 used to
+    (a Python loop per sample, and a fill per bar segment) with the Analyser
+    and batched fills, on a canvas of the given size. Returns a list of
+    ( name, seconds per frame ) tuples.
+
+    Keyword arguments:
+    width        -- canvas width
+    height       -- canvas height
+    frames       -- number of frames to draw with each method
+    bars         -- number of bars
+    rows         -- number of segments in a full height bar
+    samples      -- number of samples in each snapshot
+    """
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+    canvas = cairo.Context(surface)
+    snapshots = [ [ abs(math.sin(f * 0.1 + i * 0.05)) * ( 1.0 - float(i) / samples ) for i in range(0, samples) ] for f in range(0, 16) ]
+    bar_width = max(1, width / bars - 2)
+    segment_height = max(1, height / rows - 1)
+    color = ( 1.0, 0.0, 0.0, 1.0 )
+    peak_color = ( 0.0, 0.0, 1.0, 1.0 )
+
+    def paint_old(snapshot):
+        arr = []
+        for a in snapshot:
+            arr.append(a * 1.5)
+        cols = []
+        each = len(arr) / 3
+        z = 0
+        for j in range(0, 3):
+            t = 0
+            for x in range(0, each):
+                t += min(255, arr[z] * 340)
+                z += 1
+            cols.append(int(t / each))
+        t = 0
+        for x in range(0, len(arr)):
+            t += min(255, arr[x] * 340)
+        freq = len(arr) / bars
+        for i in range(0, len(arr), freq):
+            col = i / freq
+            n = int(min(1.0, arr[i]) * ( rows - 2 ))
+            canvas.set_source_rgba(*color)
+            for row in range(0, n):
+                canvas.rectangle(col * ( bar_width + 2 ), height - row * ( segment_height + 1 ), bar_width, -segment_height)
+            canvas.fill()
+            canvas.set_source_rgba(*peak_color)
+            canvas.rectangle(col * ( bar_width + 2 ), height - n * ( segment_height + 1 ), bar_width, -segment_height)
+            canvas.fill()
+
+    analyser = Analyser(bars, 1.5)
+    def paint_new(snapshot):
+        analyser.update(snapshot)
+        columns = []
+        peaks = []
+        for i in range(0, analyser.band_count):
+            n = int(min(1.0, analyser.bands[i]) * ( rows - 2 ))
+            x = i * ( bar_width + 2 )
+            columns.append(( x, height - n * ( segment_height + 1 ), bar_width, n * ( segment_height + 1 ) ))
+            p = int(min(1.0, analyser.peaks[i]) * ( rows - 2 ))
+            peaks.append(( x, height - p * ( segment_height + 1 ) - segment_height, bar_width, segment_height ))
+        fill_segmented_bars(canvas, color, columns, height, segment_height, 1)
+        fill_bars(canvas, peak_color, peaks)
+
+    results = []
+    for name, paint in [ ( "Per sample and segment", paint_old ), ( "Analyser and batched fill", paint_new ) ]:
+        started = time.time()
+        for f in range(0, frames):
+            canvas.set_source_rgb(0, 0, 0)
+            canvas.paint()
+            paint(snapshots[f % len(snapshots)])
+        results.append(( name, ( time.time() - started ) / frames ))
+    return results
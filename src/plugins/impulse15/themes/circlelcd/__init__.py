@@ -20,34 +20,34 @@ def on_after_set_attribute ( self, name, value, screenlet ):
 
 def on_draw( audio_sample_array, cr, screenlet ):
 
-	l = len( audio_sample_array )
+	bands = screenlet.analyser.bands
 
 	width, height = ( screenlet.width, screenlet.height )
 
 
-	n_bars = screenlet.bars
+	n_bars = len( bands )
 
 	cr.set_line_width( screenlet.bar_width )
 
-	for i in range( 0, l, l / n_bars ):
-		bar_amp_norm = audio_sample_array[ i ]
+	# The inner ring is drawn in col2 and the rest in col1, each as one path
+	inner = []
+	outer = []
+	for i in range( 0, n_bars ):
+		bar_amp_norm = bands[ i ]
 
 
 		bar_height = ( bar_amp_norm * ( screenlet.width / 2 ) + screenlet.bar_width ) * ( screenlet.bar_height / 10.0 )
 
-		cc = screenlet.col2
-		cr.set_source_rgba( cc[ 0 ],  cc[ 1 ],  cc[ 2 ],  cc[ 3 ] )
 		for j in range( 0, int( bar_height / 5 ), max(max(1, screenlet.spacing) / 5, 1) ):
-			cr.arc(
-				width / 2,
-				height / 2,
+			( inner if j == 0 else outer ).append( (
 				20 + j * screenlet.bar_width,
-				( math.pi*2 / n_bars ) * ( i / ( l / n_bars ) ),
-				( math.pi*2 / n_bars ) * ( i / ( l / n_bars ) + 1 ) - .05
-			)
-
-			cr.stroke( )
-			
-			if j == 0:		
-				cc = screenlet.col1	
-				cr.set_source_rgba( cc[ 0 ],  cc[ 1 ],  cc[ 2 ],  cc[ 3 ] )
+				( math.pi*2 / n_bars ) * i,
+				( math.pi*2 / n_bars ) * ( i + 1 ) - .05
+			) )
+
+	for arcs, cc in [ ( inner, screenlet.col2 ), ( outer, screenlet.col1 ) ]:
+		for radius, angle1, angle2 in arcs:
+			cr.new_sub_path( )
+			cr.arc( width / 2, height / 2, radius, angle1, angle2 )
+		cr.set_source_rgba( cc[ 0 ],  cc[ 1 ],  cc[ 2 ],  cc[ 3 ] )
+		cr.stroke( )
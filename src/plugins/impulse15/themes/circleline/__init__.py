@@ -18,14 +18,14 @@ def on_after_set_attribute ( self, name, value, screenlet ):
 
 def on_draw( audio_sample_array, cr, screenlet ):
 
-	l = len( audio_sample_array )
+	bands = screenlet.analyser.bands
 
 	width, height = ( screenlet.width, screenlet.height )
 
 	co = screenlet.col1
 	cr.set_source_rgba( co[ 0 ], co[ 1 ], co[ 2 ], co[ 3 ] )
 
-	n_bars = screenlet.bars
+	n_bars = len( bands )
 
 	cr.set_line_width( screenlet.bar_width )
 
@@ -34,14 +34,14 @@ def on_draw( audio_sample_array, cr, screenlet ):
 	fx = 0
 	fy = 0
 
-	for i in range( 0, l, l / n_bars ):
+	for i in range( 0, n_bars ):
 
-		bar_amp_norm = audio_sample_array[ i ]
+		bar_amp_norm = bands[ i ]
 
 		bar_height = bar_amp_norm * 100
 
 
-		a = ( math.pi*2 / n_bars ) * ( i / ( l / n_bars ) )
+		a = ( math.pi*2 / n_bars ) * i
 
 		x = ( math.sin( a ) * ( h + bar_height ) + width / 2 ) 
 		y = ( math.cos( a ) * ( h + bar_height ) + height / 2 )
@@ -1,12 +1,13 @@
-peak_heights = [ 0 for i in range( 256 ) ]
-peak_acceleration = [ 0.0 for i in range( 256 ) ]
+import impulseanalysis
+
 fft = True
 
 def load_theme ( screenlet):
 	pass
 
 def on_draw ( audio_sample_array, cr, screenlet ):
-	n_cols = screenlet.bars
+	analyser = screenlet.analyser
+	n_cols = len( analyser.bands )
 	col_width = screenlet.bar_width
 	col_spacing = screenlet.spacing
 	bar_color = screenlet.col1
@@ -14,54 +15,28 @@ def on_draw ( audio_sample_array, cr, screenlet ):
 	n_rows = screenlet.rows
 	row_spacing = screenlet.spacing
 	peak_color = screenlet.col2
-	freq = len( audio_sample_array ) / n_cols
-	actual_cols = ( len( audio_sample_array ) / freq ) + 1 
+	row_pitch = row_height + row_spacing
 	
-	total_width = ( actual_cols * ( col_width + col_spacing ) ) - col_spacing
+	total_width = ( n_cols * ( col_width + col_spacing ) ) - col_spacing
 	
-#	print "Total width = %d, Cols = %d, width = %d, spacing = %d, freq = %f, len = %d, actual_cols = %d" % ( total_width, n_cols, col_width, col_spacing, freq, len(audio_sample_array), actual_cols  )
 	
 	cr.save()
 	cr.translate( ( screenlet.width - total_width ) / 2, 0)
 
-	for i in range( 0, len( audio_sample_array ), freq ):
-
-		col = i / freq
-		rows = int( audio_sample_array[ i ] * ( n_rows - 2 ) )
-
-		cr.set_source_rgba( bar_color[ 0 ], bar_color[ 1 ], bar_color[ 2 ], bar_color[ 3 ] )
-
-		if rows > peak_heights[ i ]:
-			peak_heights[ i ] = rows
-			peak_acceleration[ i ] = 0.0
-		else:
-			peak_acceleration[ i ] += .1
-			peak_heights[ i ] -= peak_acceleration[ i ]
-
-		if peak_heights[ i ] < 0:
-			peak_heights[ i ] = 0
+	# Build all of the bars and all of the peaks, then fill each in one go
+	bars = []
+	peaks = []
+	for col in range( 0, n_cols ):
 
-		for row in range( 0, rows ):
+		x = col * ( col_width + col_spacing )
+		rows = int( analyser.bands[ col ] * ( n_rows - 2 ) )
+		if rows > 0:
+			top = screenlet.height - ( rows - 1 ) * row_pitch - row_height
+			bars.append( ( x, top, col_width, screenlet.height - top ) )
 
-			cr.rectangle(
-				col * ( col_width + col_spacing ),
-				screenlet.height - row * ( row_height + row_spacing ),
-				col_width, -row_height
-			)
+		peak_rows = analyser.peaks[ col ] * ( n_rows - 2 )
+		peaks.append( ( x, screenlet.height - peak_rows * row_pitch - row_height, col_width, row_height ) )
 
-		cr.fill( )
-
-		cr.set_source_rgba( peak_color[ 0 ], peak_color[ 1 ], peak_color[ 2 ], peak_color[ 3 ] )
-
-		cr.rectangle(
-			col * ( col_width + col_spacing ),
-			screenlet.height - peak_heights[ i ] * ( row_height + row_spacing ),
-			col_width, -row_height
-		)
-
-		cr.fill( )
-
-	cr.fill( )
-	cr.stroke( )
+	impulseanalysis.fill_segmented_bars( cr, bar_color, bars, screenlet.height, row_height, row_spacing )
+	impulseanalysis.fill_bars( cr, peak_color, peaks )
 	cr.restore()
-
@@ -29,11 +29,7 @@ import gnome15.g15globals as g15globals
 import os, os.path
 import pwd
 import gtk
-import re
-from poplib import POP3_SSL
-from poplib import POP3
-from imaplib import IMAP4
-from imaplib import IMAP4_SSL
+import mailsession
  
 # Logging
 import logging
@@ -86,12 +82,17 @@ def get_update_time(gconf_client, gconf_key):
 
 '''
 Abstract mail checker. Subclasses are responsible for connecting
-to mail stores and retrieving the number of unread messages.
+to mail stores and retrieving the number of unread messages. Connections
+are made through long lived sessions kept by the session manager.
 '''
 class Checker():
     
-    def __init__(self, account_manager):
+    def __init__(self, account_manager, session_manager):
         self.account_manager = account_manager
+        self.session_manager = session_manager
+    
+    def check(self, account):
+        return self.session_manager.get_session(self, account, self.session_class).check()
     
     def get_username(self, account):
         username = account.get_property("username", "")
@@ -125,87 +126,21 @@ the POP3 protocol.
 '''
 class POP3Checker(Checker):    
     
+    session_class = mailsession.POP3Session
     
-    def __init__(self, account_manager):
-        Checker.__init__(self, account_manager)
-    
-    def check(self, account):
-        ssl = account.get_property("ssl", "false")
-        default_port = 995 if ssl else 110
-        port = self.get_port_or_default(account, default_port)
-        if ssl:
-            pop = POP3_SSL(self.get_hostname(account), port)
-        else:
-            pop = POP3(self.get_hostname(account), port, 7.0)
-        try :
-            username = self.get_username(account)
-            for i in range(0, 3):
-                password = self.get_password(account, default_port, i > 0)
-                if password == None or password == "":
-                    raise Exception(_("Authentication cancelled"))
-                try :
-                    pop.user(username)
-                    pop.pass_(password)            
-                    self.save_password(account, password, default_port)            
-                    return pop.stat()
-                except Exception as e:
-                    logger.debug("Error while checking", exc_info = e)
-                    try :
-                        pop.apop(username, password)            
-                        self.save_password(account, password, default_port)            
-                        return pop.stat()
-                    except Exception as e2:
-                        logger.debug("Error while checking", exc_info = e2)
-        finally :
-            pop.quit()
-        return (0, 0)
+    def __init__(self, account_manager, session_manager):
+        Checker.__init__(self, account_manager, session_manager)
     
 '''
 IMAP checker. Does the actual work of checking for emails using
-the IMAP protocol.
+the IMAP protocol. Unread counts are pushed by servers that support IDLE.
 '''
 class IMAPChecker(Checker):   
-     
-    def __init__(self, account_manager):
-        Checker.__init__(self, account_manager)
     
-    def check(self, account):
-        ssl = account.get_property("ssl", "false")
-        folder = account.get_property("folder", "INBOX")
-        default_port = 993 if ssl else 143
-        port = self.get_port_or_default(account, default_port)
-        count = ( 0, 0 )
-        username = self.get_username(account)
-        for i in range(0, 3):
-            
-            for j in range(0, 2):
-                if ssl:
-                    imap = IMAP4_SSL(self.get_hostname(account), port)
-                else:
-                    imap = IMAP4(self.get_hostname(account), port)
-                
-                try :
-                    password = self.get_password(account, default_port, i > 0)
-                    if password == None or password == "":
-                        raise Exception(_("Authentication cancelled"))
-                    
-                    try :
-                        if j == 0:
-                            imap.login(username, password)
-                        else:
-                            imap.login_cram_md5(username, password)                         
-                        self.save_password(account, password, default_port) 
-                        status = imap.status(folder, "(UNSEEN)")
-                        unread  = int(re.search("UNSEEN (\d+)", status[1][0]).group(1))      
-                        count = ( unread, count )
-                        return count 
-                    except Exception as e:
-                        logger.debug("Error while checking", exc_info = e)
-                          
-                finally:
-                    imap.logout()   
-            
-        return count
+    session_class = mailsession.IMAPSession
+     
+    def __init__(self, account_manager, session_manager):
+        Checker.__init__(self, account_manager, session_manager)
 
     
 '''
@@ -375,7 +310,9 @@ class G15Biff(g15plugin.G15MenuPlugin):
         self.light_control = None
         self.account_manager = g15accounts.G15AccountManager(CONFIG_PATH, CONFIG_ITEM_NAME)
         self.account_manager.add_change_listener(self)
-        self.checkers = { PROTO_POP3 : POP3Checker(self.account_manager), PROTO_IMAP: IMAPChecker(self.account_manager) }
+        self.session_manager = mailsession.SessionManager(self)
+        self.checkers = { PROTO_POP3 : POP3Checker(self.account_manager, self.session_manager),
+                          PROTO_IMAP: IMAPChecker(self.account_manager, self.session_manager) }
         if self.screen.driver.get_bpp() > 0:
             g15plugin.G15MenuPlugin.activate(self)
         self.update_time_changed_handle = self.gconf_client.notify_add(self.gconf_key + "/update_time", self._update_time_changed)
@@ -389,6 +326,7 @@ class G15Biff(g15plugin.G15MenuPlugin):
         if self.refresh_timer:
             self.refresh_timer.cancel()
             self.refresh_timer.task_queue.stop()
+        self.session_manager.close_all()
         self.gconf_client.notify_remove(self.update_time_changed_handle)
         
     def action_performed(self, binding):
@@ -396,6 +334,10 @@ class G15Biff(g15plugin.G15MenuPlugin):
             if self.refresh_timer:
                 self.refresh_timer.cancel()
             self.refresh()
+            
+    def session_changed(self, session):
+        # Called from the IMAP IDLE threads when a server pushes a change
+        g15scheduler.execute("lcdbiff-%s" % self.screen.device.uid, "MailPushed", self._session_changed, session)
         
     def load_menu_items(self):
         items = []
@@ -422,26 +364,36 @@ class G15Biff(g15plugin.G15MenuPlugin):
         self.refresh_timer = g15scheduler.queue("lcdbiff-%s" % self.screen.device.uid, "MailRefreshTimer", time, self.refresh)
         
     def refresh(self):
-        t_count = 0
-        t_errors = 0
         for item in self.items:
             try :
                 item.refreshing = True
                 self.page.redraw()
                 status = self._check_account(item.account)
                 item.count  = status[0]
-                t_count += item.count
                 item.error = None
                 item.refreshing = False
             except Exception as e:
                 item.refreshing = False
-                t_errors += 1
                 item.error = e
                 item.count = 0
                 logger.debug("Error while refreshing item %s", str(item), exc_info = e)
                 
-        self.total_count = t_count
-        self.total_errors = t_errors
+        self._update_totals()
+        self.schedule_refresh()
+    
+    '''
+    Private
+    '''
+    def _session_changed(self, session):
+        for item in self.items:
+            if item.account.name == session.account.name and not item.refreshing:
+                item.error = session.error
+                item.count = session.count[0] if session.error is None else 0
+        self._update_totals()
+        
+    def _update_totals(self):
+        self.total_count = sum([ item.count for item in self.items ])
+        self.total_errors = len([ item for item in self.items if item.error is not None ])
         
         if self.total_errors > 0:
             self._stop_blink()
@@ -468,14 +420,10 @@ class G15Biff(g15plugin.G15MenuPlugin):
 
         if self.screen.driver.get_bpp() > 0:        
             self.screen.redraw(self.page)
-            
-        self.schedule_refresh()
     
-    '''
-    Private
-    '''
     def _accounts_changed(self, account_manager):
         self._reload_menu()
+        self.session_manager.retain(self.account_manager.accounts)
         self.schedule_refresh()
         
     def _check_account(self, account):
@@ -0,0 +1,462 @@
+#  Gnome15 - Suite of tools for the Logitech G series keyboards and headsets
+#  Copyright (C) 2010 Brett Smith <tanktarta@blueyonder.co.uk>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Long lived mailbox sessions for the lcdbiff plugin. A session is kept for
+each account, remembering the authentication method the server accepted and
+backing off exponentially when the server cannot be reached. IMAP sessions
+stay logged in, and when the server supports IDLE a thread waits for the
+server to push changes, so unread counts do not need to be polled at all.
+"""
+
+import gnome15.g15locale as g15locale
+_ = g15locale.get_translation("lcdbiff", modfile = __file__).ugettext
+
+import re
+import time
+import socket
+import threading
+from poplib import POP3_SSL
+from poplib import POP3
+from imaplib import IMAP4
+from imaplib import IMAP4_SSL
+
+# Logging
+import logging
+logger = logging.getLogger(__name__)
+
+# How long to stay in IDLE before renewing it. RFC 2177 asks clients to
+# re-issue IDLE at least every 29 minutes
+IDLE_RENEW = 29 * 60.0
+
+# Delay before the first retry after a failure, and the most it may grow to
+MIN_BACKOFF = 30.0
+MAX_BACKOFF = 30 * 60.0
+
+# Untagged responses received while idling that mean the counts have changed
+IDLE_CHANGE = re.compile("^\* (\d+) (EXISTS|EXPUNGE|RECENT|FETCH)", re.IGNORECASE)
+IDLE_EXISTS = re.compile("^\* (\d+) EXISTS", re.IGNORECASE)
+
+'''
+Exponential backoff. Each consecutive failure doubles the delay before
+the next attempt is allowed, up to a maximum. Success resets it.
+'''
+class Backoff():
+
+    def __init__(self, minimum = None, maximum = None):
+        self.minimum = MIN_BACKOFF if minimum is None else minimum
+        self.maximum = MAX_BACKOFF if maximum is None else maximum
+        self.failures = 0
+        self.next_attempt = 0
+
+    def failed(self):
+        self.failures += 1
+        delay = min(self.maximum, self.minimum * ( 2 ** ( self.failures - 1 ) ))
+        self.next_attempt = time.time() + delay
+        return delay
+
+    def succeeded(self):
+        self.failures = 0
+        self.next_attempt = 0
+
+    def get_remaining(self):
+        return max(0, self.next_attempt - time.time())
+
+    def is_waiting(self):
+        return self.get_remaining() > 0
+
+'''
+Superclass of protocol specific sessions. The credentials object is the
+lcdbiff checker for the protocol, which knows how to find the server,
+username and password for an account.
+'''
+class MailboxSession():
+
+    def __init__(self, manager, credentials, account, default_port):
+        self.manager = manager
+        self.credentials = credentials
+        self.account = account
+        self.default_port = default_port
+        self.hostname = credentials.get_hostname(account)
+        self.port = credentials.get_port_or_default(account, default_port)
+        self.username = credentials.get_username(account)
+        self.ssl = account.get_property("ssl", "false") == "true"
+        self.auth_method = None
+        self.backoff = Backoff()
+        self.lock = threading.RLock()
+        self.count = ( 0, 0 )
+        self.error = None
+        self.closed = False
+
+    def check(self):
+        self.lock.acquire()
+        try:
+            if self.closed:
+                raise Exception(_("Session closed"))
+            if self.backoff.is_waiting():
+                logger.debug("Not checking %s for another %d seconds", self.account.name, self.backoff.get_remaining())
+                raise self.error
+            try:
+                self.count = self._check()
+                self.error = None
+                self.backoff.succeeded()
+            except Exception as e:
+                self._failed(e)
+                raise
+            return self.count
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            self.closed = True
+            self._disconnect()
+        finally:
+            self.lock.release()
+
+    def authenticate(self, authenticators):
+        """
+        Log in using the first method that works, starting with the one that
+        worked last time. The password is only asked for again (possibly with
+        a dialog) if every method was rejected.
+
+        Keyword arguments:
+        authenticators        -- list of (name, function(username, password)) tuples
+        """
+        methods = [ a for a in authenticators if a[0] == self.auth_method ] + \
+                  [ a for a in authenticators if a[0] != self.auth_method ]
+        for i in range(0, 3):
+            password = self.credentials.get_password(self.account, self.default_port, i > 0)
+            if password == None or password == "":
+                raise Exception(_("Authentication cancelled"))
+            for name, authenticator in methods:
+                try :
+                    authenticator(self.username, password)
+                    if name != self.auth_method:
+                        logger.info("Authenticated to %s using %s", self.hostname, name)
+                        self.auth_method = name
+                    self.credentials.save_password(self.account, password, self.default_port)
+                    return
+                except ( socket.error, IMAP4.abort ):
+                    raise
+                except Exception as e:
+                    logger.debug("Authentication using %s failed", name, exc_info = e)
+        raise Exception(_("Authentication failed"))
+
+    '''
+    Private
+    '''
+    def _failed(self, e):
+        self.error = e
+        delay = self.backoff.failed()
+        logger.info("Failed to check %s (%s), retrying in %d seconds", self.account.name, str(e), delay)
+        self._disconnect()
+
+    def _check(self):
+        raise Exception("Not implemented")
+
+    def _disconnect(self):
+        pass
+
+'''
+POP3 session. A POP3 server locks the maildrop and shows a snapshot of it
+for as long as a client is connected, so a connection is made for each
+check. The authentication method and backoff are still remembered.
+'''
+class POP3Session(MailboxSession):
+
+    def __init__(self, manager, credentials, account):
+        MailboxSession.__init__(self, manager, credentials, account, 995 if account.get_property("ssl", "false") == "true" else 110)
+
+    def _check(self):
+        if self.ssl:
+            pop = POP3_SSL(self.hostname, self.port)
+        else:
+            pop = POP3(self.hostname, self.port, 7.0)
+        try :
+            self.authenticate([ ( "user", lambda u, p: ( pop.user(u), pop.pass_(p) ) ),
+                                ( "apop", pop.apop ) ])
+            return pop.stat()
+        finally :
+            pop.quit()
+
+'''
+IMAP session. The connection stays logged in with the folder selected
+read-only between checks. If the server advertises IDLE, a thread holds
+the connection in IDLE and refreshes the counts whenever the server
+reports a change, reconnecting (with backoff) if the connection drops.
+'''
+class IMAPSession(MailboxSession):
+
+    def __init__(self, manager, credentials, account):
+        MailboxSession.__init__(self, manager, credentials, account, 993 if account.get_property("ssl", "false") == "true" else 143)
+        self.folder = account.get_property("folder", "INBOX")
+        self.imap = None
+        self.exists = 0
+        self.idle_thread = None
+        self.stop_idle = threading.Event()
+
+    def check(self):
+        self.lock.acquire()
+        try:
+            if self.idle_thread is not None:
+                # Counts are being pushed by the server
+                if self.error is not None:
+                    raise self.error
+                return self.count
+        finally:
+            self.lock.release()
+        count = MailboxSession.check(self)
+        self._start_idle()
+        return count
+
+    def close(self):
+        self.stop_idle.set()
+        MailboxSession.close(self)
+
+    '''
+    Private
+    '''
+    def _check(self):
+        if self.imap is not None:
+            try:
+                return self._count()
+            except ( socket.error, IMAP4.abort ) as e:
+                # The server has probably timed out the connection
+                logger.debug("Connection to %s lost, reconnecting", self.hostname, exc_info = e)
+                self._disconnect()
+        self._connect()
+        return self._count()
+
+    def _connect(self):
+        if self.ssl:
+            imap = IMAP4_SSL(self.hostname, self.port)
+        else:
+            imap = IMAP4(self.hostname, self.port)
+        try:
+            authenticators = []
+            if not "LOGINDISABLED" in imap.capabilities:
+                authenticators.append(( "login", imap.login ))
+            if "AUTH=CRAM-MD5" in imap.capabilities:
+                authenticators.append(( "cram-md5", imap.login_cram_md5 ))
+            self.authenticate(authenticators)
+
+            # Servers may advertise more (such as IDLE) once logged in
+            typ, data = imap.capability()
+            if typ == "OK":
+                imap.capabilities = tuple(data[-1].upper().split())
+
+            typ, data = imap.select(self.folder, True)
+            if typ != "OK":
+                raise IMAP4.error(_("Could not open folder %s") % self.folder)
+            self.exists = int(data[0])
+        except:
+            self._shutdown(imap)
+            raise
+        self.imap = imap
+
+    def _count(self):
+        typ, data = self.imap.search(None, "UNSEEN")
+        if typ != "OK":
+            raise IMAP4.error(_("Could not search folder %s") % self.folder)
+        self.imap.untagged_responses.clear()
+        return ( len(data[0].split()), self.exists )
+
+    def _disconnect(self):
+        if self.imap is not None:
+            imap = self.imap
+            self.imap = None
+            self._shutdown(imap)
+
+    def _shutdown(self, imap):
+        try:
+            imap.shutdown()
+        except Exception as e:
+            logger.debug("Error closing connection to %s", self.hostname, exc_info = e)
+
+    def _start_idle(self):
+        self.lock.acquire()
+        try:
+            if self.idle_thread is None and self.imap is not None and not self.closed and \
+                    "IDLE" in self.imap.capabilities:
+                logger.info("Server %s supports IDLE, waiting for changes to %s", self.hostname, self.account.name)
+                self.idle_thread = threading.Thread(target = self._idle_loop, name = "IMAPIdle-%s" % self.account.name)
+                self.idle_thread.setDaemon(True)
+                self.idle_thread.start()
+        finally:
+            self.lock.release()
+
+    def _idle_loop(self):
+        reconnected = False
+        while not self.stop_idle.is_set():
+            try:
+                self.lock.acquire()
+                try:
+                    if self.imap is None:
+                        count = self._check()
+                        changed = self.error is not None or count != self.count
+                        self.count = count
+                        self.error = None
+                        self.backoff.succeeded()
+                        if changed:
+                            self.manager.session_changed(self)
+                    imap = self.imap
+                finally:
+                    self.lock.release()
+
+                changed = self._idle(imap)
+                reconnected = False
+                if changed:
+                    self.lock.acquire()
+                    try:
+                        count = self._count()
+                        if count != self.count:
+                            self.count = count
+                            self.manager.session_changed(self)
+                    finally:
+                        self.lock.release()
+            except Exception as e:
+                if self.stop_idle.is_set():
+                    break
+                if isinstance(e, ( socket.error, IMAP4.abort )) and not reconnected:
+                    # Servers drop idle connections now and then, try once straight away
+                    logger.debug("Connection to %s lost while idle, reconnecting", self.hostname, exc_info = e)
+                    reconnected = True
+                    self.lock.acquire()
+                    try:
+                        self._disconnect()
+                    finally:
+                        self.lock.release()
+                    continue
+                self.lock.acquire()
+                try:
+                    self._failed(e)
+                    delay = self.backoff.get_remaining()
+                finally:
+                    self.lock.release()
+                self.manager.session_changed(self)
+                self.stop_idle.wait(delay)
+        logger.debug("Stopped waiting for changes to %s", self.account.name)
+
+    def _idle(self, imap):
+        """
+        Wait in IDLE until the server reports a change to the folder, or it is
+        time to renew the IDLE. Returns True if there was a change.
+
+        Keyword arguments:
+        imap        -- connection to idle on
+        """
+        tag = imap._new_tag()
+        imap.send("%s IDLE\r\n" % tag)
+        line = imap.readline()
+        if not line.startswith("+"):
+            raise IMAP4.error(_("IDLE refused by %s") % self.hostname)
+
+        changed = False
+        sock = imap.socket()
+        sock.settimeout(IDLE_RENEW)
+        try:
+            while not changed:
+                line = self._readline(imap)
+                changed = IDLE_CHANGE.match(line) is not None
+                self._update_exists(line)
+        except socket.timeout:
+            pass
+        finally:
+            sock.settimeout(None)
+
+        imap.send("DONE\r\n")
+        while True:
+            line = self._readline(imap)
+            if line.startswith(tag):
+                if not line[len(tag):].strip().upper().startswith("OK"):
+                    raise IMAP4.error(line.strip())
+                return changed
+            changed = changed or IDLE_CHANGE.match(line) is not None
+            self._update_exists(line)
+
+    def _readline(self, imap):
+        line = imap.readline()
+        if not line:
+            raise IMAP4.abort(_("Connection to %s closed") % self.hostname)
+        return line
+
+    def _update_exists(self, line):
+        match = IDLE_EXISTS.match(line)
+        if match:
+            self.exists = int(match.group(1))
+
+'''
+Keeps one session for each account that has been checked, so connections
+and what was learned about the server survive between refreshes. The
+listener's session_changed(session) is called from the IDLE threads when
+a server pushes a change.
+'''
+class SessionManager():
+
+    def __init__(self, listener):
+        self.listener = listener
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def get_session(self, credentials, account, session_class):
+        key = self._get_key(credentials, account)
+        self.lock.acquire()
+        try:
+            session = self.sessions.get(account.name)
+            if session is not None and session.key != key:
+                # The account has been edited
+                session.close()
+                session = None
+            if session is None:
+                session = session_class(self, credentials, account)
+                session.key = key
+                self.sessions[account.name] = session
+            return session
+        finally:
+            self.lock.release()
+
+    def retain(self, accounts):
+        """
+        Close the sessions for any accounts that no longer exist.
+
+        Keyword arguments:
+        accounts        -- accounts to keep sessions for
+        """
+        names = [ a.name for a in accounts ]
+        self.lock.acquire()
+        try:
+            for name in list(self.sessions.keys()):
+                if not name in names:
+                    self.sessions.pop(name).close()
+        finally:
+            self.lock.release()
+
+    def close_all(self):
+        self.retain([])
+
+    def session_changed(self, session):
+        if not session.closed:
+            self.listener.session_changed(session)
+
+    '''
+    Private
+    '''
+    def _get_key(self, credentials, account):
+        # Any change to how the account connects (including the port, which
+        # is part of the server property) needs a new session
+        return ( account.type, tuple(sorted(account.properties.items())), credentials.get_username(account) )
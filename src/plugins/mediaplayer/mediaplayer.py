@@ -259,6 +259,8 @@ class G15MediaPlayerPage(g15theme.G15Page):
         self.screen.key_handler.action_listeners.append(self) 
         def on_delete():
             self._pipeline.set_state(gst.STATE_NULL)
+            if self._native_video:
+                logger.info("Video statistics for %s: %s", self._source.name, str(self._video_sink.get_statistics()))
             self.screen.key_handler.action_listeners.remove(self)
             self.screen.painters.remove(self.background_painter)
             self._plugin.show_menu()
@@ -274,15 +276,29 @@ class G15MediaPlayerPage(g15theme.G15Page):
         self._video_src = self._source.create_source()
 
         # Create our custom sink that is connected to the LCD
-        logger.info("Creating videosink that is connected to the LCD")
-        self._video_sink = lcdsink.CairoSurfaceThumbnailSink()
-        logger.info("Connecting to video sink")
-        self._video_sink.connect('thumbnail', self._redraw_cb)
+        self._native_video = g15gconf.get_bool_or_default(self._plugin.gconf_client, "%s/native_video" % self._plugin.gconf_key, True)
+        if self._native_video:
+            # GStreamer scales and converts frames to what the LCD uses
+            self._frame_format = lcdsink.get_format_for_bpp(self._screen.driver.get_bpp())
+            width, height = self._get_target_size()
+            logger.info("Creating %s videosink of %dx%d that is connected to the LCD", self._frame_format, width, height)
+            self._video_bin = lcdsink.LCDVideoBin(self._frame_format, width, height, \
+                                                  self._screen.get_redraw_statistics()["redraw_max_fps"])
+            self._video_sink = self._video_bin.sink
+            logger.info("Connecting to video sink")
+            self._video_sink.connect('frame', self._frame_cb)
+            sink = self._video_bin
+        else:
+            logger.info("Creating videosink that is connected to the LCD")
+            self._video_sink = lcdsink.CairoSurfaceThumbnailSink()
+            logger.info("Connecting to video sink")
+            self._video_sink.connect('thumbnail', self._redraw_cb)
+            sink = self._video_sink
         
         # Now create the actual pipeline
         self._pipeline = gst.Pipeline("mypipeline")
         logger.info("Building pipeline")
-        self._source.build_pipeline(self._video_src, self._video_sink, self._pipeline)
+        self._source.build_pipeline(self._video_src, sink, self._pipeline)
         logger.info("Built pipeline")
         self._connect_signals()
     
@@ -348,6 +364,12 @@ class G15MediaPlayerPage(g15theme.G15Page):
         properties["track_name"] = "%s" % self._source.name
             
         properties["play_pause"] = _("Pause") if self._is_playing() else _("Play")
+        
+        if self._native_video:
+            stats = self._video_sink.get_statistics()
+            properties["video_decode_fps"] = "%.1f" % stats["video_decode_fps"]
+            properties["video_present_fps"] = "%.1f" % stats["video_present_fps"]
+            properties["video_dropped"] = "%d" % stats["video_dropped"]
         return properties
     
     def paint_theme(self, canvas, properties, attributes):
@@ -388,6 +410,14 @@ class G15MediaPlayerPage(g15theme.G15Page):
             self._pipeline.set_state(gst.STATE_NULL)
             self._show_sidebar()
                 
+    def _frame_cb(self, unused_sink, timestamp):
+        if not self._plugin.active:
+            return
+        if self.is_visible():
+            self.redraw()
+        else:
+            self.get_screen().redraw(redraw_content = False, queue = False)
+                
     def _redraw_cb(self, unused_thsink, timestamp):
         if not self._plugin.active:
             return
@@ -447,7 +477,26 @@ class G15MediaPlayerPage(g15theme.G15Page):
         secs = int(secs)
         return hours,mins,secs
         
+    def _get_target_size(self):
+        size = self._screen.driver.get_size()
+        return ( size[0], int(float(size[0]) * (float(self._aspect[1]) ) / float(self._aspect[0])) )
+        
     def _paint_video_image(self, canvas):
+        if self._native_video:
+            surface = self._video_sink.acquire_frame()
+            if surface is not None:
+                size = self._screen.driver.get_size()
+                target_size = self._get_target_size()
+                canvas.save()
+                canvas.translate((size[0] - target_size[0]) / 2, (size[1] - target_size[1]) / 2)
+                if surface.get_width() != target_size[0] or surface.get_height() != target_size[1]:
+                    # Frames from before the aspect changed
+                    canvas.scale(float(target_size[0]) / float(surface.get_width()), \
+                                 float(target_size[1]) / float(surface.get_height()))
+                lcdsink.paint_frame(canvas, self._frame_format, surface)
+                canvas.restore()
+            return
+        
         size = self._screen.driver.get_size()
         if self._surface != None:
             target_size = ( float(size[0]), float(size[0]) * (float(self._aspect[1]) ) / float(self._aspect[0]) )
@@ -485,6 +534,8 @@ class G15MediaPlayerPage(g15theme.G15Page):
             self._aspect = self._full_screen
         else:
             self._aspect = (16, 9)
+        if self._native_video:
+            self._video_bin.set_size(*self._get_target_size())
         if self._sidebar_offset != 0:
             self._show_sidebar()
             self._hide_sidebar(3.0)
@@ -538,8 +589,9 @@ class G15MediaPlayerPage(g15theme.G15Page):
             self._lock.release()
     
     def _paint_thumbnail(self, canvas, allocated_size, horizontal):
-        if self._surface != None and self._screen.driver.get_bpp() == 16:
-            return g15cairo.paint_thumbnail_image(allocated_size, self._surface, canvas)
+        surface = self._video_sink.get_current_frame() if self._native_video else self._surface
+        if surface != None and self._screen.driver.get_bpp() == 16:
+            return g15cairo.paint_thumbnail_image(allocated_size, surface, canvas)
 
 
 class G15MediaSource():
@@ -695,6 +695,9 @@ class G15MPRIS(g15plugin.G15Plugin):
     def activate(self):
         self.players = {}
         g15plugin.G15Plugin.activate(self)
+        
+        # Player calls may block for some time, so keep them off the shared workers
+        g15scheduler.set_dedicated("mprisDataQueue-%s" % self.screen.device.uid)
         if self.session_bus == None:
             self.session_bus = dbus.SessionBus()
             self.session_bus.call_on_disconnection(self._dbus_disconnected)
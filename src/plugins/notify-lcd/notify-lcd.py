@@ -275,6 +275,7 @@ class G15NotifyLCD():
         self._load_configuration()
         self._notify_handle = None
         self._page = None
+        g15scheduler.set_dedicated(self._get_queue())
         
         # DBUS session instance must be private or monitoring will not work properly
         self._bus = dbus.SessionBus(private=True)
@@ -572,10 +573,14 @@ class G15NotifyLCD():
                 acquired_control = self._screen.driver.acquire_control_with_hint(g15driver.HINT_MKEYS, release_after = 3.0, val = g15driver.MKEY_LIGHT_1 | g15driver.MKEY_LIGHT_2 | g15driver.MKEY_LIGHT_3 | g15driver.MKEY_LIGHT_MR)
                 acquired_control.blink(delay = self.blink_delay / 1000.0)
                 
+    def _get_queue(self):
+        # Notifications have workers of their own, as moving between them waits on the plugin lock
+        return "notifyLCD-%s" % self._screen.device.uid
+        
     def _do_redraw(self):
         if self._page != None:
             self._screen.redraw(self._page)
-            self._redraw_timer = g15scheduler.schedule("Notification", self._screen.service.animation_delay, self._do_redraw)
+            self._redraw_timer = g15scheduler.queue(self._get_queue(), "Notification", self._screen.service.animation_delay, self._do_redraw)
           
     def _cancel_redraw(self):
         if self._redraw_timer != None:
@@ -612,5 +617,5 @@ class G15NotifyLCD():
         logger.debug("Starting hide timeout")
         self._cancel_timer() 
         self._displayed_notification = time.time()                       
-        self._timer = g15scheduler.schedule("Notification", message.timeout, self._hide_notification)
+        self._timer = g15scheduler.queue(self._get_queue(), "Notification", message.timeout, self._hide_notification)
                    
@@ -23,6 +23,7 @@ import gnome15.util.g15icontools as g15icontools
 import gnome15.g15theme as g15theme
 import gnome15.g15driver as g15driver
 import gnome15.g15plugin as g15plugin
+import gnome15.g15top as g15top
 import os
 import dbus
 import time
@@ -30,13 +31,6 @@ import gobject
 import logging
 logger = logging.getLogger(__name__)
 
-try:
-    import gtop
-except Exception as e:
-    logger.debug("Could not import gtop module. Will use g15top instead", exc_info = e)
-    # API compatible work around for Ubuntu 12.10
-    import gnome15.g15top as gtop
-
 from Xlib import X
 import Xlib.protocol.event
 
@@ -68,11 +62,12 @@ class ProcessMenuItem(g15theme.MenuItem):
     MenuItem for individual processes
     """
     
-    def __init__(self,  item_id, plugin, process_id, process_name):
+    def __init__(self,  item_id, plugin, process_id, process_name, start_time = None):
         g15theme.MenuItem.__init__(self, item_id)
         self.icon = None
         self.process_id = process_id
         self.process_name = process_name
+        self.start_time = start_time
         self.plugin = plugin
     
     def get_default_theme_dir(self):
@@ -92,7 +87,7 @@ class ProcessMenuItem(g15theme.MenuItem):
     def activate(self):
         kill_name = str(self.process_id) if isinstance(self.process_id, int) else self.process_name 
         self.plugin.confirm_screen = g15theme.ConfirmationScreen(self.get_screen(), _("Kill Process"), _("Are you sure you want to kill\n%s") % kill_name,  
-                                    g15icontools.get_icon_path("utilities-system-monitor"), self.plugin._kill_process, self.process_id,
+                                    g15icontools.get_icon_path("utilities-system-monitor"), self.plugin._kill_process, ( self.process_id, self.start_time ),
                                     cancel_callback = self.plugin._cancel_kill)
                     
      
@@ -102,6 +97,8 @@ class G15Processes(g15plugin.G15MenuPlugin):
         g15plugin.G15MenuPlugin.__init__(self, gconf_client, gconf_key, screen, ["utilities-system-monitor"], id, name)
         self.item_id = 0
         self.confirm_screen = None 
+        self._process_table = None
+        self._table_mode = None
         
         # Can't work out how to kill an application/window given its XID, so only wnck is used for killing
         self.session_bus = dbus.SessionBus()
@@ -119,12 +116,17 @@ class G15Processes(g15plugin.G15MenuPlugin):
         self._matches = []
         g15plugin.G15MenuPlugin.activate(self)
         self.screen.key_handler.action_listeners.append(self)
+        
+        # Killing waits for processes to exit, so keep that off the shared workers
+        g15scheduler.set_dedicated(self._get_kill_queue())
         if self.bamf_matcher is not None:        
             self._matches.append(self.bamf_matcher.connect_to_signal("ViewOpened", self._view_opened))
             self._matches.append(self.bamf_matcher.connect_to_signal("ViewClosed", self._view_closed))
             
     def deactivate(self):
         self._cancel_timer()
+        self._process_table = None
+        self._table_mode = None
         g15plugin.G15MenuPlugin.deactivate(self)
         for m in self._matches:
             m.remove()
@@ -155,6 +157,7 @@ class G15Processes(g15plugin.G15MenuPlugin):
     
     def create_menu(self):
         menu = g15plugin.G15MenuPlugin.create_menu(self)
+        menu.virtual = True
         menu.on_move = self._reschedule
         return menu
     
@@ -205,20 +208,32 @@ class G15Processes(g15plugin.G15MenuPlugin):
         root.send_event(ev, event_mask=mask)
         display.flush()
     
-    def _cancel_kill(self, process_id):
+    def _cancel_kill(self, process):
         self.confirmation_screen = None
         
-    def _do_kill(self, process_id):
+    def _is_same_process(self, process_id, start_time):
+        current_start_time = g15top.proc_start_time(process_id)
+        return current_start_time is not None and ( start_time is None or current_start_time == start_time )
+        
+    def _do_kill(self, process_id, start_time = None):
+        # The process ID may have been reused by another process since it was listed
+        if not self._is_same_process(process_id, start_time):
+            logger.warning("Process %d has already exited, not killing", process_id)
+            return
         os.system("kill %d" % process_id)
         time.sleep(0.5)
-        if process_id in gtop.proclist():
+        if self._is_same_process(process_id, start_time):
             time.sleep(5.0)
-            if process_id in gtop.proclist():
+            if self._is_same_process(process_id, start_time):
                 os.system("kill -9 %d" % process_id)
             
-    def _kill_process(self, process_id):
+    def _get_kill_queue(self):
+        return "processesKill-%s" % self.screen.device.uid
+            
+    def _kill_process(self, process):
+        process_id, start_time = process
         if isinstance(process_id, int):
-            self._do_kill(process_id)
+            g15scheduler.execute(self._get_kill_queue(), "KillProcess", self._do_kill, process_id, start_time)
         else:            
             gobject.idle_add(self._kill_window, process_id)
         self.confirmation_screen = None
@@ -235,7 +250,7 @@ class G15Processes(g15plugin.G15MenuPlugin):
         for window_name in window_names:
             for w in windows:
                 if w.get_name() == window_name:
-                    self._do_kill(w.get_pid())
+                    g15scheduler.execute(self._get_kill_queue(), "KillProcess", self._do_kill, w.get_pid())
                     return
         
     def _get_window_names(self, path, window_names = []):
@@ -262,10 +277,18 @@ class G15Processes(g15plugin.G15MenuPlugin):
     def _get_menu_item(self, pid):
         item = self.menu.get_child_by_id("process-%s" % pid)
         if item == None:
-            item = ProcessMenuItem("process-%s" % pid, self, pid, None)
+            item = ProcessMenuItem("process-%s" % pid, self, pid, None,
+                                   g15top.proc_start_time(pid) if isinstance(pid, int) else None)
             self.menu.add_child(item)
         return item
     
+    def _add_process_item(self, process):
+        if self._mode == "all" or process.uid == os.getuid():
+            item = self._get_menu_item(process.pid)
+            item.start_time = process.start_time
+            item.icon = None
+            item.process_name = self._get_process_name(process.args, process.name)
+    
     def _get_bamf_application_object(self, window):
         app = self.session_bus.get_object("org.ayatana.bamf", window)
         view = dbus.Interface(app, 'org.ayatana.bamf.view')
@@ -301,54 +324,14 @@ class G15Processes(g15plugin.G15MenuPlugin):
         if not self.active:
             return
         
-        this_items = {}        
         if self._mode == "applications":
-            if self.bamf_matcher != None:            
-                for window in self.bamf_matcher.RunningApplications():
-                    try:
-                        item = self._get_item_for_bamf_application(window)                    
-                        this_items[item.id] = item
-                    except Exception as e:
-                        logger.debug("Could not get info from BAMF", exc_info = e)
-                        pass
-            else:
-                import wnck
-                screen = wnck.screen_get_default()
-                for window in screen.get_windows():
-                    pid = window.get_pid()
-                    if pid > 0:                        
-                        item = self._get_menu_item(pid)
-                        item.process_name = window.get_name()
-                        this_items[item.id] = item
-                        pixbuf = window.get_icon()
-                        if pixbuf:
-                            item.icon = g15cairo.pixbuf_to_surface(pixbuf)
-                                
+            self._reload_applications()
         else:
-            for process_id in gtop.proclist():
-                process_id = "%d" %  process_id
-                try :
-                    pid = int(process_id)
-                    proc_state = gtop.proc_state(pid)
-                    proc_args = gtop.proc_args(pid)
-                    if self._mode == "all" or ( self._mode != "all" and proc_state.uid == os.getuid()):                      
-                        item = self._get_menu_item(pid)
-                        item.icon = None
-                        item.process_name = self._get_process_name(proc_args, proc_state.cmd)
-                        this_items[item.id] = item
-                except Exception as e:
-                    logger.debug("Process may have disappeared", exc_info = e)
-                    # In case the process disappears
-                    pass
+            self._reload_processes()
  
-        # Remove any missing items
-        for item in self.menu.get_children():
-            if not item.id in this_items:
-                self.menu.remove_child(item)
-        
         # Make sure selected still exists
         if self.menu.selected != None and self.menu.get_child_by_id(self.menu.selected.id) is None:
-            if len(self.menu.get_child_count()) > 0:
+            if self.menu.get_child_count() > 0:
                 self.menu.selected  = self.menu.get_children()[0]
             else:
                 self.menu.selected = None
@@ -356,6 +339,56 @@ class G15Processes(g15plugin.G15MenuPlugin):
         self.page.mark_dirty()
         self.screen.redraw(self.page)
         
+    def _reload_processes(self):
+        """
+        Apply the processes that have started and exited since the last
+        refresh to the menu. The whole menu is only rebuilt when the mode
+        changes.
+        """
+        if self._process_table is None:
+            self._process_table = g15top.ProcessTable()
+        added, removed = self._process_table.refresh()
+        if self._table_mode != self._mode:
+            self._table_mode = self._mode
+            self.menu.remove_all_children()
+            added = self._process_table.get_processes()
+            removed = []
+        for process in removed:
+            item = self.menu.get_child_by_id("process-%s" % process.pid)
+            if item is not None:
+                self.menu.remove_child(item)
+        for process in added:
+            self._add_process_item(process)
+        
+    def _reload_applications(self):
+        self._table_mode = None
+        this_items = {}
+        if self.bamf_matcher != None:            
+            for window in self.bamf_matcher.RunningApplications():
+                try:
+                    item = self._get_item_for_bamf_application(window)                    
+                    this_items[item.id] = item
+                except Exception as e:
+                    logger.debug("Could not get info from BAMF", exc_info = e)
+                    pass
+        else:
+            import wnck
+            screen = wnck.screen_get_default()
+            for window in screen.get_windows():
+                pid = window.get_pid()
+                if pid > 0:                        
+                    item = self._get_menu_item(pid)
+                    item.process_name = window.get_name()
+                    this_items[item.id] = item
+                    pixbuf = window.get_icon()
+                    if pixbuf:
+                        item.icon = g15cairo.pixbuf_to_surface(pixbuf)
+
+        # Remove any missing items
+        for item in self.menu.get_children():
+            if not item.id in this_items:
+                self.menu.remove_child(item)
+        
     def _on_move(self):
         self._reschedule()
         
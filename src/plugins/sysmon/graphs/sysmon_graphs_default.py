@@ -84,7 +84,7 @@ class G15CPUGraph(G15Graph):
         
     def create_plot(self, graph_surface):
         series_colors, fill_colors = self.get_colors()
-        return cairoplot.AreaPlot(graph_surface, self.plugin.selected_cpu.history, 
+        return cairoplot.AreaPlot(graph_surface, self.plugin.selected_cpu.history.get_values(), 
                                  self.view_bounds[2], 
                                  self.view_bounds[3], 
                                  background = None,
@@ -103,7 +103,7 @@ class G15NetGraph(G15Graph):
         
     def create_plot(self, graph_surface):
         y_labels = []
-        max_y = max(max(self.plugin.selected_net.max_send, self.plugin.selected_net.max_recv), 102400)
+        max_y = max(self.plugin.selected_net.send_history.get_max(), self.plugin.selected_net.recv_history.get_max(), 102400)
         for x in range(0, int(max_y), int(max_y / 4)):
             y_labels.append("%-3.2f" % ( float(x) / 102400.0 ) )
         series_color, fill_color = self.get_colors()            
@@ -113,7 +113,7 @@ class G15NetGraph(G15Graph):
         else:
             alt_series_color = g15convert.get_alt_color(series_color)
             alt_fill_color = g15convert.get_alt_color(fill_color)
-        return cairoplot.AreaPlot( graph_surface, [ self.plugin.selected_net.send_history, self.plugin.selected_net.recv_history ], 
+        return cairoplot.AreaPlot( graph_surface, [ self.plugin.selected_net.send_history.get_values(), self.plugin.selected_net.recv_history.get_values() ], 
                                       self.view_bounds[2], 
                                       self.view_bounds[3], 
                                       background = None,
@@ -144,7 +144,7 @@ class G15MemGraph(G15Graph):
         else:
             alt_series_color = g15convert.get_alt_color(series_color)
             alt_fill_color = g15convert.get_alt_color(fill_color)
-        return cairoplot.AreaPlot( graph_surface, [ self.plugin.used_history, self.plugin.cached_history ], 
+        return cairoplot.AreaPlot( graph_surface, [ self.plugin.used_history.get_values(), self.plugin.cached_history.get_values() ], 
                                       self.view_bounds[2], 
                                       self.view_bounds[3], 
                                       background = None,
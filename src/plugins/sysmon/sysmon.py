@@ -24,7 +24,9 @@ import gnome15.util.g15cairo as g15cairo
 import gnome15.util.g15icontools as g15icontools
 import gnome15.g15driver as g15driver
 import gnome15.g15plugin as g15plugin
+import gnome15.g15top as g15top
 import time
+import array
 import logging
 logger=logging.getLogger(__name__)
 try:
@@ -33,6 +35,11 @@ except Exception as e:
     logger.debug("Could not import gtop. Falling back to g15top", exc_info = e)
     # API compatible work around for Ubuntu 12.10
     import gnome15.g15top as gtop
+try:
+    import numpy
+except Exception as e:
+    logger.debug("Could not import numpy. Falling back to array based history", exc_info = e)
+    numpy = None
 import gtk
 import os
 import sys
@@ -54,6 +61,7 @@ unsupported_models = [ g15driver.MODEL_G110, g15driver.MODEL_G11, g15driver.MODE
 
 # Various constants
 GRAPH_SIZE = 50
+MAX_GRAPH_SIZE = 3600
 CPU_ICONS = [ "utilities-system-monitor","gnome-cpu-frequency-applet", "computer" ]
  
 ''' 
@@ -69,12 +77,72 @@ def show_preferences(parent, driver, gconf_client, gconf_key):
     dialog = widget_tree.get_object("SysmonDialog")
     dialog.set_transient_for(parent)    
     g15uigconf.configure_checkbox_from_gconf(gconf_client, gconf_key + "/show_cpu_on_panel", "ShowCPUUsageOnPanel", True, widget_tree)
+    g15uigconf.configure_spinner_from_gconf(gconf_client, gconf_key + "/history_length", "HistoryLength", GRAPH_SIZE, widget_tree)
     dialog.run()
     dialog.hide()
     
+class History():
+    """
+    Fixed size ring buffer holding the most recent samples of a value. Adding 
+    a sample overwrites the oldest, rather than shifting every other sample 
+    along. Backed by a numpy array if numpy is available, otherwise by an
+    array.array.
+    """
+    
+    def __init__(self, size = GRAPH_SIZE):
+        self._size = size
+        self._pos = 0
+        if numpy is not None:
+            self._data = numpy.zeros(size)
+        else:
+            self._data = array.array("d", [ 0.0 ] * size)
+            
+    def __len__(self):
+        return self._size
+        
+    def append(self, value):
+        """
+        Add a sample, replacing the oldest
+        
+        Keyword arguments:
+        value -- sample
+        """
+        self._data[self._pos] = value
+        self._pos = ( self._pos + 1 ) % self._size
+        
+    def get_values(self):
+        """
+        Get a list of all the samples, oldest first.
+        """
+        if numpy is not None:
+            return numpy.concatenate(( self._data[self._pos:], self._data[:self._pos] )).tolist()
+        else:
+            return self._data[self._pos:].tolist() + self._data[:self._pos].tolist()
+        
+    def get_max(self):
+        """
+        Get the largest sample
+        """
+        return float(self._data.max()) if numpy is not None else max(self._data)
+    
+    def resize(self, size):
+        """
+        Change the number of samples kept, keeping as many of the most recent
+        samples as will fit.
+        
+        Keyword arguments:
+        size -- new number of samples
+        """
+        if size != self._size:
+            # Fill a new buffer, so readers never see a partly filled one
+            resized = History(size)
+            for v in self.get_values()[-size:]:
+                resized.append(v)
+            self._data, self._pos, self._size = resized._data, resized._pos, resized._size
+    
 class Net():
     
-    def __init__(self, net_no, name):
+    def __init__(self, net_no, name, history_length = GRAPH_SIZE):
         self.net_no = net_no
         self.name = name 
         self.recv_bps = 0.0
@@ -82,8 +150,8 @@ class Net():
         self.last_net_list = None
         self.max_send = 0.0001  
         self.max_recv = 0.0001
-        self.send_history = [0] * GRAPH_SIZE
-        self.recv_history =  [0] * GRAPH_SIZE
+        self.send_history = History(history_length)
+        self.recv_history = History(history_length)
         self.last_net_list = None
         self.last_time = 0
         
@@ -117,12 +185,8 @@ class Net():
             self.max_send = self.send_bps
                         
         # History
-        self.send_history.append(self.recv_bps)
-        while len(self.send_history) > GRAPH_SIZE:
-            del self.send_history[0]
-        self.recv_history.append(self.send_bps)
-        while len(self.recv_history) > GRAPH_SIZE:
-            del self.recv_history[0]
+        self.send_history.append(self.send_bps)
+        self.recv_history.append(self.recv_bps)
             
         self.last_net_list = this_net_list 
         self.last_time = now
@@ -141,10 +205,10 @@ class Net():
     
 class CPU():
     
-    def __init__(self, number):
+    def __init__(self, number, history_length = GRAPH_SIZE):
         self.number = number 
         self.name = "cpu%d" % number if number >= 0 else "cpu"
-        self.history = [0] * GRAPH_SIZE
+        self.history = History(history_length)
         self.value = 0
         self.times = None
         self.last_times = None
@@ -167,10 +231,7 @@ class CPU():
         
         self.last_times = time_list
         
-        # Update the history and trim it to the graph data size
         self.history.append(self.pc)
-        while len(self.history) > GRAPH_SIZE:
-            del self.history[0]       
         
     def get_pc(self, times):
         sum_l = sum(times)
@@ -204,6 +265,8 @@ class G15SysMon(g15plugin.G15RefreshingPlugin):
         self.last_time_list = None
         self.last_times_list = []
         self.last_time = 0
+        self.history_length = self._get_history_length()
+        self.new_history_length = self.history_length
         
         # CPU
         self.selected_cpu = None
@@ -212,7 +275,7 @@ class G15SysMon(g15plugin.G15RefreshingPlugin):
         selected_cpu_name = self.gconf_client.get_string(self.gconf_key + "/cpu")
         cpus = gtop.cpu().cpus
         for i in range(-1, len(cpus)):
-            cpu = CPU(i)
+            cpu = CPU(i, self.history_length)
             self.cpu_data.append(cpu)
             if cpu.name == selected_cpu_name:
                 self.selected_cpu = cpu
@@ -225,7 +288,7 @@ class G15SysMon(g15plugin.G15RefreshingPlugin):
         net_name = self.gconf_client.get_string(self.gconf_key + "/net")
         self.net_data = []
         for idx, n in enumerate(self.net_list):
-            net = Net(idx, n)
+            net = Net(idx, n, self.history_length)
             self.net_data.append(net)
             if net.name == net_name:
                 self.selected_net = net
@@ -240,12 +303,13 @@ class G15SysMon(g15plugin.G15RefreshingPlugin):
         self.cached = 0
         self.free = 0
         self.used = 0
-        self.cached_history = [0] * GRAPH_SIZE
-        self.used_history =  [0] * GRAPH_SIZE 
+        self.cached_history = History(self.history_length)
+        self.used_history = History(self.history_length)
         
         g15plugin.G15RefreshingPlugin.activate(self)
         self._set_panel()
         self.watch(["show_cpu_on_panel","theme"], self._config_changed)
+        self.watch("history_length", self._history_length_changed)
         self.screen.key_handler.action_listeners.append(self)
         
         # Start refreshing
@@ -282,16 +346,21 @@ class G15SysMon(g15plugin.G15RefreshingPlugin):
                     return True
         
     def refresh(self):
+        
+        # Histories are only resized here, so never while samples are being added
+        if self.new_history_length != self.history_length:
+            self._resize_histories(self.new_history_length)
             
         # Memory
         mem = self._get_mem_info()
         now = time.time()
 
         '''
-        CPU
+        CPU. All of the CPU times come from a single sample
         '''
+        cpus = gtop.cpu()
         for c in self.cpu_data:            
-            c.new_times(self._get_time_list(c))
+            c.new_times(self._get_time_list(cpus, c))
         
         '''
         Net
@@ -313,12 +382,7 @@ class G15SysMon(g15plugin.G15RefreshingPlugin):
         self.cached = float(mem.cached)
         self.noncached = self.total - self.free - self.cached
         self.used_history.append(self.used + self.cached)
-        
-        while len(self.used_history) > GRAPH_SIZE:
-            del self.used_history[0]
         self.cached_history.append(self.cached)
-        while len(self.cached_history) > GRAPH_SIZE:
-            del self.cached_history[0]
         
         self.last_time = now
     
@@ -327,6 +391,23 @@ class G15SysMon(g15plugin.G15RefreshingPlugin):
     def _config_changed(self, client, connection_id, entry, args):
         self.reload_theme()
         self._reschedule_refresh()
+        
+    def _history_length_changed(self, client, connection_id, entry, args):
+        # Applied at the start of the next refresh
+        self.new_history_length = self._get_history_length()
+        
+    def _resize_histories(self, history_length):
+        self.history_length = history_length
+        for c in self.cpu_data:
+            c.history.resize(history_length)
+        for n in self.net_data:
+            n.send_history.resize(history_length)
+            n.recv_history.resize(history_length)
+        self.used_history.resize(history_length)
+        self.cached_history.resize(history_length)
+        
+    def _get_history_length(self):
+        return max(2, min(MAX_GRAPH_SIZE, g15gconf.get_int_or_default(self.gconf_client, self.gconf_key + "/history_length", GRAPH_SIZE)))
             
     def _set_panel(self, client = None, connection_id = None, entry = None, args = None):        
         self.page.panel_painter = self._paint_panel if g15gconf.get_bool_or_default(self.gconf_client, self.gconf_key + "/show_cpu_on_panel", True) else None
@@ -450,10 +531,11 @@ class G15SysMon(g15plugin.G15RefreshingPlugin):
         return ifs, nets
 
     
-    def _get_time_list(self, cpu):
+    def _get_time_list(self, cpus, cpu):
         '''
         Returns a 4 element list containing the amount of time the CPU has 
-        spent performing the different types of work
+        spent performing the different types of work, taken from a sample
+        of all CPUs (as returned by gtop.cpu())
         
         0 user
         1 nice
@@ -463,10 +545,47 @@ class G15SysMon(g15plugin.G15RefreshingPlugin):
         Values are in USER_HZ or Jiffies
         ''' 
         if cpu.number == -1:
-            cpu_times = gtop.cpu()
+            cpu_times = cpus
         else:
-            cpu_times = gtop.cpu().cpus[cpu.number]
+            cpu_times = cpus.cpus[cpu.number]
         return [cpu_times.user, cpu_times.nice, cpu_times.sys, cpu_times.idle]
     
     def _get_mem_info(self):
         return gtop.mem()
+    
+def benchmark(cpus = 64, ticks = 200, history_length = GRAPH_SIZE):
+    """
+    Measure the cost of a refresh tick's CPU statistics for a synthetic
+    machine, both the way the plugin used to do it (parsing /proc/stat once 
+    per CPU and keeping histories as lists trimmed from the front) and the
+    current way (parsing once per tick into ring buffer histories). Returns
+    a tuple of the mean time per tick (in seconds) for each.
+    
+    Keyword arguments:
+    cpus            -- number of CPUs of the synthetic machine
+    ticks           -- number of ticks to time
+    history_length  -- number of samples kept in each history
+    """
+    stat = [ "cpu  %d %d %d %d 0 0 0 0 0 0" % ( i, i, i, i ) for i in range(0, 1) ]
+    stat += [ "cpu%d %d %d %d %d 0 0 0 0 0 0" % ( c, c, c, c, c ) for c in range(0, cpus) ]
+    stat = "\n".join(stat + [ "intr 0", "ctxt 0", "btime 0", "processes 0" ]) + "\n"
+    
+    histories = [ [ 0 ] * history_length for c in range(0, cpus + 1) ]
+    started = time.time()
+    for t in range(0, ticks):
+        for c in range(0, cpus + 1):
+            times = g15top._parse_stat(stat)[c]
+            histories[c].append(times[1])
+            while len(histories[c]) > history_length:
+                del histories[c][0]
+    per_cpu = ( time.time() - started ) / ticks
+    
+    histories = [ History(history_length) for c in range(0, cpus + 1) ]
+    started = time.time()
+    for t in range(0, ticks):
+        sample = g15top._parse_stat(stat)
+        for c in range(0, cpus + 1):
+            histories[c].append(sample[c][1])
+    per_tick = ( time.time() - started ) / ticks
+    
+    return per_cpu, per_tick
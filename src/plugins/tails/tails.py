@@ -230,7 +230,7 @@ class G15TailPage(g15theme.G15Page):
         self.file_path = file_path
         self.thread =  None
         self.index = -1
-        self._menu = g15theme.Menu("menu")
+        self._menu = g15theme.Menu("menu", virtual = True)
         g15theme.G15Page.__init__(self, os.path.basename(file_path), self._screen,
                                      thumbnail_painter=self._paint_thumbnail,
                                      theme=g15theme.G15Theme(self, "menu-screen"), theme_properties_callback=self._get_theme_properties,
@@ -25,6 +25,13 @@ import logging
 import array
 logger = logging.getLogger(__name__)
 
+# Use the batched pixel conversion from Gnome15 if it is available
+try:
+    import gnome15.util.g15pixels as g15pixels
+except Exception as e:
+    logger.debug("Could not import g15pixels. Falling back to per-pixel conversion", exc_info = e)
+    g15pixels = None
+
 class G19(object):
     '''Simple access to Logitech G19 features.
 
@@ -65,6 +72,12 @@ class G19(object):
         if img.size != (320, 240):
             img = img.resize((320, 240), Img.CUBIC)
             access = img.load()
+        if g15pixels is not None:
+            # Frames scan vertically, so transpose the image first
+            img = img.convert("RGBA").transpose(Img.ROTATE_90).transpose(Img.FLIP_TOP_BOTTOM)
+            raw_mode = "BGRA" if sys.byteorder == "little" else "ARGB"
+            tobytes = getattr(img, "tobytes", None) or img.tostring
+            return array.array('B', g15pixels.argb32_to_rgb565(tobytes("raw", raw_mode))).tolist()
         data = []
         for x in range(320):
             for y in range(240):
@@ -85,6 +98,9 @@ class G19(object):
         @return 16bit highcolor value in little-endian.
 
         '''
+        if g15pixels is not None:
+            value = g15pixels.rgb_to_uint16(r, g, b)
+            return ord(value[0]) << 8 | ord(value[1])
         rBits = r * 2**5 / 255
         gBits = g * 2**6 / 255
         bBits = b * 2**5 / 255
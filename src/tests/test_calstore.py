@@ -0,0 +1,112 @@
+#  Gnome15 - Suite of tools for the Logitech G series keyboards and headsets
+#  Copyright (C) 2010 Brett Smith <tanktarta@blueyonder.co.uk>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for the Calendar plugin's event store
+"""
+
+import os
+import sys
+import datetime
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "plugins", "cal"))
+import calstore
+
+class Event():
+    
+    def __init__(self, summary, start_date, end_date = None):
+        self.summary = summary
+        self.start_date = start_date
+        self.end_date = end_date
+        self.alarm = False
+        self.color = None
+
+class Account():
+    
+    def __init__(self, name):
+        self.name = name
+        self.type = "test"
+        self.properties = {}
+
+class Backend():
+    
+    def __init__(self, events):
+        self.events = events
+        self.token = 1
+        
+    def get_sync_token(self, start_date, end_date):
+        return self.token
+    
+    def get_window_events(self, start_date, end_date):
+        return [ e for e in self.events if start_date <= e.start_date <= end_date ]
+    
+class EventStoreTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.store = calstore.EventStore("/nonexistent/events.cache")
+        self.account = Account("test")
+        self.september = calstore.get_window(datetime.date(2026, 9, 15))
+        self.october = calstore.get_window(datetime.date(2026, 10, 15))
+        
+    def test_windows_overlap(self):
+        overlap = datetime.date(2026, 9, 29)
+        self.assertTrue(self.september[0] <= overlap <= self.september[1])
+        self.assertTrue(self.october[0] <= overlap <= self.october[1])
+        
+    def test_sync(self):
+        backend = Backend([ Event("Meeting", datetime.date(2026, 9, 10)) ])
+        changed = self.store.sync(self.account, backend, self.september, 60)
+        self.assertEqual(set([ datetime.date(2026, 9, 10) ]), changed)
+        self.assertEqual([ "Meeting" ], [ e.summary for e in self.store.get_events(datetime.date(2026, 9, 10)) ])
+        self.assertTrue(self.store.has_events(datetime.date(2026, 9, 10)))
+        
+        # Unchanged token, nothing is fetched or changed
+        self.assertEqual(set(), self.store.sync(self.account, backend, self.september, 60))
+        
+    def test_deleted_in_newer_overlapping_window(self):
+        day = datetime.date(2026, 9, 29)
+        backend = Backend([ Event("Meeting", day) ])
+        self.store.sync(self.account, backend, self.september, 60)
+        self.store.sync(self.account, backend, self.october, 60)
+        self.assertEqual(1, len(self.store.get_events(day)))
+        
+        # Deleted upstream, then only the October window is fetched again
+        backend.events = []
+        backend.token = 2
+        changed = self.store.sync(self.account, backend, self.october, 60)
+        self.assertEqual(set([ day ]), changed)
+        self.assertEqual([], self.store.get_events(day))
+        self.assertFalse(self.store.has_events(day))
+        
+    def test_added_in_newer_overlapping_window(self):
+        day = datetime.date(2026, 9, 29)
+        backend = Backend([])
+        self.store.sync(self.account, backend, self.september, 60)
+        backend.events = [ Event("Meeting", day) ]
+        backend.token = 2
+        changed = self.store.sync(self.account, backend, self.october, 60)
+        self.assertEqual(set([ day ]), changed)
+        self.assertEqual([ "Meeting" ], [ e.summary for e in self.store.get_events(day) ])
+        
+    def test_retain(self):
+        day = datetime.date(2026, 9, 10)
+        self.store.sync(self.account, Backend([ Event("Meeting", day) ]), self.september, 60)
+        self.assertEqual(set([ day ]), self.store.retain([ "other" ]))
+        self.assertEqual([], self.store.get_events(day))
+        
+if __name__ == '__main__':
+    unittest.main()
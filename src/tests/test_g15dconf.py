@@ -0,0 +1,142 @@
+#  Gnome15 - Suite of tools for the Logitech G series keyboards and headsets
+#  Copyright (C) 2012 Brett Smith <tanktarta@blueyonder.co.uk>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for the cached GSettings reader. Settings are read through a stand-in
+for the gsettings command that keeps keys in a file, so the tests do not
+depend on (or change) the real dconf database. A session bus is still
+needed, as the reader watches it for changes.
+"""
+
+import os
+import sys
+import pipes
+import shutil
+import tempfile
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+import dbus
+import gnome15.g15dconf as g15dconf
+
+SCHEMA = "org.gnome15.test"
+
+# Understands the same 'list-recursively' and 'get' arguments as gsettings,
+# plus 'set' so the tests can change keys
+STAND_IN = """
+import sys, cPickle
+store = sys.argv[1]
+try:
+    values = cPickle.load(open(store, "rb"))
+except IOError:
+    values = {}
+command, schema = sys.argv[2:4]
+if command == "list-recursively":
+    for key in sorted(values.get(schema, {})):
+        print "%s %s %s" % ( schema, key, values[schema][key] )
+elif command == "get":
+    if not sys.argv[4] in values.get(schema, {}):
+        sys.exit(1)
+    print values[schema][sys.argv[4]]
+elif command == "set":
+    values.setdefault(schema, {})[sys.argv[4]] = sys.argv[5]
+    cPickle.dump(values, open(store, "wb"))
+"""
+
+def has_session_bus():
+    try:
+        dbus.SessionBus(private = True).close()
+        return True
+    except dbus.DBusException:
+        return False
+
+@unittest.skipUnless(has_session_bus(), "needs a D-Bus session bus")
+class TestGSettings(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        script = os.path.join(self.dir, "gsettings.py")
+        f = open(script, "w")
+        try:
+            f.write(STAND_IN)
+        finally:
+            f.close()
+        self.command = g15dconf.GSETTINGS_COMMAND
+        g15dconf.GSETTINGS_COMMAND = " ".join([ pipes.quote(a) for a in [ sys.executable, script, os.path.join(self.dir, "store") ] ])
+        self.settings = g15dconf.GSettings(SCHEMA)
+
+    def tearDown(self):
+        g15dconf.GSETTINGS_COMMAND = self.command
+        shutil.rmtree(self.dir)
+
+    def _set(self, key, value):
+        os.system("%s set %s %s %s" % ( g15dconf.GSETTINGS_COMMAND, SCHEMA, key, pipes.quote(value) ))
+
+    def _change(self, key):
+        # What dconf sends on the bus when a key is written
+        self.settings._changed([ ord(c) for c in "/%s/%s" % ( SCHEMA.replace(".", "/"), key ) ] + [ 0 ])
+
+    def test_round_trip(self):
+        self._set("greeting", "'hello'")
+        self._set("enabled", "true")
+        self._set("count", "uint32 42")
+        self._set("scale", "1.5")
+        self.assertEqual("hello", self.settings.get_string("greeting"))
+        self.assertTrue(self.settings.get_boolean("enabled"))
+        self.assertEqual(42, self.settings.get_int("count"))
+        self.assertEqual(1.5, self.settings.get_double("scale"))
+
+    def test_underscores_are_dashes(self):
+        self._set("font-size", "12")
+        self.assertEqual(12, self.settings.get_int("font_size"))
+
+    def test_reads_cached(self):
+        self._set("greeting", "'hello'")
+        loads = g15dconf.get_statistics()["loads"]
+        self.assertEqual("hello", self.settings.get_string("greeting"))
+        self._set("greeting", "'goodbye'")
+        self.assertEqual("hello", self.settings.get_string("greeting"))
+        self.assertEqual(loads + 1, g15dconf.get_statistics()["loads"])
+
+    def test_statistics(self):
+        self._set("greeting", "'hello'")
+        before = g15dconf.get_statistics()
+        self.assertEqual("hello", self.settings.get_string("greeting"))
+        self.assertEqual("hello", self.settings.get_string("greeting"))
+
+        # Not in the loaded settings, so has to be read on its own
+        self._set("late", "1")
+        self.assertEqual(1, self.settings.get_int("late"))
+        self.assertEqual(1, self.settings.get_int("late"))
+        after = g15dconf.get_statistics()
+        self.assertEqual(4, after["reads"] - before["reads"])
+        self.assertEqual(2, after["hits"] - before["hits"])
+        self.assertEqual(2, after["loads"] - before["loads"])
+
+    def test_change_invalidates(self):
+        self._set("greeting", "'hello'")
+        self.assertEqual("hello", self.settings.get_string("greeting"))
+        self._set("greeting", "'goodbye'")
+        self._change("greeting")
+        self.assertEqual("goodbye", self.settings.get_string("greeting"))
+
+    def test_missing_key(self):
+        self.assertEqual(None, self.settings.get_value("missing"))
+        self.assertEqual(None, self.settings.get_string("missing"))
+        self.assertEqual(0, self.settings.get_int("missing"))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+#  Gnome15 - Suite of tools for the Logitech G series keyboards and headsets
+#  Copyright (C) 2010 Brett Smith <tanktarta@blueyonder.co.uk>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for the monochrome LCD conversions, comparing every conversion path
+against golden frames. The golden frames are PBM images (whose rows are
+packed the same way as libg15 expects) of the benchmark frame.
+"""
+
+import os
+import sys
+import hashlib
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+import gnome15.util.g15pixels as g15pixels
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
+
+def load_golden(dither, invert):
+    f = open(os.path.join(DATA_DIR, "g15pixels-mono-%s%s.pbm" % ( dither, "-inverted" if invert else "" )), "rb")
+    try:
+        magic = f.readline().strip()
+        size = tuple([ int(v) for v in f.readline().split() ])
+        return magic, size, f.read()
+    finally:
+        f.close()
+
+def reverse_bits(byte):
+    return int("{0:08b}".format(byte)[::-1], 2)
+
+class TestMonochrome(unittest.TestCase):
+
+    def setUp(self):
+        self.width, self.height = g15pixels.MONO_GOLDEN_SIZE
+        self.data = g15pixels._test_frame(self.width, self.height)
+        self.options = [ ( d, i ) for d in [ g15pixels.DITHER_NONE, g15pixels.DITHER_ORDERED ] for i in [ False, True ] ]
+
+    def test_golden_frames(self):
+        for dither, invert in self.options:
+            magic, size, golden = load_golden(dither, invert)
+            self.assertEqual("P4", magic)
+            self.assertEqual(g15pixels.MONO_GOLDEN_SIZE, size)
+            self.assertEqual(g15pixels.MONO_GOLDEN[( dither, invert )], hashlib.md5(golden).hexdigest())
+            for path in g15pixels.get_available_paths():
+                self.assertEqual(golden, g15pixels.argb32_to_lcd(self.data, self.width, self.height, invert, dither, path = path),
+                                 "%s path, dither %s, invert %s" % ( path, dither, invert ))
+
+    def test_kernel_layout(self):
+        # LSB first, with each row padded to the framebuffer line length
+        line_length = self.width / 8 + 2
+        buffer_size = 1024
+        for dither, invert in self.options:
+            golden = load_golden(dither, invert)[2]
+            row_bytes = self.width / 8
+            expected = "".join([ "".join([ chr(reverse_bits(ord(c))) for c in golden[y * row_bytes:( y + 1 ) * row_bytes] ]) +
+                                 chr(0) * ( line_length - row_bytes ) for y in range(self.height) ])
+            expected += chr(0) * ( buffer_size - len(expected) )
+            for path in g15pixels.get_available_paths():
+                self.assertEqual(expected, g15pixels.argb32_to_lcd(self.data, self.width, self.height, invert, dither,
+                                                                   line_length, True, buffer_size, path),
+                                 "%s path, dither %s, invert %s" % ( path, dither, invert ))
+
+    def test_benchmark(self):
+        results = g15pixels.benchmark_mono(frames = 10)
+        self.assertEqual(g15pixels.get_available_paths(), [ r[0] for r in results ])
+
+if __name__ == '__main__':
+    unittest.main()
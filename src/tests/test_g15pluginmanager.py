@@ -0,0 +1,149 @@
+#  Gnome15 - Suite of tools for the Logitech G series keyboards and headsets
+#  Copyright (C) 2010 Brett Smith <tanktarta@blueyonder.co.uk>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for plugin activation, in particular plugins that take longer than the
+activation timeout and so finish activating in the background
+"""
+
+import os
+import sys
+import time
+import threading
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+import gnome15.g15pluginmanager as g15pluginmanager
+
+PLUGIN_ID = "test-slow"
+
+class Module():
+
+    def __init__(self):
+        self.id = PLUGIN_ID
+        self.name = "Slow Test Plugin"
+
+class Plugin():
+
+    def __init__(self):
+        self.activations = 0
+        self.deactivations = 0
+        self.destroyed = False
+        self.activating = threading.Event()
+        self.release = threading.Event()
+        self.destroyed_while_activating = False
+        self._in_activate = False
+
+    def activate(self):
+        self.activations += 1
+        self._in_activate = True
+        try:
+            self.activating.set()
+            self.release.wait(5.0)
+        finally:
+            self._in_activate = False
+
+    def deactivate(self):
+        self.deactivations += 1
+
+    def destroy(self):
+        self.destroyed_while_activating = self._in_activate
+        self.destroyed = True
+
+class ConfClient():
+
+    def __init__(self):
+        self.values = {}
+
+    def add_dir(self, key, preload):
+        pass
+
+    def set_bool(self, key, value):
+        self.values[key] = value
+
+class Service():
+
+    def __init__(self):
+        self.conf_client = ConfClient()
+        self.plugin_activation_timeout = 0.1
+        self.plugin_activation_threads = 2
+        self.active_plugins = {}
+
+class Value():
+
+    def __init__(self, value):
+        self.value = value
+
+    def get_bool(self):
+        return self.value
+
+class Entry():
+
+    def __init__(self, plugin_id, enabled):
+        self.key = "/apps/gnome15/global/plugins/%s/enabled" % plugin_id
+        self.value = Value(enabled)
+
+def wait_for(condition, timeout = 5.0):
+    end = time.time() + timeout
+    while not condition() and time.time() < end:
+        time.sleep(0.01)
+    return condition()
+
+class TestActivation(unittest.TestCase):
+
+    def setUp(self):
+        self.module = Module()
+        g15pluginmanager.imported_plugins.append(self.module)
+        self.plugins = g15pluginmanager.G15Plugins(None, Service())
+        self.plugins.state = g15pluginmanager.STARTED
+        self.plugin = Plugin()
+        self.plugins.started.append(self.plugin)
+        self.plugins.module_map[PLUGIN_ID] = self.plugin
+        self.plugins.plugin_map[self.plugin] = self.module
+
+        # Start activating, and leave it to finish in the background
+        self.plugins.activate(plugin = [ self.plugin ])
+        self.assertTrue(self.plugin.activating.is_set())
+        self.assertTrue(self.plugin in self.plugins.stragglers)
+
+    def tearDown(self):
+        self.plugin.release.set()
+        g15pluginmanager.imported_plugins.remove(self.module)
+
+    def test_straggler_not_activated_again(self):
+        self.plugins.activate(plugin = self.plugin)
+        self.assertEqual(1, self.plugin.activations)
+        self.plugin.release.set()
+        self.assertTrue(wait_for(lambda: self.plugin in self.plugins.activated))
+        self.assertEqual(1, self.plugin.activations)
+
+        # Once activated, activating again does nothing either
+        self.plugins.activate(plugin = self.plugin)
+        self.assertEqual(1, self.plugin.activations)
+
+    def test_disable_straggler(self):
+        self.plugins._plugin_changed(None, None, Entry(PLUGIN_ID, False), None)
+        self.assertFalse(self.plugin in self.plugins.started)
+        self.assertFalse(self.plugin.destroyed)
+        self.plugin.release.set()
+        self.assertTrue(wait_for(lambda: self.plugin.destroyed))
+        self.assertFalse(self.plugin.destroyed_while_activating)
+        self.assertEqual(1, self.plugin.deactivations)
+        self.assertFalse(self.plugin in self.plugins.activated)
+        self.assertFalse(PLUGIN_ID in self.plugins.service.active_plugins)
+
+if __name__ == '__main__':
+    unittest.main()
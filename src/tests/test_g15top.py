@@ -0,0 +1,118 @@
+#  Gnome15 - Suite of tools for the Logitech G series keyboards and headsets
+#  Copyright (C) 2012 Brett Smith <tanktarta@blueyonder.co.uk>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for the incrementally refreshed process table, using a synthetic proc
+tree
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+import gnome15.g15top as g15top
+
+class TestProcessTable(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix = "g15top-test")
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _spawn(self, pid, start_time, name, uid):
+        proc_dir = os.path.join(self.root, str(pid))
+        if os.path.exists(proc_dir):
+            shutil.rmtree(proc_dir)
+        os.mkdir(proc_dir)
+        for filename, content in [ ( "stat", "%d (%s) S 1 %d %d 0 -1 4194560 %s %d\n" % ( pid, name, pid, pid, " ".join([ "0" ] * 12), start_time ) ),
+                                   ( "status", "Name:\t%s\nState:\tS (sleeping)\nPid:\t%d\nUid:\t%d\t%d\t%d\t%d\n" % ( name, pid, uid, uid, uid, uid ) ),
+                                   ( "cmdline", "/usr/bin/%s\0--option\0" % name ) ]:
+            f = open(os.path.join(proc_dir, filename), "w")
+            try:
+                f.write(content)
+            finally:
+                f.close()
+
+    def _exit(self, pid):
+        shutil.rmtree(os.path.join(self.root, str(pid)))
+
+    def test_start_time(self):
+        self._spawn(10, 1234, "a name (with brackets)", 0)
+        self.assertEqual(1234, g15top.proc_start_time(10, self.root))
+        self.assertEqual(None, g15top.proc_start_time(11, self.root))
+
+    def test_added_and_removed(self):
+        table = g15top.ProcessTable(self.root)
+        self._spawn(10, 100, "first", 0)
+        self._spawn(11, 110, "second", 0)
+        added, removed = table.refresh()
+        self.assertEqual([ 10, 11 ], sorted([ p.pid for p in added ]))
+        self.assertEqual([], removed)
+
+        self._exit(10)
+        self._spawn(12, 120, "third", 0)
+        added, removed = table.refresh()
+        self.assertEqual([ 12 ], [ p.pid for p in added ])
+        self.assertEqual([ 10 ], [ p.pid for p in removed ])
+        self.assertEqual(None, table.get_process(10))
+        self.assertEqual([ ( 11, 110 ), ( 12, 120 ) ], sorted([ p.get_key() for p in table.get_processes() ]))
+
+    def test_reused_pid(self):
+        table = g15top.ProcessTable(self.root)
+        self._spawn(10, 100, "mine", 1000)
+        table.refresh()
+
+        # Exits and the process ID is given to a process of another user before the next refresh
+        self._spawn(10, 200, "theirs", 0)
+        added, removed = table.refresh()
+        self.assertEqual([ ( 10, 100 ) ], [ p.get_key() for p in removed ])
+        self.assertEqual([ ( 10, 200 ) ], [ p.get_key() for p in added ])
+        process = table.get_process(10)
+        self.assertEqual("theirs", process.name)
+        self.assertEqual(0, process.uid)
+        self.assertEqual([ "/usr/bin/theirs", "--option" ], process.args)
+
+    def test_reused_pid_found_in_rotation(self):
+        table = g15top.ProcessTable(self.root, verify_batch = 2)
+        for pid in range(10, 20):
+            self._spawn(pid, pid * 10, "proc%d" % pid, 0)
+        table.refresh()
+        self._spawn(17, 999, "reused", 0)
+
+        # Only a batch is checked on each refresh, but every process is checked eventually
+        for i in range(0, 6):
+            added, removed = table.refresh()
+            if len(added) > 0:
+                break
+        self.assertEqual([ ( 17, 170 ) ], [ p.get_key() for p in removed ])
+        self.assertEqual([ ( 17, 999 ) ], [ p.get_key() for p in added ])
+        self.assertEqual("reused", table.get_process(17).name)
+
+    def test_verify_all(self):
+        table = g15top.ProcessTable(self.root, verify = True, verify_batch = 0)
+        for pid in range(10, 20):
+            self._spawn(pid, pid * 10, "proc%d" % pid, 0)
+        table.refresh()
+        self._spawn(19, 999, "reused", 0)
+        added, removed = table.refresh()
+        self.assertEqual([ ( 19, 999 ) ], [ p.get_key() for p in added ])
+
+if __name__ == '__main__':
+    unittest.main()
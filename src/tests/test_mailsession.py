@@ -0,0 +1,282 @@
+#  Gnome15 - Suite of tools for the Logitech G series keyboards and headsets
+#  Copyright (C) 2010 Brett Smith <tanktarta@blueyonder.co.uk>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Tests for the lcdbiff plugin's mailbox sessions, run against a small local
+IMAP server that understands just enough of the protocol for a session
+(LOGIN, SELECT, SEARCH UNSEEN and IDLE)
+"""
+
+import os
+import sys
+import time
+import socket
+import threading
+import unittest
+import SocketServer
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "plugins", "lcdbiff"))
+import mailsession
+
+USERNAME = "user"
+PASSWORD = "secret"
+
+class IMAPHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        mailbox = self.server.mailbox
+        mailbox.connected()
+        self._write("* OK IMAP4rev1 ready")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            args = line.strip().split(" ")
+            tag = args[0]
+            command = args[1].upper() if len(args) > 1 else ""
+            if command == "CAPABILITY":
+                self._write("* CAPABILITY IMAP4rev1 IDLE")
+                self._write("%s OK CAPABILITY completed" % tag)
+            elif command == "LOGIN":
+                if args[2].strip('"') == USERNAME and args[3].strip('"') == PASSWORD:
+                    self._write("%s OK LOGIN completed" % tag)
+                else:
+                    self._write("%s NO LOGIN failed" % tag)
+            elif command in ( "SELECT", "EXAMINE" ):
+                self._write("* %d EXISTS" % mailbox.exists)
+                self._write("%s OK [READ-ONLY] %s completed" % ( tag, command ))
+            elif command == "SEARCH":
+                self._write(" ".join([ "* SEARCH" ] + [ str(i) for i in mailbox.unseen ]))
+                self._write("%s OK SEARCH completed" % tag)
+            elif command == "IDLE":
+                self._write("+ idling")
+                mailbox.add_idler(self)
+                try:
+                    line = self.rfile.readline()
+                finally:
+                    mailbox.remove_idler(self)
+                if not line:
+                    break
+                self._write("%s OK IDLE terminated" % tag)
+            elif command == "LOGOUT":
+                self._write("* BYE")
+                self._write("%s OK LOGOUT completed" % tag)
+                break
+            else:
+                self._write("%s BAD unknown command" % tag)
+
+    def drop(self):
+        self.request.shutdown(socket.SHUT_RDWR)
+
+    def _write(self, line):
+        self.wfile.write("%s\r\n" % line)
+        self.wfile.flush()
+
+class Mailbox():
+
+    def __init__(self):
+        self.exists = 2
+        self.unseen = [ 1, 2 ]
+        self.connections = 0
+        self.idlers = []
+        self.changed = threading.Condition()
+
+    def connected(self):
+        self.changed.acquire()
+        try:
+            self.connections += 1
+        finally:
+            self.changed.release()
+
+    def add_idler(self, handler):
+        self.changed.acquire()
+        try:
+            self.idlers.append(handler)
+            self.changed.notify_all()
+        finally:
+            self.changed.release()
+
+    def remove_idler(self, handler):
+        self.changed.acquire()
+        try:
+            if handler in self.idlers:
+                self.idlers.remove(handler)
+            self.changed.notify_all()
+        finally:
+            self.changed.release()
+
+    def wait_for_idlers(self, count, timeout = 5.0):
+        end = time.time() + timeout
+        self.changed.acquire()
+        try:
+            while len(self.idlers) != count and time.time() < end:
+                self.changed.wait(end - time.time())
+            return len(self.idlers) == count
+        finally:
+            self.changed.release()
+
+    def deliver(self, notify = True):
+        self.changed.acquire()
+        try:
+            self.exists += 1
+            self.unseen.append(self.exists)
+            if notify:
+                for handler in self.idlers:
+                    handler._write("* %d EXISTS" % self.exists)
+        finally:
+            self.changed.release()
+
+    def drop_idlers(self):
+        self.changed.acquire()
+        try:
+            for handler in self.idlers:
+                handler.drop()
+        finally:
+            self.changed.release()
+
+class IMAPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, mailbox):
+        SocketServer.TCPServer.__init__(self, ( "127.0.0.1", 0 ), IMAPHandler)
+        self.mailbox = mailbox
+
+class Account():
+
+    def __init__(self, server):
+        self.name = "test"
+        self.type = "imap"
+        self.properties = { "server" : server, "username" : USERNAME, "ssl" : "false" }
+
+    def get_property(self, key, default_value = None):
+        return self.properties[key] if key in self.properties else default_value
+
+class Credentials():
+
+    def get_username(self, account):
+        return account.get_property("username")
+
+    def get_hostname(self, account):
+        return account.get_property("server").partition(":")[0]
+
+    def get_port_or_default(self, account, default_port):
+        _, sep, post = account.get_property("server").partition(":")
+        return int(post) if sep != "" else default_port
+
+    def get_password(self, account, default_port, force_dialog = False):
+        return PASSWORD
+
+    def save_password(self, account, password, default_port):
+        pass
+
+class Listener():
+
+    def __init__(self):
+        self.counts = []
+        self.changed = threading.Condition()
+
+    def session_changed(self, session):
+        self.changed.acquire()
+        try:
+            self.counts.append(session.count)
+            self.changed.notify_all()
+        finally:
+            self.changed.release()
+
+    def wait_for(self, count, timeout = 5.0):
+        end = time.time() + timeout
+        self.changed.acquire()
+        try:
+            while not count in self.counts and time.time() < end:
+                self.changed.wait(end - time.time())
+            return count in self.counts
+        finally:
+            self.changed.release()
+
+class TestMailSession(unittest.TestCase):
+
+    def setUp(self):
+        self.mailbox = Mailbox()
+        self.server = IMAPServer(self.mailbox)
+        thread = threading.Thread(target = self.server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        self.listener = Listener()
+        self.manager = mailsession.SessionManager(self.listener)
+        self.credentials = Credentials()
+        self.account = Account("127.0.0.1:%d" % self.server.server_address[1])
+
+    def tearDown(self):
+        self.manager.close_all()
+        self.mailbox.drop_idlers()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _get_session(self):
+        return self.manager.get_session(self.credentials, self.account, mailsession.IMAPSession)
+
+    def test_check(self):
+        self.assertEqual(( 2, 2 ), self._get_session().check())
+
+    def test_session_kept(self):
+        session = self._get_session()
+        session.check()
+        self.assertTrue(self._get_session() is session)
+        self.assertEqual(1, self.mailbox.connections)
+
+    def test_new_session_when_port_changes(self):
+        session = self._get_session()
+        self.account.properties["server"] = "127.0.0.1:1"
+        other = self._get_session()
+        self.assertFalse(other is session)
+        self.assertTrue(session.closed)
+        self.assertEqual(1, other.port)
+
+    def test_new_session_when_any_property_changes(self):
+        session = self._get_session()
+        self.account.properties["timeout"] = "10"
+        self.assertFalse(self._get_session() is session)
+
+    def test_idle_wakes_on_new_mail(self):
+        session = self._get_session()
+        session.check()
+        self.assertTrue(self.mailbox.wait_for_idlers(1))
+        self.mailbox.deliver()
+        self.assertTrue(self.listener.wait_for(( 3, 3 )))
+        self.assertEqual(( 3, 3 ), session.check())
+        self.assertEqual(1, self.mailbox.connections)
+
+    def test_reconnect_when_idle_connection_dropped(self):
+        session = self._get_session()
+        session.check()
+        self.assertTrue(self.mailbox.wait_for_idlers(1))
+
+        # Mail that arrives while the connection is down is found on reconnect
+        self.mailbox.deliver(False)
+        self.mailbox.drop_idlers()
+        self.assertTrue(self.listener.wait_for(( 3, 3 )))
+        self.assertEqual(2, self.mailbox.connections)
+        self.assertEqual(None, session.error)
+
+        # And the new connection goes back to waiting for changes
+        self.assertTrue(self.mailbox.wait_for_idlers(1))
+        self.mailbox.deliver()
+        self.assertTrue(self.listener.wait_for(( 4, 4 )))
+
+if __name__ == '__main__':
+    unittest.main()